@@ -103,13 +103,47 @@ CREATE TABLE active_relay (
 );
 
 
--- No hostname, for now. I don't think this breaks anybody's heart.
--- Later, could do lookup with socket.getfqdn (plpythonu)
--- CREATE TABLE hostname (
---    address INET NOT NULL,
---    hostname CHARACTER VARYING(255),
---    CONSTRAINT hostname_unique PRIMARY KEY (address)
---);
+-- TABLE hostname
+-- The hostnames of the addresses of relays, as found by reverse DNS
+-- lookups. The lookups are made in the background by the web
+-- application (see status/custom/resolver.py), not by the database.
+-- A NULL hostname records a failed lookup, which is retried once it
+-- expires.
+CREATE TABLE hostname (
+    address INET NOT NULL,
+    hostname CHARACTER VARYING(255),
+    expires TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    CONSTRAINT hostname_unique PRIMARY KEY (address)
+);
+
+
+-- TABLE whois
+-- The WHOIS information of netblocks, as found by lookups from the
+-- whois page (see status/custom/whois.py). Each netblock is stored
+-- under each of its networks, and an address is answered from the
+-- most specific unexpired network that covers it.
+CREATE TABLE whois (
+    network CIDR NOT NULL,
+    netname CHARACTER VARYING(255),
+    org CHARACTER VARYING(255),
+    asn CHARACTER VARYING(255),
+    whois TEXT NOT NULL,
+    expires TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    CONSTRAINT whois_unique PRIMARY KEY (network)
+);
+
+
+-- TABLE exit_summary
+-- The ports that the exit policy of each descriptor accepts, in the
+-- form of the p line of a microdescriptor, such as 'accept 80,443'.
+-- Summaries are written by the web application when it first compiles
+-- the policy of a descriptor (see status/custom/exitpolicy.py), and
+-- purged along with their descriptors.
+CREATE TABLE exit_summary (
+    descriptor CHARACTER(40) NOT NULL,
+    summary TEXT NOT NULL,
+    CONSTRAINT exit_summary_unique PRIMARY KEY (descriptor)
+);
 
 
 -- INDICES ------------------------------------------------------------
@@ -245,6 +279,10 @@ RETURNS INTEGER AS $$
         DELETE FROM cache.active_descriptor
         WHERE published < (SELECT localtimestamp AT TIME ZONE 'UTC')
                           - INTERVAL '48 hours';
+        DELETE FROM cache.exit_summary
+        WHERE descriptor NOT IN (SELECT descriptor
+                                 FROM cache.active_descriptor
+                                 WHERE descriptor IS NOT NULL);
     RETURN 1;
     END;
 $$ LANGUAGE plpgsql;
@@ -302,6 +340,9 @@ RETURNS INTEGER AS $$
                 cache.active_statusentry AS s
                 LEFT JOIN cache.active_descriptor as d
                 ON s.fingerprint=d.fingerprint;
+        -- Tell TorStatus processes that a new consensus is available
+        -- (see status/custom/epoch.py).
+        NOTIFY active_relay_updated;
     RETURN 1;
     END;
 $$ LANGUAGE plpgsql;
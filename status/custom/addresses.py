@@ -0,0 +1,408 @@
+"""
+IPv4 and IPv6 addresses and networks as integers.
+
+Addresses used to be handled as dotted strings, split and converted on
+every comparison, and only IPv4 was understood. Here an address is
+parsed once into its version and an integer, and a L{Network} holds the
+first and last address that it covers, so testing membership is two
+integer comparisons. An L{AddressArray} holds a whole column of
+addresses as NumPy arrays, so that the members of a network can be
+found among every relay at once.
+
+Both versions are handled alike: an IPv6 address is simply a larger
+integer. PostgreSQL sorts INET values by version and then by address,
+and so do the (version, value) pairs of L{parse_address}.
+"""
+# NumPy-specific import statements ------------------------------------
+import numpy
+
+# INIT Variables ------------------------------------------------------
+IPV4 = 4
+IPV6 = 6
+
+# The number of bits in an address of each version.
+ADDRESS_BITS = {IPV4: 32, IPV6: 128}
+
+# The largest address of each version.
+MAX_ADDRESS = {IPV4: (1 << 32) - 1, IPV6: (1 << 128) - 1}
+
+# The low 64 bits of an address; see AddressArray.
+LOW_BITS = (1 << 64) - 1
+
+
+def address_to_int(text, abbreviated=False):
+    """
+    Convert a dotted-quad IPv4 address to an integer.
+
+    >>> address_to_int('1.2.3.4')
+    16909060
+    >>> address_to_int('200.0', abbreviated=True) == (200 << 24)
+    True
+
+    @type text: C{string}
+    @param text: The IPv4 address.
+    @type abbreviated: C{bool}
+    @param abbreviated: Whether trailing zero octets may be left out,
+        as LACNIC does in the networks it answers WHOIS queries with.
+    @rtype: C{int}
+    @return: The address as an integer.
+    @raise ValueError: If the text is not a dotted-quad IPv4 address.
+    """
+    octets = text.split('.')
+    if abbreviated and 1 <= len(octets) < 4:
+        octets.extend(['0'] * (4 - len(octets)))
+    if len(octets) != 4:
+        raise ValueError('not an IPv4 address: %r' % text)
+    value = 0
+    for octet in octets:
+        if not octet.isdigit() or len(octet) > 3:
+            raise ValueError('not an IPv4 address: %r' % text)
+        octet = int(octet)
+        if octet > 255:
+            raise ValueError('not an IPv4 address: %r' % text)
+        value = (value << 8) | octet
+    return value
+
+
+def ipv6_to_int(text):
+    """
+    Convert an IPv6 address to an integer.
+
+    >>> ipv6_to_int('::ffff:1.2.3.4') == 0xffff01020304
+    True
+
+    @type text: C{string}
+    @param text: The IPv6 address, in any of the forms of RFC 4291,
+        including '::' and a trailing dotted quad.
+    @rtype: C{int}
+    @return: The address as an integer.
+    @raise ValueError: If the text is not an IPv6 address.
+    """
+    if text.count('::') > 1:
+        raise ValueError('not an IPv6 address: %r' % text)
+
+    def groups(part):
+        if not part:
+            return []
+        words = part.split(':')
+        # A dotted quad may stand in for the last two groups.
+        if '.' in words[-1]:
+            value = address_to_int(words[-1])
+            words[-1:] = ['%x' % (value >> 16), '%x' % (value & 0xffff)]
+        for word in words:
+            if not 1 <= len(word) <= 4:
+                raise ValueError('not an IPv6 address: %r' % text)
+        return [int(word, 16) for word in words]
+
+    if '::' in text:
+        head, tail = text.split('::')
+        head, tail = groups(head), groups(tail)
+        if len(head) + len(tail) > 7:
+            raise ValueError('not an IPv6 address: %r' % text)
+        words = head + [0] * (8 - len(head) - len(tail)) + tail
+    else:
+        words = groups(text)
+        if len(words) != 8:
+            raise ValueError('not an IPv6 address: %r' % text)
+
+    value = 0
+    for word in words:
+        value = (value << 16) | word
+    return value
+
+
+def parse_address(text):
+    """
+    Parse an IPv4 or IPv6 address.
+
+    >>> parse_address('10.0.0.1')
+    (4, 167772161)
+    >>> parse_address('[::1]')
+    (6, 1)
+
+    @type text: C{string}
+    @param text: The address. An IPv6 address may be in brackets.
+    @rtype: C{tuple}
+    @return: The version of the address and the address as an integer.
+    @raise ValueError: If the text is not an address.
+    """
+    text = text.strip()
+    if text.startswith('[') and text.endswith(']'):
+        return IPV6, ipv6_to_int(text[1:-1])
+    if ':' in text:
+        return IPV6, ipv6_to_int(text)
+    return IPV4, address_to_int(text)
+
+
+def is_address(text, version=None):
+    """
+    Check whether a string is an IP address.
+
+    @type text: C{string}
+    @param text: The supposed address.
+    @type version: C{int}
+    @param version: L{IPV4} or L{IPV6} to accept only that version, or
+        None to accept either.
+    @rtype: C{bool}
+    @return: True if the text is an address of the version.
+    """
+    try:
+        parsed = parse_address(text)
+    except (AttributeError, ValueError):
+        return False
+    return version is None or parsed[0] == version
+
+
+def format_address(version, value):
+    """
+    Write an address as text.
+
+    IPv6 addresses are written in full, without '::', which is valid
+    though not the shortest form.
+
+    @type version: C{int}
+    @param version: L{IPV4} or L{IPV6}.
+    @type value: C{int}
+    @param value: The address as an integer.
+    @rtype: C{string}
+    @return: The address.
+    """
+    if version == IPV4:
+        return '%d.%d.%d.%d' % ((value >> 24) & 255, (value >> 16) & 255,
+                                (value >> 8) & 255, value & 255)
+    return ':'.join(['%x' % ((value >> shift) & 0xffff)
+                     for shift in xrange(112, -1, -16)])
+
+
+def int_to_address(value):
+    """
+    Convert an integer to a dotted-quad IPv4 address; the reverse of
+    L{address_to_int}.
+
+    @type value: C{int}
+    @param value: The address as an integer.
+    @rtype: C{string}
+    @return: The IPv4 address.
+    """
+    return format_address(IPV4, value)
+
+
+def netmask(bits, version=IPV4):
+    """
+    Get the netmask of a prefix length as an integer.
+
+    >>> netmask(8) == 0xff000000
+    True
+
+    @type bits: C{int}
+    @param bits: The prefix length.
+    @type version: C{int}
+    @param version: L{IPV4} or L{IPV6}.
+    @rtype: C{int}
+    @return: The netmask.
+    """
+    maximum = MAX_ADDRESS[version]
+    return (maximum << (ADDRESS_BITS[version] - bits)) & maximum
+
+
+def range_to_networks(first, last, version=IPV4):
+    """
+    Split a range of addresses into the fewest networks that cover
+    exactly that range.
+
+    >>> range_to_networks(address_to_int('10.0.0.0'),
+    ...                   address_to_int('10.0.2.255'))
+    ['10.0.0.0/23', '10.0.2.0/24']
+
+    @type first: C{int}
+    @param first: The first address of the range, as an integer.
+    @type last: C{int}
+    @param last: The last address of the range, as an integer.
+    @type version: C{int}
+    @param version: L{IPV4} or L{IPV6}.
+    @rtype: C{list} of C{string}
+    @return: The networks, in CIDR notation and in order.
+    """
+    width = ADDRESS_BITS[version]
+    networks = []
+    while first <= last:
+        # The largest network that starts at first and does not run
+        # past last.
+        bits = width
+        while bits > 0:
+            size = 1 << (width + 1 - bits)
+            if first & (size - 1) or first + size - 1 > last:
+                break
+            bits -= 1
+        networks.append('%s/%d' % (format_address(version, first), bits))
+        first += 1 << (width - bits)
+    return networks
+
+
+class Network(object):
+    """
+    A network of either version, as the first and last address that
+    it covers.
+
+    @type version: C{int}
+    @ivar version: L{IPV4} or L{IPV6}.
+    @type first: C{int}
+    @ivar first: The first address of the network.
+    @type last: C{int}
+    @ivar last: The last address of the network.
+    """
+    __slots__ = ('version', 'first', 'last')
+
+    def __init__(self, version, first, last):
+        """
+        @type version: C{int}
+        @param version: L{IPV4} or L{IPV6}.
+        @type first: C{int}
+        @param first: The first address of the network.
+        @type last: C{int}
+        @param last: The last address of the network.
+        """
+        self.version = version
+        self.first = first
+        self.last = last
+
+    def __eq__(self, other):
+        return (isinstance(other, Network) and
+                (self.version, self.first, self.last) ==
+                (other.version, other.first, other.last))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.version, self.first, self.last))
+
+    def __repr__(self):
+        return 'Network(%d, %s, %s)' % (
+                self.version, format_address(self.version, self.first),
+                format_address(self.version, self.last))
+
+    def contains(self, version, value):
+        """
+        Check whether the network covers an address.
+
+        @type version: C{int}
+        @param version: The version of the address.
+        @type value: C{int}
+        @param value: The address as an integer.
+        @rtype: C{bool}
+        @return: True if the address is in the network.
+        """
+        return version == self.version and self.first <= value <= self.last
+
+    def __contains__(self, text):
+        try:
+            version, value = parse_address(text)
+        except (AttributeError, ValueError):
+            return False
+        return self.contains(version, value)
+
+    def members(self, addresses):
+        """
+        Check which of an array of addresses the network covers.
+
+        @type addresses: L{AddressArray}
+        @param addresses: The addresses.
+        @rtype: C{numpy.ndarray} of C{bool}
+        @return: True for each address in the network.
+        """
+        first_high = numpy.uint64(self.first >> 64)
+        first_low = numpy.uint64(self.first & LOW_BITS)
+        last_high = numpy.uint64(self.last >> 64)
+        last_low = numpy.uint64(self.last & LOW_BITS)
+        high = addresses.high
+        low = addresses.low
+
+        # Compare the high and then the low 64 bits, since NumPy has no
+        # 128-bit integers.
+        above = (high > first_high) | ((high == first_high) &
+                                       (low >= first_low))
+        below = (high < last_high) | ((high == last_high) &
+                                      (low <= last_low))
+        return (addresses.versions == self.version) & above & below
+
+
+def parse_network(text, version=None):
+    """
+    Parse a network: an address, an address and a number of bits, an
+    IPv4 address and a netmask, or '*' for every address.
+
+    >>> parse_network('10.0.0.0/8') == Network(IPV4, 0x0a000000,
+    ...                                         0x0affffff)
+    True
+
+    @type text: C{string}
+    @param text: The network.
+    @type version: C{int}
+    @param version: The version that '*' stands for; L{IPV4} if None.
+    @rtype: L{Network}
+    @return: The network.
+    @raise ValueError: If the text is not a network.
+    """
+    text = text.strip()
+    if text == '*':
+        version = version or IPV4
+        return Network(version, 0, MAX_ADDRESS[version])
+    if '/' not in text:
+        version, value = parse_address(text)
+        return Network(version, value, value)
+
+    base, bits = text.split('/', 1)
+    version, base = parse_address(base)
+    maximum = MAX_ADDRESS[version]
+    if version == IPV4 and '.' in bits:
+        mask = address_to_int(bits)
+    else:
+        if not bits.isdigit():
+            raise ValueError('not a network: %r' % text)
+        bits = int(bits)
+        if bits > ADDRESS_BITS[version]:
+            raise ValueError('not a network: %r' % text)
+        mask = netmask(bits, version)
+    return Network(version, base & mask, base | (~mask & maximum))
+
+
+class AddressArray(object):
+    """
+    A column of addresses of either version, as NumPy arrays.
+
+    Each address is held as its version and its high and low 64 bits,
+    so that L{Network.members} can compare every address at once.
+    Addresses that cannot be parsed, and missing addresses, have
+    version 0 and belong to no network.
+
+    @type versions: C{numpy.ndarray} of C{uint8}
+    @ivar versions: The version of each address, or 0.
+    @type high: C{numpy.ndarray} of C{uint64}
+    @ivar high: The high 64 bits of each address; 0 for IPv4.
+    @type low: C{numpy.ndarray} of C{uint64}
+    @ivar low: The low 64 bits of each address.
+    """
+
+    def __init__(self, texts):
+        """
+        @type texts: C{list} of C{string}
+        @param texts: The addresses, or None where there is none.
+        """
+        versions = []
+        high = []
+        low = []
+        for text in texts:
+            try:
+                version, value = parse_address(text)
+            except (AttributeError, ValueError):
+                version, value = 0, 0
+            versions.append(version)
+            high.append(value >> 64)
+            low.append(value & LOW_BITS)
+        self.versions = numpy.array(versions, dtype=numpy.uint8)
+        self.high = numpy.array(high, dtype=numpy.uint64)
+        self.low = numpy.array(low, dtype=numpy.uint64)
+
+    def __len__(self):
+        return len(self.versions)
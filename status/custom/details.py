@@ -0,0 +1,140 @@
+"""
+Load and cache the details page of a relay.
+
+The details page used to run one query for the relay, another for the
+validafter of the most recent consensus, a reverse DNS lookup, and the
+family queries of the template on every request. L{load_relay} fetches
+the relay and the most recent validafter in a single statement, and
+rendered pages are kept in Django's cache under a key made of the
+fingerprint, the descriptor digest, the hostname, and the validafter of
+the consensus, all of which the consensus snapshot already knows. A
+repeated view of a relay is therefore served without touching the
+database.
+
+The only part of the page that changes between consensuses is the
+adjusted uptime, which grows with the time since the descriptor was
+published. Cached pages hold L{UPTIME_PLACEHOLDER} in its place, and
+L{fill_uptime} fills it in when the page is served.
+"""
+# General python import statements ------------------------------------
+import datetime
+
+# Django-specific import statements -----------------------------------
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import ActiveRelay
+from statusapp.templatetags.details_filters import words
+from custom.pagecache import page_key, PAGE_CACHE_TIMEOUT
+
+# INIT Variables ------------------------------------------------------
+# Stands in for the adjusted uptime in cached details pages.
+UPTIME_PLACEHOLDER = mark_safe(u'<!-- adjusted uptime -->')
+
+# The most recent validafter, selected alongside the relay.
+LAST_VALIDAFTER_SQL = 'SELECT MAX(validafter) FROM cache.active_relay'
+
+
+def load_relay(fingerprint):
+    """
+    Fetch a relay from the cache.active_relay table together with the
+    validafter of the most recent consensus, in a single statement.
+
+    @type fingerprint: C{string}
+    @param fingerprint: The fingerprint of the relay.
+    @rtype: L{ActiveRelay}
+    @return: The relay, with the most recent validafter as its
+        C{last_validafter} attribute, or None if there is no such
+        relay.
+    """
+    relays = list(ActiveRelay.objects.filter(fingerprint=fingerprint)
+                  .extra(select={'last_validafter': LAST_VALIDAFTER_SQL})
+                  [:1])
+    if not relays:
+        return None
+    return relays[0]
+
+
+def adjusted_uptime(uptime, published, now=None):
+    """
+    Get the uptime of a relay now, assuming that it has stayed up
+    since it published its descriptor.
+
+    @type uptime: C{int}
+    @param uptime: The uptime in the descriptor, in seconds.
+    @type published: C{datetime}
+    @param published: When the descriptor was published.
+    @type now: C{datetime}
+    @param now: The current time, if not C{datetime.datetime.now()}.
+    @rtype: C{int}
+    @return: The adjusted uptime, in seconds.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    diff = now - published
+    return uptime + diff.seconds + diff.days * 24 * 3600
+
+
+def details_key(validafter, fingerprint, descriptor, hostname):
+    """
+    Get the cache key of the details page of a relay.
+
+    @type validafter: C{datetime}
+    @param validafter: The validafter of the most recent consensus.
+    @type fingerprint: C{string}
+    @param fingerprint: The fingerprint of the relay.
+    @type descriptor: C{string}
+    @param descriptor: The digest of the descriptor of the relay.
+    @type hostname: C{string}
+    @param hostname: The hostname of the relay, or None.
+    @rtype: C{string}
+    @return: The cache key.
+    """
+    return page_key('details', validafter,
+                    (fingerprint, descriptor, hostname))
+
+
+def get_details(key):
+    """
+    Get a cached details page.
+
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @rtype: C{unicode}
+    @return: The page, with the adjusted uptime not yet filled in, or
+        None if the page is not cached.
+    """
+    return cache.get(key)
+
+
+def set_details(key, html):
+    """
+    Cache a details page.
+
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @type html: C{unicode}
+    @param html: The page, with L{UPTIME_PLACEHOLDER} in place of the
+        adjusted uptime.
+    """
+    cache.set(key, html, PAGE_CACHE_TIMEOUT)
+
+
+def fill_uptime(html, uptime, published):
+    """
+    Fill the adjusted uptime into a details page.
+
+    @type html: C{unicode}
+    @param html: The page.
+    @type uptime: C{int}
+    @param uptime: The uptime in the descriptor of the relay.
+    @type published: C{datetime}
+    @param published: When the descriptor was published.
+    @rtype: C{unicode}
+    @return: The page, with the adjusted uptime in words.
+    """
+    if UPTIME_PLACEHOLDER not in html:
+        return html
+    return html.replace(UPTIME_PLACEHOLDER,
+                        words(adjusted_uptime(uptime, published)))
@@ -0,0 +1,364 @@
+"""
+Answer TorDNSEL exit list queries over DNS.
+
+Services that want to know whether their clients come from Tor exits
+ask over DNS, in the format of TorDNSEL: an A query for::
+
+    d.c.b.a.P.z.y.x.w.ip-port.exitlist.torproject.org
+
+asks whether the client a.b.c.d is a running relay that would exit to
+port P of the destination w.x.y.z. The answer is C{127.0.0.2} if it
+is, and NXDOMAIN if it is not.
+
+An L{ExitListServer} answers these queries on a UDP socket from the
+exit lists that the consensus snapshot keeps in memory (see
+L{ConsensusSnapshot.exit_list}), so a query costs neither an HTTP
+request nor a database query. It is run with the C{runexitlist}
+management command, and L{resolve} asks it questions, as a resolver
+would.
+"""
+# General python import statements ------------------------------------
+import random
+import socket
+import struct
+import SocketServer
+
+# Django-specific import statements -----------------------------------
+from django.db import connection as db_connection
+
+# TorStatus specific import statements --------------------------------
+from custom.addresses import address_to_int
+from custom.snapshot import get_snapshot
+
+# INIT Variables ------------------------------------------------------
+# The zone that the queries are made under.
+DNSEL_ZONE = 'ip-port.exitlist.torproject.org'
+
+# The address that answers that a client is an exit, and how long, in
+# seconds, resolvers may keep an answer. Exit lists change once per
+# consensus.
+EXIT_ANSWER = '127.0.0.2'
+ANSWER_TTL = 60 * 30
+
+# The largest DNS message that is sent or read over UDP.
+MAX_MESSAGE = 512
+
+# Record types, classes, header flags, and response codes of DNS
+# (RFC 1035).
+TYPE_A = 1
+CLASS_IN = 1
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_RD = 0x0100
+OPCODE_MASK = 0x7800
+RCODE_MASK = 0x000f
+NOERROR = 0
+FORMERR = 1
+SERVFAIL = 2
+NXDOMAIN = 3
+NOTIMP = 4
+REFUSED = 5
+
+
+def parse_question(message):
+    """
+    Read the header and the question of a DNS query.
+
+    @type message: C{string}
+    @param message: The query as it was received.
+    @rtype: C{tuple}
+    @return: The id and flags of the query, the name asked about in
+        lower case and without a trailing dot, its type and class, and
+        the offset of the end of the question.
+    @raise ValueError: If the query cannot be read, or does not hold
+        exactly one question.
+    """
+    if len(message) < 12:
+        raise ValueError('short header')
+    (query_id, flags, questions, answers, authorities,
+     additional) = struct.unpack('!HHHHHH', message[:12])
+    if questions != 1:
+        raise ValueError('%d questions' % questions)
+
+    labels = []
+    offset = 12
+    while True:
+        if offset >= len(message):
+            raise ValueError('truncated name')
+        length = ord(message[offset])
+        offset += 1
+        if length == 0:
+            break
+        if length > 63:
+            # Queries never need to point to names elsewhere.
+            raise ValueError('compressed or bad label')
+        labels.append(message[offset:offset + length])
+        offset += length
+    if offset + 4 > len(message):
+        raise ValueError('truncated question')
+    kind, klass = struct.unpack('!HH', message[offset:offset + 4])
+    name = '.'.join(labels).lower()
+    return query_id, flags, name, kind, klass, offset + 4
+
+
+def parse_name(name, zone=DNSEL_ZONE):
+    """
+    Read the client, port, and destination from the name of a query.
+
+    >>> parse_name('4.3.2.1.80.8.7.6.5.' + DNSEL_ZONE)
+    ('1.2.3.4', 80, '5.6.7.8')
+
+    @type name: C{string}
+    @param name: The name, in lower case and without a trailing dot.
+    @type zone: C{string}
+    @param zone: The zone that queries are made under.
+    @rtype: C{tuple}
+    @return: The client address, the port, and the destination
+        address, or None if the name does not ask about an exit.
+    """
+    if not name.endswith('.' + zone):
+        return None
+    labels = name[:-len(zone) - 1].split('.')
+    if len(labels) != 9:
+        return None
+    client = '.'.join(reversed(labels[0:4]))
+    destination = '.'.join(reversed(labels[5:9]))
+    try:
+        address_to_int(client)
+        address_to_int(destination)
+        port = int(labels[4])
+    except ValueError:
+        return None
+    if not 0 < port <= 65535:
+        return None
+    return client, port, destination
+
+
+def build_query(query_id, name, kind=TYPE_A):
+    """
+    Build a recursive DNS query for a name.
+
+    @type query_id: C{int}
+    @param query_id: The id of the query.
+    @type name: C{string}
+    @param name: The name, without a trailing dot.
+    @type kind: C{int}
+    @param kind: The record type asked for.
+    @rtype: C{string}
+    @return: The query.
+    """
+    question = ''.join([chr(len(label)) + label
+                        for label in name.split('.')]) + '\0'
+    return (struct.pack('!HHHHHH', query_id, FLAG_RD, 1, 0, 0, 0) +
+            question + struct.pack('!HH', kind, CLASS_IN))
+
+
+def build_response(query, flags, question_end, rcode, address=None,
+                   ttl=ANSWER_TTL):
+    """
+    Build the response to a query, repeating its question.
+
+    @type query: C{string}
+    @param query: The query.
+    @type flags: C{int}
+    @param flags: The flags of the query.
+    @type question_end: C{int}
+    @param question_end: The offset of the end of its question.
+    @type rcode: C{int}
+    @param rcode: The response code.
+    @type address: C{string}
+    @param address: The IPv4 address to answer with, or None.
+    @type ttl: C{int}
+    @param ttl: How long, in seconds, the answer may be kept.
+    @rtype: C{string}
+    @return: The response.
+    """
+    flags = FLAG_QR | FLAG_AA | (flags & (OPCODE_MASK | FLAG_RD)) | rcode
+    answers = address is not None and 1 or 0
+    response = (query[:2] + struct.pack('!HHHHH', flags, 1, answers, 0, 0)
+                + query[12:question_end])
+    if address is not None:
+        # The answer names the question, at offset 12, by a pointer.
+        response += (struct.pack('!HHHIH', 0xc00c, TYPE_A, CLASS_IN, ttl,
+                                 4) + socket.inet_aton(address))
+    return response
+
+
+def answer(query, is_exit, zone=DNSEL_ZONE, ttl=ANSWER_TTL):
+    """
+    Answer an exit list query.
+
+    @type query: C{string}
+    @param query: The query as it was received.
+    @type is_exit: C{callable}
+    @param is_exit: A function that takes the client address, port,
+        and destination address and tells whether the client is an
+        exit to the destination.
+    @type zone: C{string}
+    @param zone: The zone that queries are made under.
+    @type ttl: C{int}
+    @param ttl: How long, in seconds, resolvers may keep an answer.
+    @rtype: C{string}
+    @return: The response, or None if the query is too broken to be
+        answered at all.
+    """
+    try:
+        query_id, flags, name, kind, klass, end = parse_question(query)
+    except ValueError:
+        if len(query) < 12:
+            return None
+        # Answer with the header alone, since there is no question
+        # to repeat.
+        flags = struct.unpack('!H', query[2:4])[0]
+        if flags & FLAG_QR:
+            return None
+        flags = FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD)) | FORMERR
+        return query[:2] + struct.pack('!HHHHH', flags, 0, 0, 0, 0)
+
+    if flags & FLAG_QR:
+        return None
+    if flags & OPCODE_MASK:
+        return build_response(query, flags, end, NOTIMP)
+    if not (name == zone or name.endswith('.' + zone)):
+        return build_response(query, flags, end, REFUSED)
+
+    question = parse_name(name, zone)
+    if question is None:
+        if name == zone:
+            return build_response(query, flags, end, NOERROR)
+        return build_response(query, flags, end, NXDOMAIN)
+
+    try:
+        found = is_exit(*question)
+    except Exception:
+        # The exit lists could not be had, for instance because the
+        # database is down; let the resolver try again later.
+        return build_response(query, flags, end, SERVFAIL)
+    if not found:
+        return build_response(query, flags, end, NXDOMAIN)
+    if kind == TYPE_A and klass == CLASS_IN:
+        return build_response(query, flags, end, NOERROR, EXIT_ANSWER,
+                              ttl)
+    return build_response(query, flags, end, NOERROR)
+
+
+def snapshot_is_exit(client, port, destination):
+    """
+    Check whether a client address is a running relay that would exit
+    to a destination, using the exit lists of the consensus snapshot.
+
+    @type client: C{string}
+    @param client: The client address.
+    @type port: C{int}
+    @param port: The destination port.
+    @type destination: C{string}
+    @param destination: The destination address.
+    @rtype: C{bool}
+    @return: True if the client is such a relay.
+    """
+    try:
+        exit_list = get_snapshot().exit_list(
+                address_to_int(destination), port)
+    finally:
+        # Building a snapshot, or checking the valid-after time, leaves
+        # the connection in a transaction that nothing ends in this
+        # process, and an idle transaction blocks the truncation of
+        # the active relay table. Closing a connection that no query
+        # opened costs nothing.
+        db_connection.close()
+    return address_to_int(client) in exit_list
+
+
+class ExitListHandler(SocketServer.BaseRequestHandler):
+    """
+    Answers a single exit list query.
+    """
+
+    def handle(self):
+        query, connection = self.request
+        response = answer(query, self.server.is_exit, self.server.zone,
+                          self.server.ttl)
+        if response is not None:
+            connection.sendto(response, self.client_address)
+
+
+class ExitListServer(SocketServer.UDPServer):
+    """
+    Answers exit list queries on a UDP socket, one at a time. Each
+    answer is a lookup in an exit list that is kept in memory, so
+    there is nothing to gain from answering queries in threads.
+
+    @type is_exit: C{callable}
+    @ivar is_exit: A function that tells whether a client is an exit
+        to a destination; see L{answer}.
+    @type zone: C{string}
+    @ivar zone: The zone that queries are made under.
+    @type ttl: C{int}
+    @ivar ttl: How long, in seconds, resolvers may keep an answer.
+    """
+    allow_reuse_address = True
+    max_packet_size = MAX_MESSAGE
+
+    def __init__(self, address, is_exit=snapshot_is_exit,
+                 zone=DNSEL_ZONE, ttl=ANSWER_TTL):
+        """
+        @type address: C{tuple}
+        @param address: The (host, port) to listen on.
+        @type is_exit: C{callable}
+        @param is_exit: A function that tells whether a client is an
+            exit to a destination.
+        @type zone: C{string}
+        @param zone: The zone that queries are made under.
+        @type ttl: C{int}
+        @param ttl: How long, in seconds, resolvers may keep an answer.
+        """
+        SocketServer.UDPServer.__init__(self, address, ExitListHandler)
+        self.is_exit = is_exit
+        self.zone = zone.lower().strip('.')
+        self.ttl = ttl
+
+
+def resolve(server, name, kind=TYPE_A, timeout=5):
+    """
+    Ask a DNS server about a name, as a stub resolver would.
+
+    @type server: C{tuple}
+    @param server: The (host, port) of the server.
+    @type name: C{string}
+    @param name: The name, without a trailing dot.
+    @type kind: C{int}
+    @param kind: The record type asked for.
+    @type timeout: C{int} or C{float}
+    @param timeout: How long, in seconds, to wait for the response.
+    @rtype: C{tuple}
+    @return: The response code, and the IPv4 addresses that the
+        response answers with.
+    @raise socket.error: If no response arrives in time.
+    @raise ValueError: If the response cannot be read.
+    """
+    query_id = random.randint(0, 0xffff)
+    connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        connection.settimeout(timeout)
+        connection.sendto(build_query(query_id, name, kind), server)
+        while True:
+            response, sender = connection.recvfrom(MAX_MESSAGE)
+            if (len(response) >= 12 and
+                    struct.unpack('!H', response[:2])[0] == query_id):
+                break
+    finally:
+        connection.close()
+
+    (response_id, flags, questions, answers, authorities,
+     additional) = struct.unpack('!HHHHHH', response[:12])
+    offset = parse_question(response)[5]
+    addresses = []
+    for number in xrange(answers):
+        # Every answer names the question by a two-byte pointer.
+        kind, klass, ttl, length = struct.unpack(
+                '!HHIH', response[offset + 2:offset + 12])
+        data = response[offset + 12:offset + 12 + length]
+        if kind == TYPE_A and length == 4:
+            addresses.append(socket.inet_ntoa(data))
+        offset += 12 + length
+    return flags & RCODE_MASK, addresses
@@ -0,0 +1,238 @@
+"""
+Track the validafter of the most recent consensus in the
+cache.active_relay table.
+
+Views and caches used to learn the most recent validafter by running
+C{Max('validafter')} over the active_relay table, often several times
+per request. The table only changes when update_relay_table() runs,
+and update_relay_table() sends a notification on the
+L{NOTIFY_CHANNEL} channel when it does, so each process instead keeps
+the validafter in memory and only queries it again after a
+notification arrives.
+
+If notifications cannot be received, for instance because the listening
+connection has been lost, the validafter is queried again whenever it
+is older than C{settings.CONSENSUS_EPOCH_TTL} seconds.
+
+Because the validafter changes exactly when the active_relay table
+does, L{epoch_key} can be used as the version of anything that is
+computed from the table.
+"""
+# General python import statements ------------------------------------
+import select
+import threading
+import time
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+from django.db.models import Max
+
+# Psycopg2-specific import statements ---------------------------------
+import psycopg2
+import psycopg2.extensions
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import ActiveRelay
+
+# INIT Variables ------------------------------------------------------
+# The channel that update_relay_table() notifies, as in cache.sql.
+NOTIFY_CHANNEL = 'active_relay_updated'
+
+# How long, in seconds, a validafter is trusted while no notifications
+# can be received.
+EPOCH_TTL = getattr(settings, 'CONSENSUS_EPOCH_TTL', 60)
+
+# How long, in seconds, a validafter is trusted while notifications
+# are being received. This only guards against missed notifications.
+LISTENING_TTL = 60 * 15
+
+# How long, in seconds, the listener waits before reconnecting after
+# its connection fails.
+RECONNECT_DELAY = 30
+
+
+class ConsensusEpoch(object):
+    """
+    The validafter of the most recent consensus, cached in memory.
+
+    @type fetch: C{callable}
+    @ivar fetch: A function of no arguments that queries the most
+        recent validafter.
+    @type ttl: C{int} or C{float}
+    @ivar ttl: How long, in seconds, a validafter is trusted while no
+        notifications can be received.
+    """
+
+    def __init__(self, fetch, ttl, listen=False):
+        """
+        @type fetch: C{callable}
+        @param fetch: A function of no arguments that queries the most
+            recent validafter.
+        @type ttl: C{int} or C{float}
+        @param ttl: How long, in seconds, a validafter is trusted while
+            no notifications can be received.
+        @type listen: C{bool}
+        @param listen: Whether to start a thread that listens for the
+            notifications sent by update_relay_table().
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self._listen = listen
+        self._listener = None
+        self._listening = False
+        self._validafter = None
+        self._expires = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def validafter(self):
+        """
+        Get the validafter of the most recent consensus, querying it
+        only if the cached value has been invalidated or has expired.
+
+        @rtype: C{datetime}
+        @return: The validafter of the most recent consensus.
+        """
+        if self._listen and self._listener is None:
+            self._start_listener()
+
+        if time.time() < self._expires:
+            return self._validafter
+
+        self._lock.acquire()
+        try:
+            if time.time() >= self._expires:
+                generation = self._generation
+                self._validafter = self.fetch()
+
+                # If a notification arrived while the query was running,
+                # the result may already be out of date, so don't trust
+                # it beyond this request.
+                if generation == self._generation:
+                    if self._listening:
+                        ttl = LISTENING_TTL
+                    else:
+                        ttl = self.ttl
+                    self._expires = time.time() + ttl
+            return self._validafter
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """
+        Forget the cached validafter, so that the next call to
+        L{validafter} queries it again.
+        """
+        self._generation += 1
+        self._expires = 0
+
+    def _start_listener(self):
+        """
+        Start the thread that listens for notifications.
+        """
+        self._lock.acquire()
+        try:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen_loop,
+                                                  name='consensus-epoch')
+                self._listener.setDaemon(True)
+                self._listener.start()
+        finally:
+            self._lock.release()
+
+    def _listen_loop(self):
+        """
+        Listen for notifications on L{NOTIFY_CHANNEL}, invalidating the
+        cached validafter whenever one arrives, and reconnect whenever
+        the connection fails.
+        """
+        while True:
+            try:
+                connection = psycopg2.connect(**connection_params())
+                try:
+                    connection.set_isolation_level(
+                        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                    connection.cursor().execute(
+                        'LISTEN %s;' % NOTIFY_CHANNEL)
+
+                    # The table may have changed while nobody was
+                    # listening.
+                    self._listening = True
+                    self.invalidate()
+
+                    while True:
+                        readable = select.select([connection], [], [],
+                                                 LISTENING_TTL)[0]
+                        if not readable:
+                            continue
+                        connection.poll()
+                        if connection.notifies:
+                            del connection.notifies[:]
+                            self.invalidate()
+                finally:
+                    self._listening = False
+                    connection.close()
+            except (psycopg2.Error, select.error):
+                time.sleep(RECONNECT_DELAY)
+
+
+def connection_params():
+    """
+    Get the keyword arguments for psycopg2.connect() that connect to
+    the default database in settings.
+
+    @rtype: C{dict}
+    @return: The keyword arguments.
+    """
+    database = settings.DATABASES['default']
+    params = {'database': database['NAME'], 'user': database['USER']}
+    for key in ('PASSWORD', 'HOST', 'PORT'):
+        if database.get(key):
+            params[key.lower()] = database[key]
+    return params
+
+
+def _fetch_validafter():
+    """
+    Query the validafter of the most recent consensus.
+    """
+    return ActiveRelay.objects.aggregate(last=Max('validafter'))['last']
+
+
+__epoch = ConsensusEpoch(_fetch_validafter, EPOCH_TTL, listen=True)
+
+
+def get_validafter():
+    """
+    Get the validafter of the most recent consensus in the
+    cache.active_relay table.
+
+    @rtype: C{datetime}
+    @return: The validafter of the most recent consensus.
+    """
+    return __epoch.validafter()
+
+
+def invalidate_validafter():
+    """
+    Forget the validafter of the most recent consensus, so that it is
+    queried again the next time it is asked for. This is for callers
+    that receive the notifications of update_relay_table() themselves,
+    and may receive one before the listener of this process does.
+    """
+    __epoch.invalidate()
+
+
+def epoch_key():
+    """
+    Get a short string that identifies the most recent consensus, for
+    use in cache keys.
+
+    @rtype: C{string}
+    @return: The validafter of the most recent consensus, as a string
+        of digits, or C{'none'} if the active_relay table is empty.
+    """
+    validafter = __epoch.validafter()
+    if validafter is None:
+        return 'none'
+    return validafter.strftime('%Y%m%d%H%M%S')
@@ -0,0 +1,826 @@
+"""
+Compile exit policies into integer rules.
+
+The exit node query used to split every line of an exit policy into
+its action, subnet, and ports, and then had L{is_ip_in_subnet} and
+L{port_match} parse the subnet and ports again, for every line of every
+relay on every request. L{compile_policy} parses a policy once into
+five parallel integer arrays, one entry per line: the first and last
+address of the subnet, the first and last port, and whether the line
+accepts. L{CompiledPolicy.allows} then only compares integers, taking
+the first line that matches as the old loop did.
+
+A descriptor never changes once it is published, so compiled policies
+are kept by the digest of their descriptor; see L{get_policy}.
+
+To ask which relays can exit to a destination at all, L{ExitIndex}
+arranges the compiled policies of a whole consensus by port and then by
+address, so that the question costs a few binary searches rather than a
+walk through every policy.
+
+L{summarize_policy} reduces a policy to the ports that it accepts to
+most destinations, like the C{p} line of a microdescriptor. Summaries
+are stored in the cache.exit_summary table by L{load_summaries}, and
+let the advanced search find the relays that allow exits to a port
+without looking at their policies.
+
+@see: L{statusapp.views.helpers.is_ip_in_subnet}
+@see: L{statusapp.views.helpers.port_match}
+"""
+# General python import statements ------------------------------------
+import bisect
+import threading
+from array import array
+from itertools import izip
+
+# Django-specific import statements -----------------------------------
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Q
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import ActiveRelay, ExitSummary
+from custom.addresses import address_to_int, parse_network, IPV4
+
+# INIT Variables ------------------------------------------------------
+# The last IPv4 address and the last port, as integers.
+MAX_ADDRESS = 0xffffffff
+MAX_PORT = 65535
+
+# The number of compiled policies that are kept; when the limit is
+# reached, the kept policies are discarded. A consensus names about
+# as many descriptors as it has relays.
+MAX_POLICIES = 1 << 14
+
+# The number of lines of a batch of addresses that are checked against
+# an exit list at a time; see stream_exit_list().
+STREAM_CHUNK_SIZE = 1000
+
+# A port summary, like the p line of a microdescriptor, counts a port
+# as accepted if the policy rejects it for fewer than
+# SUMMARY_REJECT_CUTOFF addresses outside of PRIVATE_NETWORKS, as Tor
+# does; see summarize_policy().
+PRIVATE_NETWORKS = ('0.0.0.0/8', '10.0.0.0/8', '127.0.0.0/8',
+                    '169.254.0.0/16', '172.16.0.0/12', '192.168.0.0/16')
+SUMMARY_REJECT_CUTOFF = 1 << 25
+
+# Stores port summaries in the cache.exit_summary table, leaving out
+# those that are already stored, and the most summaries that a single
+# statement stores.
+STORE_SUMMARIES_SQL = ('INSERT INTO cache.exit_summary '
+                       '(descriptor, summary) '
+                       'SELECT fresh.descriptor, fresh.summary '
+                       'FROM (VALUES %s) AS fresh (descriptor, summary) '
+                       'WHERE NOT EXISTS (SELECT 1 '
+                       'FROM cache.exit_summary stored '
+                       'WHERE stored.descriptor = fresh.descriptor)')
+STORE_SUMMARIES_SIZE = 1000
+
+__policies = {}
+__policies_lock = threading.Lock()
+
+__summaries = {}
+__summaries_lock = threading.Lock()
+
+__private_ranges = [(network.first, network.last) for network in
+                    [parse_network(text) for text in PRIVATE_NETWORKS]]
+__public_size = MAX_ADDRESS + 1 - sum([last - first + 1 for first, last
+                                       in __private_ranges])
+
+
+def parse_subnet(subnet):
+    """
+    Get the first and last address of the subnet of a policy line.
+
+    >>> parse_subnet('10.0.0.0/8') == (0x0a000000, 0x0affffff)
+    True
+
+    @type subnet: C{string}
+    @param subnet: The subnet: C{*}, an address, an address and a
+        number of bits, or an address and a netmask.
+    @rtype: C{tuple}
+    @return: The first and last address as integers.
+    @raise ValueError: If the subnet cannot be parsed, or is not an
+        IPv4 subnet.
+    """
+    network = parse_network(subnet)
+    if network.version != IPV4:
+        raise ValueError('not an IPv4 subnet: %r' % subnet)
+    return network.first, network.last
+
+
+def parse_ports(ports):
+    """
+    Get the first and last port of the ports of a policy line.
+
+    >>> parse_ports('80-443')
+    (80, 443)
+
+    @type ports: C{string}
+    @param ports: The ports: C{*}, a port, or a range of ports.
+    @rtype: C{tuple}
+    @return: The first and last port as integers.
+    @raise ValueError: If the ports cannot be parsed.
+    """
+    if ports == '*':
+        return 0, MAX_PORT
+    if '-' in ports:
+        first, last = ports.split('-', 1)
+        first, last = int(first), int(last)
+    else:
+        first = last = int(ports)
+    if not 0 <= first <= last <= MAX_PORT:
+        raise ValueError('bad ports: %r' % ports)
+    return first, last
+
+
+class CompiledPolicy(object):
+    """
+    An exit policy as parallel arrays of integers, one entry per line.
+
+    @type address_first: C{array} of C{long}
+    @ivar address_first: The first address of the subnet of each line.
+    @type address_last: C{array} of C{long}
+    @ivar address_last: The last address of the subnet of each line.
+    @type port_first: C{array} of C{int}
+    @ivar port_first: The first port of each line.
+    @type port_last: C{array} of C{int}
+    @ivar port_last: The last port of each line.
+    @type accept: C{array} of C{int}
+    @ivar accept: 1 if the line accepts, 0 if it rejects.
+    """
+    __slots__ = ('address_first', 'address_last', 'port_first',
+                 'port_last', 'accept', '_rules')
+
+    def __init__(self):
+        self.address_first = array('L')
+        self.address_last = array('L')
+        self.port_first = array('H')
+        self.port_last = array('H')
+        self.accept = array('B')
+
+        # The same lines as tuples, which are faster to walk in python
+        # than five arrays at once, built when the policy is first
+        # evaluated.
+        self._rules = None
+
+    def __len__(self):
+        return len(self.accept)
+
+    def add(self, accept, address_first, address_last, port_first,
+            port_last):
+        """
+        Add a line to the end of the policy.
+
+        @type accept: C{bool}
+        @param accept: Whether the line accepts.
+        @type address_first: C{int}
+        @param address_first: The first address of the subnet.
+        @type address_last: C{int}
+        @param address_last: The last address of the subnet.
+        @type port_first: C{int}
+        @param port_first: The first port.
+        @type port_last: C{int}
+        @param port_last: The last port.
+        """
+        self.address_first.append(address_first)
+        self.address_last.append(address_last)
+        self.port_first.append(port_first)
+        self.port_last.append(port_last)
+        self.accept.append(accept and 1 or 0)
+        self._rules = None
+
+    def rules(self):
+        """
+        Get the lines of the policy as tuples.
+
+        @rtype: C{tuple} of C{tuple}
+        @return: An (address_first, address_last, port_first,
+            port_last, accept) tuple for each line, in order.
+        """
+        rules = self._rules
+        if rules is None:
+            rules = tuple(izip(self.address_first, self.address_last,
+                               self.port_first, self.port_last,
+                               self.accept))
+            self._rules = rules
+        return rules
+
+    def allows(self, address, port):
+        """
+        Check whether the policy lets a relay exit to an address and
+        port. The first line that matches decides; if no line matches,
+        the relay is taken not to exit there.
+
+        @type address: C{int}
+        @param address: The destination address, as an integer; see
+            L{address_to_int}.
+        @type port: C{int}
+        @param port: The destination port.
+        @rtype: C{bool}
+        @return: True if the first matching line accepts.
+        """
+        for (address_first, address_last, port_first, port_last,
+             accept) in self.rules():
+            if (address_first <= address <= address_last and
+                    port_first <= port <= port_last):
+                return accept == 1
+        return False
+
+
+def compile_policy(lines):
+    """
+    Compile the lines of an exit policy.
+
+    Lines that cannot be parsed are left out, and so are IPv6 lines,
+    since the rules of a compiled policy hold IPv4 addresses.
+
+    @type lines: iterable of C{string}
+    @param lines: The lines of the policy, such as C{'reject *:25'},
+        as stored in the exitpolicy field of a descriptor.
+    @rtype: L{CompiledPolicy}
+    @return: The compiled policy.
+    """
+    policy = CompiledPolicy()
+    for line in lines or ():
+        try:
+            action, target = line.strip().split(' ', 1)
+            subnet, ports = target.strip().rsplit(':', 1)
+            address_first, address_last = parse_subnet(subnet)
+            port_first, port_last = parse_ports(ports)
+        except ValueError:
+            continue
+        if action not in ('accept', 'reject'):
+            continue
+        policy.add(action == 'accept', address_first, address_last,
+                   port_first, port_last)
+    return policy
+
+
+def get_policy(descriptor, lines):
+    """
+    Get the compiled exit policy of a descriptor, compiling it the
+    first time it is asked for.
+
+    @type descriptor: C{string}
+    @param descriptor: The digest of the descriptor, or None if the
+        policy should not be kept.
+    @type lines: iterable of C{string}
+    @param lines: The lines of the exit policy of the descriptor.
+    @rtype: L{CompiledPolicy}
+    @return: The compiled policy.
+    """
+    if descriptor is None:
+        return compile_policy(lines)
+
+    policy = __policies.get(descriptor)
+    if policy is None:
+        policy = compile_policy(lines)
+        __policies_lock.acquire()
+        try:
+            if len(__policies) >= MAX_POLICIES:
+                __policies.clear()
+            __policies[descriptor] = policy
+        finally:
+            __policies_lock.release()
+    return policy
+
+
+def accepted_ranges(rules):
+    """
+    Find the addresses that a list of policy lines accepts, when the
+    first line that matches an address decides.
+
+    >>> accepted_ranges([(10, 19, 0), (0, 99, 1)])
+    [(0, 9), (20, 99)]
+
+    @type rules: iterable of C{tuple}
+    @param rules: An (address_first, address_last, accept) tuple for
+        each line, in order.
+    @rtype: C{list} of C{tuple}
+    @return: The accepted addresses as sorted, disjoint, and
+        non-adjacent (first, last) ranges.
+    """
+    covered = []
+    accepted = []
+    for first, last, accept in rules:
+        if accept:
+            # Accept the part of the line that no earlier line covers.
+            cursor = first
+            for start, end in covered:
+                if end < cursor:
+                    continue
+                if start > last:
+                    break
+                if start > cursor:
+                    accepted.append((cursor, start - 1))
+                cursor = end + 1
+                if cursor > last:
+                    break
+            if cursor <= last:
+                accepted.append((cursor, last))
+        covered = _merge_ranges(covered + [(first, last)])
+        if covered == [(0, MAX_ADDRESS)]:
+            break
+    return _merge_ranges(accepted)
+
+
+def _merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent (first, last) ranges.
+    """
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class ExitIndex(object):
+    """
+    The relays whose exit policies accept each destination, arranged
+    for lookups by address and port.
+
+    The ports are cut into segments at every port where a line of any
+    policy starts or ends, so that within a segment each line either
+    covers every port or none. For a given segment, each policy thus
+    reduces to the lines that cover it, and those lines to the ranges
+    of addresses they accept. Relays whose policies accept the same
+    ranges share one sorted list of ranges, so a lookup costs one
+    binary search per distinct list rather than a walk through every
+    line of every policy. Most relays use one of a few policies, so
+    there are far fewer lists than relays.
+
+    A segment is arranged the first time a port in it is asked about,
+    and kept for the life of the index.
+    """
+
+    def __init__(self, policies):
+        """
+        @type policies: iterable of C{tuple}
+        @param policies: A (position, L{CompiledPolicy}) pair for each
+            relay.
+        """
+        groups = {}
+        for position, policy in policies:
+            groups.setdefault(policy.rules(), []).append(position)
+        self._groups = groups.items()
+
+        bounds = set([0])
+        for rules in groups:
+            for (address_first, address_last, port_first, port_last,
+                 accept) in rules:
+                bounds.add(port_first)
+                if port_last < MAX_PORT:
+                    bounds.add(port_last + 1)
+        self._ports = sorted(bounds)
+
+        # The lists of ranges of each segment that has been asked
+        # about, keyed by the first port of the segment.
+        self._segments = {}
+
+    def exits(self, address, port):
+        """
+        Find the relays whose policies accept a destination.
+
+        @type address: C{int}
+        @param address: The destination address, as an integer; see
+            L{address_to_int}.
+        @type port: C{int}
+        @param port: The destination port.
+        @rtype: C{list} of C{int}
+        @return: The positions of the relays, in ascending order.
+        """
+        segment, tables, matches = self._match(address, port)
+        positions = []
+        for index in matches:
+            positions.extend(tables[index][2])
+        positions.sort()
+        return positions
+
+    def cell(self, address, port):
+        """
+        Get a key that is the same for every destination that each
+        policy treats alike, such as, for most ports, every ordinary
+        address outside the networks that policies name.
+
+        @type address: C{int}
+        @param address: The destination address, as an integer.
+        @type port: C{int}
+        @param port: The destination port.
+        @rtype: C{tuple}
+        @return: The key; two destinations with the same key are
+            accepted by the same relays.
+        """
+        segment, tables, matches = self._match(address, port)
+        return (segment, matches)
+
+    def _match(self, address, port):
+        """
+        Find the segment of a port, its lists of ranges, and the
+        indexes of the lists that hold an address.
+        """
+        segment = self._ports[bisect.bisect_right(self._ports, port) - 1]
+        tables = self._segments.get(segment)
+        if tables is None:
+            tables = self._arrange(segment)
+            self._segments[segment] = tables
+
+        matches = []
+        for index, (firsts, lasts, members) in enumerate(tables):
+            found = bisect.bisect_right(firsts, address) - 1
+            if found >= 0 and address <= lasts[found]:
+                matches.append(index)
+        return segment, tables, tuple(matches)
+
+    def _arrange(self, port):
+        """
+        Build the lists of accepted ranges of the segment that starts
+        at a port, each with the relays whose policies accept them.
+        """
+        reduced = {}
+        for rules, positions in self._groups:
+            lines = tuple([(address_first, address_last, accept)
+                           for (address_first, address_last, port_first,
+                                port_last, accept) in rules
+                           if port_first <= port <= port_last])
+            reduced.setdefault(lines, []).extend(positions)
+
+        ranges = {}
+        for lines, positions in reduced.iteritems():
+            accepted = tuple(accepted_ranges(lines))
+            if accepted:
+                ranges.setdefault(accepted, []).extend(positions)
+
+        tables = []
+        for accepted, positions in ranges.iteritems():
+            tables.append((array('L', [first for first, last
+                                       in accepted]),
+                           array('L', [last for first, last
+                                       in accepted]),
+                           positions))
+        return tables
+
+
+class PortSummary(object):
+    """
+    The ports that an exit policy accepts to most destinations, as in
+    the C{p} line of a microdescriptor: either the ports that it
+    accepts or those that it rejects, whichever list is shorter.
+
+    >>> str(PortSummary(True, [(80, 80), (443, 443)]))
+    'accept 80,443'
+
+    @type accept: C{bool}
+    @ivar accept: True if the ranges are the accepted ports, False if
+        they are the rejected ports.
+    @type ranges: C{tuple} of C{tuple}
+    @ivar ranges: The ports as sorted, disjoint (first, last) ranges.
+    """
+    __slots__ = ('accept', 'ranges', '_firsts')
+
+    def __init__(self, accept, ranges):
+        """
+        @type accept: C{bool}
+        @param accept: True if the ranges are the accepted ports.
+        @type ranges: iterable of C{tuple}
+        @param ranges: The ports as sorted, disjoint (first, last)
+            ranges.
+        """
+        self.accept = accept
+        self.ranges = tuple(ranges)
+        self._firsts = [first for first, last in self.ranges]
+
+    def __eq__(self, other):
+        return (isinstance(other, PortSummary) and
+                (self.accept, self.ranges) == (other.accept, other.ranges))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.accept, self.ranges))
+
+    def __str__(self):
+        ports = []
+        for first, last in self.ranges:
+            if first == last:
+                ports.append('%d' % first)
+            else:
+                ports.append('%d-%d' % (first, last))
+        if self.accept:
+            action = 'accept'
+        else:
+            action = 'reject'
+        return '%s %s' % (action, ','.join(ports))
+
+    def accepted(self):
+        """
+        Get the ports, other than port 0, that the policy accepts to
+        most destinations.
+
+        >>> PortSummary(False, [(1, 79), (81, 65535)]).accepted()
+        [(80, 80)]
+
+        @rtype: C{list} of C{tuple}
+        @return: The ports as sorted, disjoint (first, last) ranges.
+        """
+        if self.accept:
+            return [(max(first, 1), last) for first, last in self.ranges
+                    if last >= 1]
+        accepted = []
+        cursor = 1
+        for first, last in self.ranges:
+            if first > cursor:
+                accepted.append((cursor, first - 1))
+            cursor = max(cursor, last + 1)
+        if cursor <= MAX_PORT:
+            accepted.append((cursor, MAX_PORT))
+        return accepted
+
+    def allows(self, port):
+        """
+        Check whether the policy accepts a port to most destinations.
+
+        @type port: C{int}
+        @param port: The port.
+        @rtype: C{bool}
+        @return: True if the port is accepted.
+        """
+        index = bisect.bisect_right(self._firsts, port) - 1
+        listed = index >= 0 and port <= self.ranges[index][1]
+        return listed == self.accept
+
+
+def parse_summary(text):
+    """
+    Parse a port summary, as written by L{PortSummary}.
+
+    @type text: C{string}
+    @param text: The summary, such as C{'reject 25,119,135-139'}.
+    @rtype: L{PortSummary}
+    @return: The summary.
+    @raise ValueError: If the text is not a port summary.
+    """
+    action, ports = text.strip().split(' ', 1)
+    if action not in ('accept', 'reject'):
+        raise ValueError('not a port summary: %r' % text)
+    ranges = [parse_ports(entry) for entry in ports.split(',')]
+    return PortSummary(action == 'accept', _merge_ranges(ranges))
+
+
+def summarize_policy(policy):
+    """
+    Summarize the ports that a compiled policy accepts.
+
+    A port is accepted if the policy rejects it for fewer than
+    L{SUMMARY_REJECT_CUTOFF} addresses outside of the private
+    networks, so a policy that only rejects a few hosts or private
+    networks still counts as accepting the port, as in Tor's
+    microdescriptors. Port 0 is left out.
+
+    @type policy: L{CompiledPolicy}
+    @param policy: The policy.
+    @rtype: L{PortSummary}
+    @return: The summary.
+    """
+    rules = policy.rules()
+    bounds = set([1])
+    for (address_first, address_last, port_first, port_last,
+         accept) in rules:
+        if port_first > 1:
+            bounds.add(port_first)
+        if port_last < MAX_PORT:
+            bounds.add(port_last + 1)
+    bounds = sorted(bounds)
+
+    # Ports whose segments are covered by the same lines are decided
+    # alike, so each distinct set of lines is decided once.
+    decided = {}
+    accepted = []
+    for index, first in enumerate(bounds):
+        if index + 1 < len(bounds):
+            last = bounds[index + 1] - 1
+        else:
+            last = MAX_PORT
+        lines = tuple([(address_first, address_last, accept)
+                       for (address_first, address_last, port_first,
+                            port_last, accept) in rules
+                       if port_first <= first <= port_last])
+        if lines not in decided:
+            decided[lines] = (_public_rejected(accepted_ranges(lines)) <
+                              SUMMARY_REJECT_CUTOFF)
+        if decided[lines]:
+            accepted.append((first, last))
+    accepted = _merge_ranges(accepted)
+
+    rejected = []
+    cursor = 1
+    for first, last in accepted:
+        if first > cursor:
+            rejected.append((cursor, first - 1))
+        cursor = last + 1
+    if cursor <= MAX_PORT:
+        rejected.append((cursor, MAX_PORT))
+
+    if not accepted:
+        return PortSummary(False, rejected)
+    summary = PortSummary(True, accepted)
+    if rejected and len(str(PortSummary(False, rejected))) < len(
+            str(summary)):
+        return PortSummary(False, rejected)
+    return summary
+
+
+def _public_rejected(accepted):
+    """
+    Count the addresses outside of the private networks that are not
+    in a list of accepted (first, last) ranges.
+    """
+    rejected = __public_size
+    for first, last in accepted:
+        rejected -= last - first + 1
+        for private_first, private_last in __private_ranges:
+            overlap = min(last, private_last) - max(first, private_first)
+            if overlap >= 0:
+                rejected += overlap + 1
+    return rejected
+
+
+def load_policies(descriptors):
+    """
+    Get the compiled exit policies of relays, reusing the policies of
+    descriptors that have been compiled before.
+
+    Only the policies of descriptors that have not been compiled yet,
+    and of relays without a descriptor, are read from the
+    cache.active_relay table, so a consensus that brings no new
+    descriptors reads none.
+
+    @type descriptors: C{dict}
+    @param descriptors: The digest of the descriptor of each relay, or
+        None if it has none, keyed by fingerprint.
+    @rtype: C{dict}
+    @return: The compiled policy of each relay, keyed by fingerprint.
+    """
+    policies = {}
+    missing = set()
+    unnamed = False
+    for fingerprint, descriptor in descriptors.iteritems():
+        if not descriptor:
+            unnamed = True
+            continue
+        policy = __policies.get(descriptor)
+        if policy is None:
+            missing.add(descriptor)
+        else:
+            policies[fingerprint] = policy
+
+    if missing or unnamed:
+        query = Q(descriptor__isnull=True)
+        if missing:
+            query |= Q(descriptor__in=list(missing))
+        rows = ActiveRelay.objects.filter(query).values_list(
+                'fingerprint', 'descriptor', 'exitpolicy')
+        for fingerprint, descriptor, lines in rows.iterator():
+            if fingerprint in descriptors:
+                policies[fingerprint] = get_policy(descriptor or None,
+                                                   lines)
+    return policies
+
+
+def load_summaries(policies):
+    """
+    Get the port summaries of the exit policies of descriptors.
+
+    Summaries are taken from memory or, failing that, from the
+    cache.exit_summary table. Those that are in neither are computed
+    from the compiled policies and stored in bulk (see
+    L{store_summaries}), so each descriptor is usually summarized once,
+    by whichever process first loads it.
+
+    @type policies: C{dict}
+    @param policies: The L{CompiledPolicy} of each descriptor, keyed by
+        the digest of the descriptor.
+    @rtype: C{dict}
+    @return: The L{PortSummary} of each descriptor, keyed by the digest
+        of the descriptor.
+    """
+    summaries = {}
+    missing = []
+    for descriptor in policies:
+        summary = __summaries.get(descriptor)
+        if summary is None:
+            missing.append(descriptor)
+        else:
+            summaries[descriptor] = summary
+
+    found = {}
+    if missing:
+        rows = ExitSummary.objects.filter(descriptor__in=missing)
+        for descriptor, text in rows.values_list('descriptor', 'summary'):
+            try:
+                found[descriptor] = parse_summary(text)
+            except ValueError:
+                pass
+
+    computed = {}
+    for descriptor in missing:
+        summary = found.get(descriptor)
+        if summary is None:
+            summary = summarize_policy(policies[descriptor])
+            computed[descriptor] = summary
+        summaries[descriptor] = summary
+    if computed:
+        store_summaries(computed)
+
+    __summaries_lock.acquire()
+    try:
+        if len(__summaries) + len(missing) > MAX_POLICIES:
+            __summaries.clear()
+        for descriptor in missing:
+            __summaries[descriptor] = summaries[descriptor]
+    finally:
+        __summaries_lock.release()
+    return summaries
+
+
+def store_summaries(summaries, chunk_size=STORE_SUMMARIES_SIZE):
+    """
+    Store port summaries in the cache.exit_summary table, a chunk at a
+    time, leaving out those that are already stored.
+
+    Several processes may summarize the same consensus at once, so a
+    chunk may still collide with summaries that another process has
+    stored meanwhile. Such a chunk is rolled back and left out; its
+    summaries are the same as those stored, or are computed again by
+    the next process that misses them. The table is only a cache, so
+    no error in storing to it is raised.
+
+    @type summaries: C{dict}
+    @param summaries: The L{PortSummary} of each descriptor, keyed by
+        the digest of the descriptor.
+    @type chunk_size: C{int}
+    @param chunk_size: The most summaries stored by one statement.
+    @rtype: C{int}
+    @return: The number of chunks that could not be stored.
+    """
+    # Inserting in order keeps concurrent inserts from waiting on each
+    # other in a circle.
+    rows = sorted([(descriptor, str(summary)) for descriptor, summary
+                   in summaries.iteritems()])
+    failed = 0
+    cursor = connection.cursor()
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        params = []
+        for row in chunk:
+            params.extend(row)
+        savepoint = transaction.savepoint()
+        try:
+            cursor.execute(STORE_SUMMARIES_SQL %
+                           ', '.join(['(%s, %s)'] * len(chunk)), params)
+        except DatabaseError:
+            transaction.savepoint_rollback(savepoint)
+            failed += 1
+        else:
+            transaction.savepoint_commit(savepoint)
+    transaction.commit_unless_managed()
+    return failed
+
+
+def stream_exit_list(exit_list, lines, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Pick the addresses that are in an exit list out of lines of text,
+    a chunk of lines at a time, so that a batch of any size is checked
+    without being held in memory.
+
+    @type exit_list: C{dict}
+    @param exit_list: The exit list, keyed by address as an integer,
+        as returned by L{ConsensusSnapshot.exit_list}.
+    @type lines: iterable of C{string}
+    @param lines: The lines, each holding addresses separated by
+        whitespace or commas. Anything that is not an IPv4 address is
+        skipped.
+    @type chunk_size: C{int}
+    @param chunk_size: The number of lines checked per chunk.
+    @rtype: iterator of C{string}
+    @return: The addresses in the exit list, one per line, in the
+        order they were given.
+    """
+    chunk = []
+    for number, line in enumerate(lines):
+        for address in line.replace(',', ' ').split():
+            try:
+                if address_to_int(address) in exit_list:
+                    chunk.append(address + '\n')
+            except ValueError:
+                continue
+        if number % chunk_size == chunk_size - 1 and chunk:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
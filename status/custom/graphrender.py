@@ -0,0 +1,579 @@
+"""
+Draw graphs with matplotlib in a pool of processes.
+
+The graphs used to set their margins through the global
+C{matplotlib.rcParams['figure.subplot.*']} before building each figure,
+so two requests drawing at the same time in a threaded server could
+give each other their margins, and every graph was drawn on the core of
+the process that served it. The functions here take the data of a
+graph and return its PNG bytes; each figure is given its own layout
+(see L{new_figure}), and no global state of matplotlib is changed.
+
+Since they only take and return plain data, the drawing functions can
+be sent to other processes. L{submit_graph} hands them to a
+C{multiprocessing} pool of C{GRAPH_PROCESSES} processes or, in the
+C{rendergraphs} command, C{GRAPH_RENDER_PROCESSES}, so that the graphs
+it renders together are drawn on every core. With no processes, as in
+the web server by default, graphs are drawn in the calling thread.
+
+The data of a graph is gathered by the caller, in the process that
+holds the database connection and the consensus snapshot.
+"""
+# General python import statements ------------------------------------
+import multiprocessing
+import os
+import threading
+from cStringIO import StringIO
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+
+# NumPy-specific import statements ------------------------------------
+import numpy
+
+# Matplotlib-specific import statements -------------------------------
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from matplotlib.figure import Figure, SubplotParams
+from matplotlib.font_manager import FontProperties
+from matplotlib.ticker import MaxNLocator
+
+
+def _cpu_count():
+    """
+    Count the processors of the machine.
+
+    @rtype: C{int}
+    @return: The number of processors, or 1 if it cannot be told.
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+# INIT Variables ------------------------------------------------------
+# The number of processes that draw graphs, or 0 to draw graphs in the
+# thread that asks for them, in the web server and in the
+# rendergraphs command.
+GRAPH_PROCESSES = getattr(settings, 'GRAPH_PROCESSES', 0)
+GRAPH_RENDER_PROCESSES = getattr(settings, 'GRAPH_RENDER_PROCESSES',
+                                 _cpu_count())
+
+# How long, in seconds, to wait for a graph to be drawn.
+GRAPH_TIMEOUT = getattr(settings, 'GRAPH_TIMEOUT', 60)
+
+# The resolution of the figures, in pixels per inch.
+GRAPH_DPI = 80
+
+
+def new_figure(width, height, top, bottom, left, right):
+    """
+    Build an empty figure whose subplots leave the given margins.
+
+    @type width: C{int}
+    @param width: The width of the figure, in pixels.
+    @type height: C{int}
+    @param height: The height of the figure, in pixels.
+    @type top: C{int}
+    @param top: The margin above the subplots, in pixels.
+    @type bottom: C{int}
+    @param bottom: The margin below the subplots, in pixels.
+    @type left: C{int}
+    @param left: The margin left of the subplots, in pixels.
+    @type right: C{int}
+    @param right: The margin right of the subplots, in pixels.
+    @rtype: C{Figure}
+    @return: The figure.
+    """
+    layout = SubplotParams(left=float(left) / width,
+                           right=float(width - right) / width,
+                           top=float(height - top) / height,
+                           bottom=float(bottom) / height)
+    return Figure(facecolor='white', edgecolor='black',
+                  figsize=(float(width) / GRAPH_DPI,
+                           float(height) / GRAPH_DPI),
+                  frameon=False, subplotpars=layout)
+
+
+def print_png(fig):
+    """
+    Render a figure as a PNG image.
+
+    @type fig: C{Figure}
+    @param fig: The figure.
+    @rtype: C{string}
+    @return: The PNG bytes of the figure.
+    """
+    output = StringIO()
+    FigureCanvas(fig).print_png(output)
+    return output.getvalue()
+
+
+def bar_graph(xs, ys, labels, params):
+    """
+    Draw a bar graph, given data points, labels, and presentation
+    parameters.
+
+    @type xs: C{list}
+    @param xs: The x values to be plotted.
+    @type ys: C{list}
+    @param ys: The y values to be plotted.
+    @type labels: C{list} of C{string}
+    @param labels: The labels to be used for each data point, where
+        C{labels[i]} labels C{(xs[i], ys[i])}.
+    @type params: C{dict} of C{string} and C{int}
+    @param params: Parameters specifying how the graph is to be drawn.
+        Params must contain the keys: WIDTH, HEIGHT, TOP_MARGIN,
+        BOTTOM_MARGIN, LEFT_MARGIN, RIGHT_MARGIN, X_FONT_SIZE,
+        Y_FONT_SIZE, LABEL_FONT_SIZE, FONT_WEIGHT, BAR_WIDTH,
+        COLOR, LABEL_FLOAT, LABEL_ROT, and TITLE.
+    @rtype: C{string}
+    @return: The PNG bytes of the graph.
+    """
+    ## Get the parameters from the params dictionary
+    # Width and height of the graph in pixels
+    WIDTH = params['WIDTH']
+    HEIGHT = params['HEIGHT']
+    # Space in pixels given around plot
+    TOP_MARGIN = params['TOP_MARGIN']
+    BOTTOM_MARGIN = params['BOTTOM_MARGIN']
+    LEFT_MARGIN = params['LEFT_MARGIN']
+    RIGHT_MARGIN = params['RIGHT_MARGIN']
+    # Font sizes, in pixels
+    X_FONT_SIZE = params['X_FONT_SIZE']
+    Y_FONT_SIZE = params['Y_FONT_SIZE']
+    LABEL_FONT_SIZE = params['LABEL_FONT_SIZE']
+    # How many pixels above each bar the labels should be
+    LABEL_FLOAT = params['LABEL_FLOAT']
+    # How the labels should be presented
+    LABEL_ROT = params['LABEL_ROT']
+    # Font weight used for labels and titles
+    FONT_WEIGHT = params['FONT_WEIGHT']
+    BAR_WIDTH = params['BAR_WIDTH']
+    COLOR = params['COLOR']
+    # Title of graph
+    TITLE = params['TITLE']
+
+    fig = new_figure(WIDTH, HEIGHT, TOP_MARGIN, BOTTOM_MARGIN,
+                     LEFT_MARGIN, RIGHT_MARGIN)
+    ax = fig.add_subplot(111)
+
+    # Plot the data.
+    ax.bar(xs, ys, color=COLOR, width=BAR_WIDTH)
+
+    # Label the height of each bar.
+    label_float_ydist = ax.get_ylim()[1] * LABEL_FLOAT / (
+                        HEIGHT - TOP_MARGIN - BOTTOM_MARGIN)
+    num_params = len(xs)
+    for i in range(num_params):
+        ax.text(xs[i] + (BAR_WIDTH / 2.0),
+                ys[i] + (label_float_ydist), str(ys[i]),
+                fontsize=LABEL_FONT_SIZE, horizontalalignment='center')
+
+    x_index = numpy.arange(num_params)
+    ax.set_xticks(x_index + (BAR_WIDTH / 2.0))
+    ax.set_xticklabels(labels, fontsize=X_FONT_SIZE,
+                       fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
+
+    for tick in ax.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(Y_FONT_SIZE)
+        tick.label1.set_fontweight(FONT_WEIGHT)
+
+    ax.set_title(TITLE, fontsize='12', fontweight=FONT_WEIGHT)
+
+    return print_png(fig)
+
+
+def line_graph(bps, times, title, color, shade):
+    """
+    Draw a graph of the bandwidth history of a router over a day.
+
+    @type bps: C{list} of C{int}
+    @param bps: The average bandwidth, in bytes per second, of each of
+        the 96 quarters of an hour of the day.
+    @type times: C{list} of C{string}
+    @param times: The labels of every eighth quarter, from the first
+        to the one after the last.
+    @type title: C{string}
+    @param title: The title of the graph.
+    @type color: C{string}
+    @param color: The color to draw the line graph with.
+    @type shade: C{string}
+    @param shade: The color to shade under the line graph.
+    @rtype: C{string}
+    @return: The PNG bytes of the graph.
+    """
+    # Width and height of the graph in pixels
+    WIDTH = 480
+    HEIGHT = 320
+    # Space in pixels given around plot
+    TOP_MARGIN = 42
+    BOTTOM_MARGIN = 32
+    LEFT_MARGIN = 98
+    RIGHT_MARGIN = 5
+    # Font sizes, in pixels
+    X_FONT_SIZE = '8'
+    Y_FONT_SIZE = '8'
+    # Font weight used for labels and titles.
+    FONT_WEIGHT = 'bold'
+
+    fig = new_figure(WIDTH, HEIGHT, TOP_MARGIN, BOTTOM_MARGIN,
+                     LEFT_MARGIN, RIGHT_MARGIN)
+    ax = fig.add_subplot(111)
+
+    dates = range(len(bps))
+
+    # Draw the graph and give the graph a light shade underneath it
+    ax.plot(dates, bps, color=color)
+    ax.fill_between(dates, 0, bps, color=shade)
+
+    ax.set_xlabel("Time (GMT)", fontsize='12')
+    ax.set_xticks(range(0, 104, 8))
+    ax.set_xticklabels(times, fontsize=X_FONT_SIZE,
+                       fontweight=FONT_WEIGHT)
+
+    ax.set_ylabel("Bandwidth (bytes/sec)", fontsize='12')
+
+    # Don't extend the y-axis to negative numbers, in any circumstance
+    ax.set_ylim(ymin=0)
+
+    # Don't use scientific notation
+    ax.yaxis.major.formatter.set_scientific(False)
+
+    # Format the y-tick labels with the desired font weight and size
+    for tick in ax.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(Y_FONT_SIZE)
+        tick.label1.set_fontweight(FONT_WEIGHT)
+
+    ax.set_title(title, fontsize='12', fontweight=FONT_WEIGHT)
+
+    return print_png(fig)
+
+
+def total_bandwidth_graph(ys_bwobserved, ys_relays, times):
+    """
+    Draw a graph of the total observed bandwidth and the average number
+    of running relays of the Tor network, by day.
+
+    @type ys_bwobserved: C{list} of C{float}
+    @param ys_bwobserved: The total observed bandwidth of each day, in
+        MiB, from the earliest day on.
+    @type ys_relays: C{list}
+    @param ys_relays: The average number of running relays of each day.
+    @type times: C{list} of C{string}
+    @param times: The labels of every seventh day, from the first on.
+    @rtype: C{string}
+    @return: The PNG bytes of the graph.
+    """
+    # Graph presentation parameters -----------------------------------
+    HEIGHT = 160
+    WIDTH = 440
+    TOP_MARGIN = 8
+    BOTTOM_MARGIN = 28
+    LEFT_MARGIN = 50
+    RIGHT_MARGIN = 50
+    X_FONT_SIZE = 8
+    Y_FONT_SIZE = 8
+    LABEL_ROT = 'horizontal'
+    FONT_WEIGHT = 'bold'
+
+    data_points = len(ys_bwobserved)
+    xs = range(data_points)
+
+    fig = new_figure(WIDTH, HEIGHT, TOP_MARGIN, BOTTOM_MARGIN,
+                     LEFT_MARGIN, RIGHT_MARGIN)
+
+    # Draw bandwidth observed line
+    ax1 = fig.add_subplot(111)
+
+    ax1.plot(xs, ys_bwobserved, color='#68228B',
+             label='Observed Bandwidth')
+
+    # Shade the area below the graph lightly
+    ax1.fill_between(xs, 0, ys_bwobserved, color='#DAC8E2')
+
+    # Label the graph with appropriate colors and fontsizes
+    ax1.set_xlabel("Date (GMT)", fontsize='8', fontweight=FONT_WEIGHT)
+    ax1.set_xticks(range(0, data_points, 7))
+    ax1.set_xticklabels(times, fontsize=X_FONT_SIZE,
+                        fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
+
+    ax1.set_ylabel("Bandwidth (MiB)",
+                  fontsize='8', fontweight=FONT_WEIGHT)
+
+    for tick in ax1.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(Y_FONT_SIZE)
+        tick.label1.set_fontweight(FONT_WEIGHT)
+
+    for tick in ax1.get_yticklabels():
+        tick.set_color('#68228B')
+
+    # Draw average relays running line using same 'xs' as before.
+    ax2 = ax1.twinx()
+    ax2.plot(xs, ys_relays, color='#005500',
+             label='Average Active Relays')
+
+    # Label the graph with appropriate colors and fontsizes
+    ax2.set_xticks(range(0, data_points, 7))
+    ax2.set_xticklabels(times, fontsize=X_FONT_SIZE,
+                        fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
+
+    ax2.set_ylabel('Relays', fontsize='8', fontweight=FONT_WEIGHT)
+
+    for tick in ax2.yaxis.get_major_ticks():
+        tick.label2.set_fontsize(Y_FONT_SIZE)
+        tick.label2.set_fontweight(FONT_WEIGHT)
+
+    for tick in ax2.get_yticklabels():
+        tick.set_color('#005500')
+
+    # Label entire graph
+    fontparam = FontProperties(size=8, weight='bold')
+
+    # TODO: put both labels in one legend. How?
+    ax1.legend(prop=fontparam, loc='lower left')
+    ax2.legend(prop=fontparam, loc='lower right')
+
+    # TODO: Make a grid that works for both lines
+    # (Set tick marks such that a grid applies to both lines)
+    ax1.set_ylim(ymin=0)
+    ax1.set_xlim(xmin=0)
+    ax2.set_xlim(xmin=0)
+    ax1.yaxis.set_major_locator(MaxNLocator(5))
+    ax2.yaxis.set_major_locator(MaxNLocator(5))
+
+    return print_png(fig)
+
+
+def port_coverage_graph(counts, bandwidths):
+    """
+    Draw a graph of the number of exits and the exit bandwidth that
+    allow exiting to each port.
+
+    @type counts: C{numpy.ndarray}
+    @param counts: The number of exits allowing each port, indexed by
+        port; see L{ConsensusSnapshot.port_coverage}.
+    @type bandwidths: C{numpy.ndarray}
+    @param bandwidths: The total observed bandwidth, in bytes per
+        second, of the exits allowing each port.
+    @rtype: C{string}
+    @return: The PNG bytes of the graph.
+    """
+    # Graph presentation parameters -----------------------------------
+    HEIGHT = 320
+    WIDTH = 960
+    TOP_MARGIN = 25
+    BOTTOM_MARGIN = 38
+    LEFT_MARGIN = 60
+    RIGHT_MARGIN = 60
+    X_FONT_SIZE = 8
+    Y_FONT_SIZE = 8
+    FONT_WEIGHT = 'bold'
+
+    max_port = len(counts) - 1
+    ports = numpy.arange(1, max_port + 1)
+    ys_exits = counts[1:]
+    ys_bandwidth = bandwidths[1:] / float(1024 ** 2)
+
+    fig = new_figure(WIDTH, HEIGHT, TOP_MARGIN, BOTTOM_MARGIN,
+                     LEFT_MARGIN, RIGHT_MARGIN)
+
+    # Draw the exit bandwidth, shaded, on a logarithmic port axis so
+    # that the well-known ports can be told apart.
+    ax1 = fig.add_subplot(111)
+    ax1.set_xscale('log')
+    ax1.plot(ports, ys_bandwidth, color='#68228B',
+             label='Exit Bandwidth', drawstyle='steps-post')
+    ax1.fill_between(ports, 0, ys_bandwidth, color='#DAC8E2')
+    ax1.set_xlim(1, max_port)
+    ax1.set_ylim(ymin=0)
+    ax1.set_xlabel('Port', fontsize='8', fontweight=FONT_WEIGHT)
+    ax1.set_ylabel('Bandwidth (MiB/s)', fontsize='8',
+                   fontweight=FONT_WEIGHT)
+
+    for tick in ax1.xaxis.get_major_ticks():
+        tick.label1.set_fontsize(X_FONT_SIZE)
+        tick.label1.set_fontweight(FONT_WEIGHT)
+    for tick in ax1.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(Y_FONT_SIZE)
+        tick.label1.set_fontweight(FONT_WEIGHT)
+    for tick in ax1.get_yticklabels():
+        tick.set_color('#68228B')
+
+    # Draw the number of exits against the same ports.
+    ax2 = ax1.twinx()
+    ax2.set_xscale('log')
+    ax2.plot(ports, ys_exits, color='#005500', label='Exits',
+             drawstyle='steps-post')
+    ax2.set_xlim(1, max_port)
+    ax2.set_ylim(ymin=0)
+    ax2.set_ylabel('Exits', fontsize='8', fontweight=FONT_WEIGHT)
+
+    for tick in ax2.yaxis.get_major_ticks():
+        tick.label2.set_fontsize(Y_FONT_SIZE)
+        tick.label2.set_fontweight(FONT_WEIGHT)
+    for tick in ax2.get_yticklabels():
+        tick.set_color('#005500')
+
+    fontparam = FontProperties(size=8, weight='bold')
+    ax1.legend(prop=fontparam, loc='lower left')
+    ax2.legend(prop=fontparam, loc='lower right')
+    ax1.set_title('Exits and Exit Bandwidth by Port', fontsize='12',
+                  fontweight=FONT_WEIGHT)
+    ax1.yaxis.set_major_locator(MaxNLocator(5))
+    ax2.yaxis.set_major_locator(MaxNLocator(5))
+
+    return print_png(fig)
+
+
+class DrawnGraph(object):
+    """
+    A graph that has already been drawn, in the calling thread.
+
+    @type data: C{string}
+    @ivar data: The PNG bytes of the graph.
+    """
+
+    def __init__(self, data):
+        """
+        @type data: C{string}
+        @param data: The PNG bytes of the graph.
+        """
+        self.data = data
+
+    def get(self):
+        """
+        @rtype: C{string}
+        @return: The PNG bytes of the graph.
+        """
+        return self.data
+
+
+class PendingGraph(object):
+    """
+    A graph that is being drawn by a process of a L{RenderPool}.
+    """
+
+    def __init__(self, result, timeout):
+        """
+        @type result: C{multiprocessing.pool.AsyncResult}
+        @param result: The result of the drawing function.
+        @type timeout: C{int} or C{float}
+        @param timeout: How long, in seconds, to wait for the graph.
+        """
+        self.__result = result
+        self.__timeout = timeout
+
+    def get(self):
+        """
+        Wait for the graph to be drawn.
+
+        @rtype: C{string}
+        @return: The PNG bytes of the graph.
+        @raise multiprocessing.TimeoutError: If the graph is not drawn
+            in time.
+        """
+        return self.__result.get(self.__timeout)
+
+
+class RenderPool(object):
+    """
+    Draws graphs in a pool of processes, which is started the first
+    time that a graph is submitted.
+
+    The pool belongs to the process that started it; a process forked
+    from that one starts a pool of its own.
+
+    @type processes: C{int}
+    @ivar processes: The number of processes that draw graphs, or 0 to
+        draw graphs in the calling thread.
+    @type timeout: C{int} or C{float}
+    @ivar timeout: How long, in seconds, to wait for a graph.
+    """
+
+    def __init__(self, processes, timeout):
+        """
+        @type processes: C{int}
+        @param processes: The number of processes that draw graphs, or
+            0 to draw graphs in the calling thread.
+        @type timeout: C{int} or C{float}
+        @param timeout: How long, in seconds, to wait for a graph.
+        """
+        self.processes = processes
+        self.timeout = timeout
+        self.__pool = None
+        self.__owner = None
+        self.__lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Have a graph drawn.
+
+        @type function: C{callable}
+        @param function: The drawing function, such as L{bar_graph}. It
+            must be defined at the top level of a module, and take and
+            return data that can be pickled.
+        @param args: The arguments to the drawing function.
+        @rtype: L{PendingGraph} or L{DrawnGraph}
+        @return: The graph, whose C{get()} returns its PNG bytes.
+        """
+        if not self.processes:
+            return DrawnGraph(function(*args))
+        result = self.__get_pool().apply_async(function, args)
+        return PendingGraph(result, self.timeout)
+
+    def close(self):
+        """
+        Stop the processes of the pool, once they have drawn the graphs
+        submitted so far. A later submission starts a new pool.
+        """
+        self.__lock.acquire()
+        try:
+            pool, self.__pool = self.__pool, None
+            if pool is not None and self.__owner == os.getpid():
+                pool.close()
+                pool.join()
+        finally:
+            self.__lock.release()
+
+    def __get_pool(self):
+        """
+        @rtype: C{multiprocessing.pool.Pool}
+        @return: The pool of this process, started if need be.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__pool is None or self.__owner != os.getpid():
+                self.__pool = multiprocessing.Pool(self.processes)
+                self.__owner = os.getpid()
+            return self.__pool
+        finally:
+            self.__lock.release()
+
+
+__pool = RenderPool(GRAPH_PROCESSES, GRAPH_TIMEOUT)
+
+
+def submit_graph(function, *args):
+    """
+    Have a graph drawn by the pool of rendering processes.
+
+    @type function: C{callable}
+    @param function: The drawing function, such as L{bar_graph}.
+    @param args: The arguments to the drawing function.
+    @rtype: L{PendingGraph} or L{DrawnGraph}
+    @return: The graph, whose C{get()} returns its PNG bytes.
+    """
+    return __pool.submit(function, *args)
+
+
+def set_graph_processes(processes):
+    """
+    Change the number of processes that draw the graphs of this
+    process, stopping the pool that drew them so far.
+
+    @type processes: C{int}
+    @param processes: The number of processes, or 0 to draw graphs in
+        the calling thread.
+    """
+    __pool.close()
+    __pool.processes = processes
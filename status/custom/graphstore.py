@@ -0,0 +1,188 @@
+"""
+A store of rendered network statistic graphs on disk.
+
+The network statistic graphs depend only on the most recent consensus,
+yet every process used to render each of them with matplotlib whenever
+its own cache_page entry had expired. Graphs are now rendered once per
+consensus, by the C{rendergraphs} management command after each run
+of update_relay_table(), and stored as PNG files named after the graph
+and the validafter of the consensus (see L{epoch_key}). The views
+serve the stored bytes, and only render a graph themselves if it has
+not been stored for the most recent consensus yet.
+
+Files are written under a temporary name and renamed into place, so a
+reader never sees a partly written graph.
+"""
+# General python import statements ------------------------------------
+import os
+import tempfile
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+
+# INIT Variables ------------------------------------------------------
+# The directory that rendered graphs are stored in.
+GRAPH_DIR = getattr(settings, 'GRAPH_DIR',
+                    os.path.join(tempfile.gettempdir(), 'torstatus-graphs'))
+
+# The suffix of stored graphs.
+GRAPH_SUFFIX = '.png'
+
+
+class GraphStore(object):
+    """
+    Rendered graphs, stored as files in a directory under the name of
+    the graph and the key of the consensus they were rendered from.
+
+    @type directory: C{string}
+    @ivar directory: The directory that the graphs are stored in.
+    """
+
+    def __init__(self, directory):
+        """
+        @type directory: C{string}
+        @param directory: The directory that the graphs are stored in.
+            It is created the first time a graph is stored.
+        """
+        self.directory = directory
+
+    def path(self, name, key):
+        """
+        Get the path of a stored graph.
+
+        @type name: C{string}
+        @param name: The name of the graph, such as C{'byplatform'}.
+        @type key: C{string}
+        @param key: The key of the consensus; see L{epoch_key}.
+        @rtype: C{string}
+        @return: The path of the file that holds the graph.
+        """
+        return os.path.join(self.directory,
+                            '%s-%s%s' % (name, key, GRAPH_SUFFIX))
+
+    def load(self, name, key):
+        """
+        Read a stored graph.
+
+        @type name: C{string}
+        @param name: The name of the graph.
+        @type key: C{string}
+        @param key: The key of the consensus.
+        @rtype: C{string}
+        @return: The PNG bytes of the graph, or None if it has not been
+            stored.
+        """
+        try:
+            graph = open(self.path(name, key), 'rb')
+        except IOError:
+            return None
+        try:
+            return graph.read()
+        finally:
+            graph.close()
+
+    def save(self, name, key, data):
+        """
+        Store a graph, replacing any graph stored under the same name
+        and key.
+
+        @type name: C{string}
+        @param name: The name of the graph.
+        @type key: C{string}
+        @param key: The key of the consensus.
+        @type data: C{string}
+        @param data: The PNG bytes of the graph.
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process may have made it meanwhile.
+                if not os.path.isdir(self.directory):
+                    raise
+
+        descriptor, temporary = tempfile.mkstemp(prefix='.%s-' % name,
+                                                 dir=self.directory)
+        try:
+            graph = os.fdopen(descriptor, 'wb')
+            try:
+                graph.write(data)
+            finally:
+                graph.close()
+            os.chmod(temporary, 0644)
+            os.rename(temporary, self.path(name, key))
+        except:
+            os.remove(temporary)
+            raise
+
+    def purge(self, key):
+        """
+        Remove the graphs stored for every consensus other than one.
+
+        @type key: C{string}
+        @param key: The key of the consensus whose graphs are kept.
+        @rtype: C{int}
+        @return: The number of graphs removed.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+
+        removed = 0
+        ending = '-%s%s' % (key, GRAPH_SUFFIX)
+        for filename in names:
+            if (filename.startswith('.') or
+                    not filename.endswith(GRAPH_SUFFIX) or
+                    filename.endswith(ending)):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, filename))
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+__store = GraphStore(GRAPH_DIR)
+
+
+def get_graph(name, key):
+    """
+    Get a graph stored for a consensus.
+
+    @type name: C{string}
+    @param name: The name of the graph.
+    @type key: C{string}
+    @param key: The key of the consensus.
+    @rtype: C{string}
+    @return: The PNG bytes of the graph, or None if it has not been
+        stored.
+    """
+    return __store.load(name, key)
+
+
+def set_graph(name, key, data):
+    """
+    Store a graph rendered from a consensus.
+
+    @type name: C{string}
+    @param name: The name of the graph.
+    @type key: C{string}
+    @param key: The key of the consensus.
+    @type data: C{string}
+    @param data: The PNG bytes of the graph.
+    """
+    __store.save(name, key, data)
+
+
+def purge_graphs(key):
+    """
+    Remove the graphs stored for every consensus but one.
+
+    @type key: C{string}
+    @param key: The key of the consensus whose graphs are kept.
+    @rtype: C{int}
+    @return: The number of graphs removed.
+    """
+    return __store.purge(key)
@@ -0,0 +1,89 @@
+"""
+Custom middleware for responses that are streamed to the client.
+
+Django's GZipMiddleware compresses a response by reading its whole
+content, which turns a response built from an iterator back into one
+big string before the client receives a single byte. L{GZipMiddleware}
+compresses such responses chunk by chunk instead.
+
+A view marks a response as streamed by setting its C{streaming}
+attribute to True.
+"""
+# General python import statements ------------------------------------
+import zlib
+
+# Django-specific import statements -----------------------------------
+from django.middleware.gzip import GZipMiddleware as DjangoGZipMiddleware
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+
+# INIT Variables ------------------------------------------------------
+# The compression level that Django's GZipMiddleware uses.
+COMPRESS_LEVEL = 6
+
+
+def gzip_chunks(chunks, charset):
+    """
+    Compress an iterable of chunks into the chunks of a gzip stream.
+
+    Every chunk is flushed as soon as it is compressed, so that the
+    client can start to decompress and display the response while the
+    rest of it is being produced.
+
+    @type chunks: iterable of C{string} or C{unicode}
+    @param chunks: The chunks of the uncompressed content.
+    @type charset: C{string}
+    @param charset: The charset to encode C{unicode} chunks in.
+    @rtype: generator of C{string}
+    @return: The chunks of the compressed content.
+    """
+    # A window size of 16 + MAX_WBITS makes zlib write a gzip header
+    # and trailer rather than a zlib header and trailer.
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(charset)
+        if chunk:
+            data = compressor.compress(chunk) + compressor.flush(
+                   zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+class GZipMiddleware(DjangoGZipMiddleware):
+    """
+    Compress responses as Django's GZipMiddleware does, except that
+    streamed responses are compressed as they are streamed.
+    """
+
+    def process_response(self, request, response):
+        if not getattr(response, 'streaming', False):
+            return super(GZipMiddleware, self).process_response(
+                   request, response)
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if (response.status_code != 200 or
+            response.has_header('Content-Encoding')):
+            return response
+
+        # MSIE have issues with gzipped responses of various content
+        # types.
+        if "msie" in request.META.get('HTTP_USER_AGENT', '').lower():
+            ctype = response.get('Content-Type', '').lower()
+            if not ctype.startswith("text/") or "javascript" in ctype:
+                return response
+
+        if not re_accepts_gzip.search(
+               request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return response
+
+        # Replace the iterator that the response was built from; reading
+        # response.content here would consume it.
+        response._container = gzip_chunks(response._container,
+                                          response._charset)
+        response['Content-Encoding'] = 'gzip'
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+        return response
@@ -0,0 +1,179 @@
+"""
+A cache of rendered pages that depend only on the most recent
+consensus and on a few inputs from the client.
+
+Pages are stored in Django's cache, gzipped, under a key made of the
+name of the page, the validafter of the consensus they were rendered
+from, and a hash of a canonical form of the inputs. Because the
+validafter is part of the key, a new consensus makes every stored page
+unreachable at once, and the stale entries simply expire.
+
+The key also serves as the ETag of a page, so a client that already
+has a page is answered with 304 Not Modified without the page being
+looked up at all.
+"""
+# General python import statements ------------------------------------
+import hashlib
+import zlib
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseRedirect, \
+        HttpResponseNotModified
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+# INIT Variables ------------------------------------------------------
+# How long, in seconds, a page is kept. A page can only be served while
+# its consensus is the most recent one, so this need only be a little
+# longer than the interval between consensuses.
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 90)
+
+# The kinds of entries in the page cache.
+PAGE = 'page'
+REDIRECT = 'redirect'
+
+
+def _canonical(value):
+    """
+    Convert a value to a form whose repr() does not depend on the order
+    of dictionary keys or on the difference between C{str} and
+    C{unicode}.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted([(_canonical(key), _canonical(item))
+                             for key, item in value.iteritems()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_canonical(item) for item in value])
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def page_key(name, validafter, inputs):
+    """
+    Get the cache key of a page.
+
+    @type name: C{string}
+    @param name: The name of the page, such as C{'index'}.
+    @type validafter: C{datetime}
+    @param validafter: The validafter of the consensus that the page is
+        rendered from.
+    @type inputs: C{object}
+    @param inputs: Everything else that the page depends on, made of
+        dictionaries, lists, tuples, strings, and numbers.
+    @rtype: C{string}
+    @return: The cache key of the page.
+    """
+    if validafter is None:
+        epoch = 'none'
+    else:
+        epoch = validafter.strftime('%Y%m%d%H%M%S')
+    digest = hashlib.sha1(repr(_canonical(inputs))).hexdigest()
+    return 'page:%s:%s:%s' % (name, epoch, digest)
+
+
+def page_etag(key):
+    """
+    Get the ETag of the page with a cache key.
+
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @rtype: C{string}
+    @return: The quoted ETag.
+    """
+    return '"%s"' % hashlib.sha1(key).hexdigest()
+
+
+def not_modified(request, key):
+    """
+    Get a 304 Not Modified response if the client already has the page
+    with a cache key.
+
+    @type request: HttpRequest
+    @param request: The request for the page.
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @rtype: HttpResponse
+    @return: A 304 Not Modified response, or None if the client does
+        not have the page.
+    """
+    etags = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if page_etag(key) in [etag.strip() for etag in etags.split(',')]:
+        return HttpResponseNotModified()
+    return None
+
+
+def get_page(request, key):
+    """
+    Get the stored response for a page.
+
+    @type request: HttpRequest
+    @param request: The request for the page.
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @rtype: HttpResponse
+    @return: The response, or None if the page is not stored.
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    kind, content = entry
+    if kind == REDIRECT:
+        return HttpResponseRedirect(content)
+    return _page_response(request, key, content)
+
+
+def set_page(request, key, html):
+    """
+    Store a rendered page and get the response for it.
+
+    @type request: HttpRequest
+    @param request: The request for the page.
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @type html: C{unicode}
+    @param html: The rendered page.
+    @rtype: HttpResponse
+    @return: The response for the page.
+    """
+    content = compress_string(html.encode(settings.DEFAULT_CHARSET))
+    cache.set(key, (PAGE, content), PAGE_CACHE_TIMEOUT)
+    return _page_response(request, key, content)
+
+
+def set_redirect(key, url):
+    """
+    Store a redirect in place of a page and get the response for it.
+
+    @type key: C{string}
+    @param key: The cache key of the page.
+    @type url: C{string}
+    @param url: The url to redirect to.
+    @rtype: HttpResponseRedirect
+    @return: The response for the redirect.
+    """
+    cache.set(key, (REDIRECT, url), PAGE_CACHE_TIMEOUT)
+    return HttpResponseRedirect(url)
+
+
+def _page_response(request, key, content):
+    """
+    Get the response for a stored page, sending the gzipped content as
+    it is to clients that accept gzip.
+    """
+    if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING',
+                                               '')):
+        response = HttpResponse(content)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        # A window size of 16 + MAX_WBITS makes zlib read a gzip
+        # header and trailer.
+        response = HttpResponse(zlib.decompress(content,
+                                                16 + zlib.MAX_WBITS))
+    response['Content-Length'] = str(len(response.content))
+    response['ETag'] = page_etag(key)
+    patch_vary_headers(response, ('Accept-Encoding', 'Cookie'))
+    return response
@@ -0,0 +1,190 @@
+"""
+Keyset pagination over a sorted list of relays in a
+L{ConsensusSnapshot}.
+
+Django's Paginator locates a page by counting relays from the start of
+the result set, so the relays on page n change whenever relays are
+added to or removed from earlier pages. A L{KeysetPaginator} can also
+locate a page by the relay just before or just after it, keyed on the
+(sort key, fingerprint) pair of that relay, so following the "next"
+and "previous" links never skips or repeats a relay, and every page
+costs one binary search however deep it is.
+
+The L{KeysetPage} objects it returns have the attributes of Django's
+Page objects that the templates use, so they can be passed to the
+templates in place of Django's Page objects.
+"""
+
+
+class KeysetPaginator(object):
+    """
+    Split a sorted list of relays into pages.
+
+    @type snapshot: L{ConsensusSnapshot}
+    @ivar snapshot: The snapshot that the relays belong to.
+    @type object_list: C{list} of C{int}
+    @ivar object_list: The positions of the relays, as sorted by
+        C{snapshot.order(object_list, order)}.
+    @type order: C{string}
+    @ivar order: The order that the relays are sorted in.
+    @type per_page: C{int}
+    @ivar per_page: The number of relays on each page.
+    @type count: C{int}
+    @ivar count: The number of relays.
+    @type num_pages: C{int}
+    @ivar num_pages: The number of pages, which is at least 1.
+    """
+
+    def __init__(self, snapshot, object_list, order, per_page):
+        """
+        Paginate relays that have already been sorted in an order.
+        """
+        self.snapshot = snapshot
+        self.object_list = object_list
+        self.order = order
+        self.per_page = max(int(per_page), 1)
+        self.count = len(object_list)
+        self.num_pages = max((self.count + self.per_page - 1) //
+                             self.per_page, 1)
+
+    def page(self, number):
+        """
+        Get a page by its number, delivering the last page if the
+        number is out of range.
+
+        @type number: C{int}
+        @param number: The number of the page, starting at 1.
+        @rtype: L{KeysetPage}
+        @return: The page.
+        """
+        number = min(max(number, 1), self.num_pages)
+        return self._page((number - 1) * self.per_page)
+
+    def page_after(self, fingerprint):
+        """
+        Get the page that starts just after a relay.
+
+        @type fingerprint: C{string}
+        @param fingerprint: The fingerprint of the last relay on the
+            previous page.
+        @rtype: L{KeysetPage}
+        @return: The page, or the first page if the relay is no longer
+            in the most recent consensus.
+        """
+        bounds = self.snapshot.seek(self.object_list, self.order,
+                                    fingerprint)
+        if bounds is None:
+            return self.page(1)
+        start = bounds[1]
+        if start >= self.count:
+            return self.page(self.num_pages)
+        return self._page(start)
+
+    def page_before(self, fingerprint):
+        """
+        Get the page that ends just before a relay.
+
+        @type fingerprint: C{string}
+        @param fingerprint: The fingerprint of the first relay on the
+            next page.
+        @rtype: L{KeysetPage}
+        @return: The page, or the first page if the relay is no longer
+            in the most recent consensus.
+        """
+        bounds = self.snapshot.seek(self.object_list, self.order,
+                                    fingerprint)
+        if bounds is None:
+            return self.page(1)
+        end = bounds[0]
+        if end <= self.per_page:
+            return self.page(1)
+        return self._page(end - self.per_page)
+
+    def _page(self, start):
+        """
+        Get the page that starts at an index into L{object_list}.
+        """
+        return KeysetPage(self, start,
+                          self.object_list[start:start + self.per_page])
+
+
+class KeysetPage(object):
+    """
+    A single page of relays.
+
+    @type paginator: L{KeysetPaginator}
+    @ivar paginator: The paginator that the page belongs to.
+    @type object_list: C{list}
+    @ivar object_list: The positions of the relays on the page.
+    @type number: C{int}
+    @ivar number: The number of the page. A page that does not start
+        at a multiple of C{per_page} is numbered as the page after the
+        one its first relay would be on, so that only the first page
+        is numbered 1.
+    @type first_key: C{string}
+    @ivar first_key: The fingerprint of the first relay on the page.
+    @type last_key: C{string}
+    @ivar last_key: The fingerprint of the last relay on the page.
+    """
+
+    def __init__(self, paginator, start, object_list):
+        """
+        Make the page that starts at an index into the relays of a
+        paginator.
+        """
+        self.paginator = paginator
+        self.object_list = object_list
+        self.start = start
+        self.number = ((start + paginator.per_page - 1) //
+                       paginator.per_page + 1)
+
+        fingerprints = paginator.snapshot.columns['fingerprint']
+        if object_list:
+            self.first_key = fingerprints[object_list[0]]
+            self.last_key = fingerprints[object_list[-1]]
+        else:
+            self.first_key = self.last_key = ''
+
+    def has_next(self):
+        """
+        Tell whether any relay follows the page.
+        """
+        return self.start + len(self.object_list) < self.paginator.count
+
+    def has_previous(self):
+        """
+        Tell whether any relay precedes the page.
+        """
+        return self.start > 0
+
+    def has_other_pages(self):
+        """
+        Tell whether the relays do not all fit on the page.
+        """
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        """
+        Get the number of the page after this one.
+        """
+        return self.number + 1
+
+    def previous_page_number(self):
+        """
+        Get the number of the page before this one.
+        """
+        return self.number - 1
+
+    def start_index(self):
+        """
+        Get the 1-based index of the first relay on the page.
+        """
+        if not self.object_list:
+            return 0
+        return self.start + 1
+
+    def end_index(self):
+        """
+        Get the 1-based index of the last relay on the page.
+        """
+        return self.start + len(self.object_list)
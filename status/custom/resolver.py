@@ -0,0 +1,394 @@
+"""
+Look up the hostnames of relay addresses in the background.
+
+The details page used to call C{socket.getfqdn} on every request, which
+blocks the worker for as long as a slow PTR lookup takes, and the index
+page could not show or sort by hostname at all. A L{HostnameResolver}
+instead keeps the hostname of each address in memory and looks up
+missing and expired hostnames with a small pool of worker threads, so
+no request ever waits for DNS.
+
+Hostnames are kept for C{settings.HOSTNAME_TTL} seconds, and failed
+lookups are remembered for C{settings.HOSTNAME_NEGATIVE_TTL} seconds
+before they are tried again. Every result is also stored in the
+cache.hostname table, so that hostnames survive restarts and are shared
+between processes.
+
+Whenever a new consensus snapshot is built, it gets the hostnames of
+its relays from L{load_hostnames}, which also queues a lookup for
+every address that is missing or expired, so the whole network is
+looked up, and kept fresh, without any request asking for it.
+"""
+# General python import statements ------------------------------------
+import datetime
+import socket
+import threading
+import time
+import Queue
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+from django.db import transaction, DatabaseError
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import Hostname
+
+# INIT Variables ------------------------------------------------------
+# How long, in seconds, a hostname is kept before it is looked up
+# again.
+HOSTNAME_TTL = getattr(settings, 'HOSTNAME_TTL', 60 * 60 * 24)
+
+# How long, in seconds, a failed lookup is remembered before it is
+# tried again.
+HOSTNAME_NEGATIVE_TTL = getattr(settings, 'HOSTNAME_NEGATIVE_TTL',
+                                60 * 60)
+
+# The number of threads that look up hostnames in each process. With
+# no threads, hostnames are only read from the cache.hostname table.
+HOSTNAME_WORKERS = getattr(settings, 'HOSTNAME_WORKERS', 4)
+
+# The number of addresses that are remembered as missing from the
+# cache.hostname table; when the limit is reached, they are forgotten.
+MAX_MISSES = 1 << 14
+
+
+def reverse_lookup(address):
+    """
+    Look up the hostname of an IP address.
+
+    @type address: C{string}
+    @param address: The IP address.
+    @rtype: C{string}
+    @return: The hostname of the address.
+    @raise socket.error: If the address has no hostname, or if the
+        lookup fails.
+    """
+    return socket.gethostbyaddr(address)[0]
+
+
+class HostnameResolver(object):
+    """
+    A cache of the hostnames of IP addresses that is filled by a pool
+    of threads.
+
+    @type lookup: C{callable}
+    @ivar lookup: A function mapping an address to its hostname that
+        raises C{socket.error} if the address has none.
+    @type ttl: C{int} or C{float}
+    @ivar ttl: How long, in seconds, a hostname is kept.
+    @type negative_ttl: C{int} or C{float}
+    @ivar negative_ttl: How long, in seconds, a failed lookup is kept.
+    @type workers: C{int}
+    @ivar workers: The number of threads that look up hostnames.
+    @type store: C{callable}
+    @ivar store: A function that is called with the address, the
+        hostname (or None), and the expiry time as a C{datetime} after
+        every lookup, or None.
+    @type fetch: C{callable}
+    @ivar fetch: A function mapping an address to the (address,
+        hostname, expires) triples kept elsewhere for it, as taken by
+        L{load}, or None.
+    """
+
+    def __init__(self, lookup, ttl, negative_ttl, workers, store=None,
+                 fetch=None):
+        """
+        @type lookup: C{callable}
+        @param lookup: A function mapping an address to its hostname
+            that raises C{socket.error} if the address has none.
+        @type ttl: C{int} or C{float}
+        @param ttl: How long, in seconds, a hostname is kept.
+        @type negative_ttl: C{int} or C{float}
+        @param negative_ttl: How long, in seconds, a failed lookup is
+            kept.
+        @type workers: C{int}
+        @param workers: The number of threads that look up hostnames.
+        @type store: C{callable}
+        @param store: A function that is called after every lookup, as
+            described above, or None.
+        @type fetch: C{callable}
+        @param fetch: A function that finds the hostname of an address
+            kept elsewhere, as described above, or None.
+        """
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.store = store
+        self.fetch = fetch
+
+        # Each address maps to a (hostname, expires) pair, where
+        # expires is in seconds since the epoch.
+        self._entries = {}
+
+        # Each address that fetch() did not know maps to the time, in
+        # seconds since the epoch, until which it is not asked again.
+        self._misses = {}
+        self._pending = set()
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def hostname(self, address):
+        """
+        Get the hostname of an address without waiting for a lookup.
+
+        If the hostname is unknown or has expired, a lookup is queued,
+        and an expired hostname is returned until the lookup finishes.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @rtype: C{string}
+        @return: The hostname of the address, or None if it is not
+            known or the address has none.
+        """
+        entry = self._entries.get(address)
+        if entry is None or entry[1] <= time.time():
+            self.refresh([address])
+        if entry is None:
+            return None
+        return entry[0]
+
+    def get(self, address):
+        """
+        Get the hostname of an address without waiting for a lookup,
+        fetching it from elsewhere if it is not known in memory.
+
+        An address that L{fetch} does not know either is not fetched
+        again for L{negative_ttl} seconds, so that repeated requests
+        for it do not each ask.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @rtype: C{string}
+        @return: The hostname of the address, or None if it is not
+            known or the address has none.
+        """
+        if self.fetch is not None and not self.known(address):
+            now = time.time()
+            if self._misses.get(address, 0) <= now:
+                self.load(self.fetch(address))
+                if not self.known(address):
+                    if len(self._misses) >= MAX_MISSES:
+                        self._misses.clear()
+                    self._misses[address] = now + self.negative_ttl
+        return self.hostname(address)
+
+    def hostnames(self, addresses):
+        """
+        Get the hostnames of a list of addresses that are known, even
+        if they have expired, without queueing any lookups.
+
+        @type addresses: iterable of C{string}
+        @param addresses: The IP addresses.
+        @rtype: C{dict}
+        @return: The hostname of each address that has one, keyed by
+            address.
+        """
+        entries = self._entries
+        hostnames = {}
+        for address in addresses:
+            entry = entries.get(address)
+            if entry is not None and entry[0] is not None:
+                hostnames[address] = entry[0]
+        return hostnames
+
+    def known(self, address):
+        """
+        Check whether the hostname of an address, or the failure to
+        find one, is known and has not expired.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @rtype: C{bool}
+        @return: True if the address does not need to be looked up.
+        """
+        entry = self._entries.get(address)
+        return entry is not None and entry[1] > time.time()
+
+    def load(self, entries):
+        """
+        Add hostnames that were looked up elsewhere, such as by another
+        process.
+
+        @type entries: iterable of C{tuple}
+        @param entries: (address, hostname, expires) triples, where
+            hostname may be None and expires is a C{datetime}.
+        """
+        for address, hostname, expires in entries:
+            expires = time.mktime(expires.timetuple())
+            current = self._entries.get(address)
+            if current is None or current[1] < expires:
+                self._entries[address] = (hostname, expires)
+
+    def refresh(self, addresses):
+        """
+        Queue a lookup for each address whose hostname is unknown or
+        has expired, unless a lookup is already queued.
+
+        @type addresses: iterable of C{string}
+        @param addresses: The IP addresses.
+        @rtype: C{int}
+        @return: The number of lookups queued.
+        """
+        if not self.workers:
+            return 0
+
+        queued = 0
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if not self._threads:
+                self._start()
+            for address in addresses:
+                entry = self._entries.get(address)
+                if entry is not None and entry[1] > now:
+                    continue
+                if address in self._pending:
+                    continue
+                self._pending.add(address)
+                self._queue.put(address)
+                queued += 1
+        finally:
+            self._lock.release()
+        return queued
+
+    def wait(self):
+        """
+        Wait until every queued lookup has finished.
+        """
+        self._queue.join()
+
+    def _start(self):
+        """
+        Start the threads that look up hostnames.
+        """
+        for number in xrange(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='resolver-%d' % number)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """
+        Look up queued addresses, one at a time, forever.
+        """
+        while True:
+            address = self._queue.get()
+            try:
+                self._resolve(address)
+            finally:
+                self._lock.acquire()
+                try:
+                    self._pending.discard(address)
+                finally:
+                    self._lock.release()
+                self._queue.task_done()
+
+    def _resolve(self, address):
+        """
+        Look up the hostname of an address and remember the result,
+        or the failure, until it expires.
+        """
+        try:
+            hostname = self.lookup(address)
+            expires = time.time() + self.ttl
+        except socket.error:
+            hostname = None
+            expires = time.time() + self.negative_ttl
+
+        self._entries[address] = (hostname, expires)
+        if self.store is not None:
+            try:
+                self.store(address, hostname,
+                           datetime.datetime.fromtimestamp(expires))
+            except Exception:
+                # The hostname is still kept in memory; the table is
+                # only a cache, so a failure to write it is not fatal.
+                pass
+
+
+def _store_hostname(address, hostname, expires):
+    """
+    Store the result of a lookup in the cache.hostname table.
+
+    Lookups run on threads of their own, where nothing else ends the
+    transaction, so it is committed here. Another process may store
+    the same address meanwhile; the failed write is rolled back to a
+    savepoint before it raises.
+    """
+    savepoint = transaction.savepoint()
+    try:
+        Hostname(address=address, hostname=hostname,
+                 expires=expires).save()
+    except DatabaseError:
+        transaction.savepoint_rollback(savepoint)
+        raise
+    else:
+        transaction.savepoint_commit(savepoint)
+    finally:
+        transaction.commit_unless_managed()
+
+
+def _fetch_hostname(address):
+    """
+    Read the result of a lookup from the cache.hostname table.
+    """
+    return Hostname.objects.filter(address=address).values_list(
+            'address', 'hostname', 'expires')
+
+
+__resolver = HostnameResolver(reverse_lookup, HOSTNAME_TTL,
+                              HOSTNAME_NEGATIVE_TTL, HOSTNAME_WORKERS,
+                              store=_store_hostname,
+                              fetch=_fetch_hostname)
+
+
+def load_hostnames(addresses):
+    """
+    Read the hostnames of a list of addresses from the cache.hostname
+    table, and queue lookups for those that are missing or expired.
+
+    @type addresses: C{list} of C{string}
+    @param addresses: The IP addresses.
+    @rtype: C{dict}
+    @return: The hostname of each address whose hostname is known,
+        even if it has expired, keyed by address.
+    """
+    __resolver.load(Hostname.objects.values_list('address', 'hostname',
+                                                 'expires').iterator())
+    __resolver.refresh(addresses)
+    return __resolver.hostnames(addresses)
+
+
+def refresh_hostnames(addresses):
+    """
+    Queue lookups for the addresses whose hostnames are missing or
+    expired.
+
+    @type addresses: iterable of C{string}
+    @param addresses: The IP addresses.
+    @rtype: C{int}
+    @return: The number of lookups queued.
+    """
+    return __resolver.refresh(addresses)
+
+
+def get_hostname(address):
+    """
+    Get the hostname of an address without waiting for DNS.
+
+    The hostname is taken from memory or, failing that, from the
+    cache.hostname table, which is not read again for an address that
+    it lacks for C{settings.HOSTNAME_NEGATIVE_TTL} seconds. If the
+    hostname is missing or expired, a lookup is queued in the
+    background.
+
+    @type address: C{string}
+    @param address: The IP address.
+    @rtype: C{string}
+    @return: The hostname, or None if it is not known or the address
+        has none.
+    """
+    return __resolver.get(address)
@@ -0,0 +1,1212 @@
+"""
+An in-process, column-oriented snapshot of the cache.active_relay table.
+
+The active_relay table only changes once per consensus, yet the index
+page, the csv export and the network statistic graphs used to fetch and
+instantiate thousands of L{ActiveRelay} objects on every request. A
+L{ConsensusSnapshot} holds the table as one column per field, with the
+flags of each relay packed into a single integer, so that these views
+can filter, sort and count relays in memory.
+
+A snapshot is built once per consensus. When the validafter of the most
+recent consensus changes, a new snapshot is built and then swapped in
+for the old one with a single assignment; requests that are still
+holding the old snapshot finish with it undisturbed.
+"""
+# General python import statements ------------------------------------
+import bisect
+import calendar
+import datetime
+import threading
+from array import array
+
+# NumPy-specific import statements ------------------------------------
+import numpy
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import ActiveRelay
+from custom.epoch import get_validafter
+from custom.resolver import load_hostnames
+from custom.exitpolicy import ExitIndex, load_policies, load_summaries, \
+        MAX_PORT
+from custom.addresses import address_to_int, parse_address, \
+        parse_network, AddressArray
+
+# INIT Variables ------------------------------------------------------
+# The flags of a relay, in the order of their bits in the packed
+# flags column.
+FLAG_FIELDS = ('isauthority', 'isbadexit', 'isbaddirectory', 'isexit',
+               'isfast', 'isguard', 'ishsdir', 'ishibernating',
+               'isnamed', 'isstable', 'isrunning', 'isunnamed',
+               'isvalid', 'isv2dir', 'isv3dir')
+
+FLAG_BITS = dict([(flag, 1 << bit) for bit, flag in
+                  enumerate(FLAG_FIELDS)])
+
+# Fields that are stored in integer arrays. None of these fields can
+# be negative, so NULL values are stored as NULL_INTEGER.
+INTEGER_FIELDS = ('orport', 'dirport', 'bandwidthavg',
+                  'bandwidthburst', 'bandwidthobserved',
+                  'bandwidthkbps', 'uptime', 'uptimedays')
+
+NULL_INTEGER = -1
+
+# Fields that are stored in lists of python objects.
+OBJECT_FIELDS = ('validafter', 'nickname', 'fingerprint', 'address',
+                 'descriptor', 'published', 'platform', 'contact',
+                 'family', 'country', 'latitude', 'longitude')
+
+TEXT_FIELDS = set(('nickname', 'fingerprint', 'address', 'descriptor',
+                   'platform', 'contact', 'family', 'country',
+                   'hostname'))
+
+# The order of the fields in the rows that a snapshot is built from.
+SNAPSHOT_FIELDS = OBJECT_FIELDS + INTEGER_FIELDS + FLAG_FIELDS
+
+# Formats accepted when comparing a search term to a timestamp, the
+# same formats that django's DateTimeField accepts.
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+# The tests behind each search criterion in helpers.CRITERIA. Each test
+# takes a value from the snapshot and the (coerced) search term.
+LOOKUP_TESTS = {
+        'exact': lambda value, term: value == term,
+        'iexact': lambda value, term: value.lower() == term.lower(),
+        'contains': lambda value, term: term in value,
+        'icontains': lambda value, term: term.lower() in value.lower(),
+        'startswith': lambda value, term: value.startswith(term),
+        'istartswith': lambda value, term:
+                value.lower().startswith(term.lower()),
+        'lt': lambda value, term: value < term,
+        'gt': lambda value, term: value > term,
+        }
+
+TEXT_LOOKUPS = set(('iexact', 'contains', 'icontains', 'startswith',
+                    'istartswith'))
+
+# The same tests as LOOKUP_TESTS, evaluated over whole columns at once
+# by L{FilterMasks}. Text columns are NumPy unicode arrays, lower-cased
+# in advance for the lookups that ignore case, and the search term is
+# lower-cased to match.
+MASK_TESTS = {
+        'exact': lambda values, term: values == term,
+        'iexact': lambda values, term: values == term,
+        'contains': lambda values, term:
+                numpy.char.find(values, term) >= 0,
+        'icontains': lambda values, term:
+                numpy.char.find(values, term) >= 0,
+        'startswith': lambda values, term:
+                numpy.char.startswith(values, term),
+        'istartswith': lambda values, term:
+                numpy.char.startswith(values, term),
+        'lt': lambda values, term: values < term,
+        'gt': lambda values, term: values > term,
+        }
+
+CASELESS_LOOKUPS = set(('iexact', 'icontains', 'istartswith'))
+
+# Fields whose values are timestamps, compared as seconds since the
+# epoch by L{FilterMasks}.
+DATETIME_FIELDS = set(('validafter', 'published'))
+
+# The number of result sets that a snapshot keeps; see results(). When
+# the limit is reached, the kept result sets are discarded.
+MAX_RESULT_SETS = 256
+
+__snapshot = None
+__build_lock = threading.Lock()
+
+
+class SnapshotRelay(object):
+    """
+    A read-only view of a single relay in a L{ConsensusSnapshot}.
+
+    The attributes of a L{SnapshotRelay} have the same names as the
+    fields of L{ActiveRelay}, so a L{SnapshotRelay} can be handed to
+    code that was written for L{ActiveRelay} objects.
+    """
+    __slots__ = ('_snapshot', '_position')
+
+    def __init__(self, snapshot, position):
+        self._snapshot = snapshot
+        self._position = position
+
+    def __getattr__(self, name):
+        try:
+            return self._snapshot.value(name, self._position)
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ConsensusSnapshot(object):
+    """
+    The rows of the cache.active_relay table, stored column by column.
+
+    Relays are referred to by their position in the snapshot. Every
+    method that takes or returns a list of relays works with lists of
+    positions.
+
+    @type validafter: C{datetime}
+    @ivar validafter: The validafter of the most recent consensus when
+        the snapshot was built.
+    @type size: C{int}
+    @ivar size: The number of relays in the snapshot.
+    @type latest: C{list} of C{int}
+    @ivar latest: The positions of the relays that are in the most
+        recent consensus, in the order that they were loaded.
+    @type flags: C{array} of C{long}
+    @ivar flags: The flags of each relay, packed as in L{FLAG_BITS}.
+    @type positions: C{dict}
+    @ivar positions: The position of each relay, keyed by fingerprint.
+    @type latest_positions: C{dict}
+    @ivar latest_positions: The position of each relay in the most
+        recent consensus, keyed by fingerprint.
+    @type policies: C{list} of L{CompiledPolicy}
+    @ivar policies: The compiled exit policy of each relay, or None.
+    @type summaries: C{list} of L{PortSummary}
+    @ivar summaries: The port summary of the exit policy of each relay,
+        or None.
+    """
+
+    def __init__(self, validafter, rows):
+        """
+        Build a snapshot from rows of values.
+
+        @type validafter: C{datetime}
+        @param validafter: The validafter of the most recent consensus.
+        @type rows: iterable of C{tuple}
+        @param rows: The rows of the active_relay table, with values in
+            the order of L{SNAPSHOT_FIELDS}.
+        """
+        self.validafter = validafter
+        self.columns = {}
+        for field in OBJECT_FIELDS:
+            self.columns[field] = []
+        for field in INTEGER_FIELDS:
+            self.columns[field] = array('l')
+        self.flags = array('L')
+
+        object_positions = [(SNAPSHOT_FIELDS.index(field),
+                             self.columns[field].append)
+                            for field in OBJECT_FIELDS]
+        integer_positions = [(SNAPSHOT_FIELDS.index(field),
+                              self.columns[field].append)
+                             for field in INTEGER_FIELDS]
+        flag_positions = [(SNAPSHOT_FIELDS.index(field), FLAG_BITS[field])
+                          for field in FLAG_FIELDS]
+
+        for row in rows:
+            for index, append in object_positions:
+                append(row[index])
+            for index, append in integer_positions:
+                value = row[index]
+                if value is None:
+                    value = NULL_INTEGER
+                append(value)
+
+            packed = 0
+            for index, bit in flag_positions:
+                if row[index]:
+                    packed |= bit
+            self.flags.append(packed)
+
+        self.size = len(self.flags)
+
+        # Hostnames are not in the active_relay table; they are looked
+        # up in the background by custom/resolver.py and added with
+        # set_hostnames().
+        self.columns['hostname'] = [None] * self.size
+
+        validafters = self.columns['validafter']
+        self.latest = [position for position in xrange(self.size)
+                       if validafters[position] == validafter]
+
+        fingerprints = self.columns['fingerprint']
+        self.positions = dict(zip(fingerprints, xrange(self.size)))
+        self.latest_positions = dict([(fingerprints[position], position)
+                                      for position in self.latest])
+
+        # The rank of every relay in each sort order that has been
+        # requested, computed once per order; see ranks().
+        self._ranks = {}
+
+        # The NumPy masks that advanced searches are evaluated with,
+        # built the first time they are needed; see filter().
+        self._masks = None
+
+        # The sorted prefix index of basic searches, built the first
+        # time it is needed; see search().
+        self._prefix_keys = None
+        self._prefix_positions = None
+        self._latest_set = frozenset(self.latest)
+
+        # The ordered results of each search, filter, and order that
+        # has been requested; see results().
+        self._results = {}
+        self._results_lock = threading.Lock()
+
+        # The relays that the family lines of descriptors can name,
+        # built the first time they are needed; see family().
+        self._family_fingerprints = None
+        self._family_nicknames = None
+
+        # The compiled exit policy of each relay, added with
+        # set_policies(), and the index of the policies of the running
+        # relays in the most recent consensus, built the first time it
+        # is needed; see exits().
+        self.policies = [None] * self.size
+        self._exit_index = None
+
+        # The port summary of each relay, added with set_summaries().
+        self.summaries = [None] * self.size
+
+        # The exit lists that have been asked for; see exit_list().
+        self._exit_lists = {}
+
+        # The exits and exit bandwidth of every port, built the first
+        # time they are needed; see port_coverage().
+        self._port_coverage = None
+
+        # The positions of the relays on each address, with addresses
+        # as integers, built the first time they are needed; see
+        # relays_at().
+        self._address_positions = None
+
+        # The addresses of the relays as integers, built the first
+        # time a search names a network; see search().
+        self._address_array = None
+
+    def set_hostnames(self, hostnames):
+        """
+        Fill the C{hostname} column. This must be done before the
+        snapshot is shared, since hostnames are sorted and filtered
+        like any other column.
+
+        @type hostnames: C{dict}
+        @param hostnames: The hostname of each address that has one,
+            keyed by address.
+        """
+        self.columns['hostname'] = [hostnames.get(address) for address
+                                    in self.columns['address']]
+
+    def set_policies(self, policies):
+        """
+        Add the compiled exit policies of the relays. This must be done
+        before the snapshot is shared.
+
+        @type policies: C{dict}
+        @param policies: The L{CompiledPolicy} of each relay that has
+            one, keyed by fingerprint.
+        """
+        self.policies = [policies.get(fingerprint) for fingerprint
+                         in self.columns['fingerprint']]
+
+    def set_summaries(self, summaries):
+        """
+        Add the port summaries of the exit policies of the relays. This
+        must be done before the snapshot is shared.
+
+        @type summaries: C{dict}
+        @param summaries: The L{PortSummary} of each descriptor that
+            has one, keyed by the digest of the descriptor.
+        """
+        self.summaries = [summaries.get(descriptor) for descriptor
+                          in self.columns['descriptor']]
+
+    def exits(self, address, port):
+        """
+        Find the running relays in the most recent consensus whose exit
+        policies accept a destination.
+
+        The policies are indexed the first time this is asked, once
+        per snapshot; see L{ExitIndex}.
+
+        @type address: C{int}
+        @param address: The destination address, as an integer.
+        @type port: C{int}
+        @param port: The destination port.
+        @rtype: C{list} of C{int}
+        @return: The positions of the relays, in ascending order.
+        """
+        if self._exit_index is None:
+            self._build_exit_index()
+        return self._exit_index.exits(address, port)
+
+    def exit_list(self, address, port):
+        """
+        Get the addresses of the running relays in the most recent
+        consensus whose exit policies accept a destination.
+
+        Exit lists are kept for the life of the snapshot under the
+        L{ExitIndex.cell} of their destination, so every destination
+        that all policies treat alike, such as any ordinary web server
+        on port 443, shares one list, computed once per consensus.
+
+        @type address: C{int}
+        @param address: The destination address, as an integer.
+        @type port: C{int}
+        @param port: The destination port.
+        @rtype: C{dict}
+        @return: The address of each relay as text, keyed by the
+            address as an integer. The dictionary is shared and must
+            not be changed.
+        """
+        if self._exit_index is None:
+            self._build_exit_index()
+        key = self._exit_index.cell(address, port)
+        exit_list = self._exit_lists.get(key)
+        if exit_list is not None:
+            return exit_list
+
+        addresses = self.columns['address']
+        exit_list = {}
+        for position in self._exit_index.exits(address, port):
+            text = addresses[position]
+            try:
+                exit_list[address_to_int(text)] = text
+            except (AttributeError, ValueError):
+                continue
+
+        self._results_lock.acquire()
+        try:
+            if len(self._exit_lists) >= MAX_RESULT_SETS:
+                self._exit_lists.clear()
+            self._exit_lists[key] = exit_list
+        finally:
+            self._results_lock.release()
+        return exit_list
+
+    def _build_exit_index(self):
+        """
+        Build the index of L{exits} from the policies of the running
+        relays in the most recent consensus.
+        """
+        running = FLAG_BITS['isrunning']
+        flags = self.flags
+        policies = self.policies
+        self._exit_index = ExitIndex([(position, policies[position])
+                                      for position in self.latest
+                                      if flags[position] & running
+                                      and policies[position]
+                                      is not None])
+
+    def port_coverage(self):
+        """
+        Count the running relays in the most recent consensus whose
+        port summaries allow exits to each port, and add up their
+        observed bandwidth.
+
+        The summaries tell which ports a relay accepts to most
+        destinations, so the counts are those for a generic public
+        destination. Each distinct summary adds its count and
+        bandwidth to the first port of each of its ranges and takes
+        them away after the last, and a cumulative sum over all ports
+        then gives the totals, once per snapshot.
+
+        @rtype: C{tuple}
+        @return: Two NumPy arrays with an entry for each port from 0 to
+            L{MAX_PORT}: the number of relays, and their total observed
+            bandwidth in bytes per second. The arrays are shared and
+            must not be changed.
+        """
+        if self._port_coverage is None:
+            self._port_coverage = self._build_port_coverage()
+        return self._port_coverage
+
+    def _build_port_coverage(self):
+        """
+        Build the arrays of L{port_coverage}.
+        """
+        running = FLAG_BITS['isrunning']
+        flags = self.flags
+        summaries = self.summaries
+        bandwidths = self.columns['bandwidthobserved']
+
+        totals = {}
+        for position in self.latest:
+            summary = summaries[position]
+            if summary is None or not flags[position] & running:
+                continue
+            count, bandwidth = totals.get(summary, (0, 0))
+            totals[summary] = (count + 1,
+                               bandwidth + max(bandwidths[position], 0))
+
+        firsts = []
+        ends = []
+        counts = []
+        weights = []
+        for summary, (count, bandwidth) in totals.iteritems():
+            for first, last in summary.accepted():
+                firsts.append(first)
+                ends.append(last + 1)
+                counts.append(count)
+                weights.append(bandwidth)
+
+        coverage = []
+        for values in (counts, weights):
+            steps = numpy.zeros(MAX_PORT + 2, dtype=numpy.int64)
+            values = numpy.array(values, dtype=numpy.int64)
+            numpy.add.at(steps, numpy.array(firsts, dtype=int), values)
+            numpy.add.at(steps, numpy.array(ends, dtype=int), -values)
+            coverage.append(numpy.cumsum(steps)[:MAX_PORT + 1])
+        return tuple(coverage)
+
+    def relays_at(self, address):
+        """
+        Find the relays on an IPv4 address.
+
+        Every relay in the snapshot is found, not only those in the
+        most recent consensus. The addresses of the snapshot are
+        indexed the first time this is asked, so each lookup after
+        that is a single dictionary lookup.
+
+        @type address: C{int}
+        @param address: The address, as an integer; see
+            L{address_to_int}.
+        @rtype: C{list} of C{int}
+        @return: The positions of the relays, in ascending order.
+        """
+        if self._address_positions is None:
+            addresses = {}
+            for position, text in enumerate(self.columns['address']):
+                try:
+                    key = address_to_int(text)
+                except (AttributeError, ValueError):
+                    continue
+                addresses.setdefault(key, []).append(position)
+            self._address_positions = addresses
+        return self._address_positions.get(address, [])
+
+    def value(self, field, position):
+        """
+        Get the value of a field for a single relay.
+
+        @type field: C{string}
+        @param field: The name of the field, as in L{ActiveRelay}.
+        @type position: C{int}
+        @param position: The position of the relay.
+        @rtype: C{object}
+        @return: The value of the field, with NULL values as None and
+            flags as booleans.
+        @raise KeyError: If the snapshot does not hold the field.
+        """
+        if field in FLAG_BITS:
+            return bool(self.flags[position] & FLAG_BITS[field])
+
+        value = self.columns[field][position]
+        if value == NULL_INTEGER and field in INTEGER_FIELDS:
+            return None
+        return value
+
+    def values(self, field, positions):
+        """
+        Get the values of a field for a list of relays.
+
+        @type field: C{string}
+        @param field: The name of the field, as in L{ActiveRelay}.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays.
+        @rtype: C{list}
+        @return: The value of the field for each relay, as
+            L{value} would return it.
+        @raise KeyError: If the snapshot does not hold the field.
+        """
+        # Read the whole column at once, rather than through value(),
+        # since this is how the rows of the index page are projected.
+        if field in FLAG_BITS:
+            bit = FLAG_BITS[field]
+            flags = self.flags
+            return [bool(flags[position] & bit)
+                    for position in positions]
+
+        column = self.columns[field]
+        values = [column[position] for position in positions]
+        if field in INTEGER_FIELDS:
+            return [None if value == NULL_INTEGER else value
+                    for value in values]
+        return values
+
+    def relays(self, positions):
+        """
+        Get a L{SnapshotRelay} for each of a list of relays.
+
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays.
+        @rtype: C{list} of L{SnapshotRelay}
+        @return: A view of each relay.
+        """
+        return [SnapshotRelay(self, position) for position in positions]
+
+    def count(self, flag, positions):
+        """
+        Count the relays in a list of relays that have a given flag.
+
+        @type flag: C{string}
+        @param flag: The name of the flag, such as C{'isexit'}.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays.
+        @rtype: C{int}
+        @return: The number of relays that have the flag.
+        """
+        bit = FLAG_BITS[flag]
+        flags = self.flags
+        return len([position for position in positions
+                    if flags[position] & bit])
+
+    def search(self, term, positions):
+        """
+        Find the relays whose nickname, fingerprint, or IP address
+        starts with a search term, ignoring case, or whose address is
+        in the network that the term names, such as C{10.0.0.0/8}.
+
+        Matches are looked up in a sorted index of the lower-cased
+        nicknames, fingerprints, and addresses of all relays, so a
+        search costs a binary search plus the number of matches rather
+        than a pass over every relay. A network is matched against
+        every address at once; see L{Network.members}.
+
+        @type term: C{string}
+        @param term: The search term supplied by the client.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays to search.
+        @rtype: C{list} of C{int}
+        @return: The positions of the matching relays, in ascending
+            order.
+        """
+        if '/' in term:
+            try:
+                network = parse_network(term)
+            except ValueError:
+                network = None
+            if network is not None:
+                if self._address_array is None:
+                    self._address_array = AddressArray(
+                            self.columns['address'])
+                matches = numpy.flatnonzero(
+                        network.members(self._address_array)).tolist()
+                return self._members(matches, positions)
+
+        if self._prefix_keys is None:
+            self._build_prefix_index()
+        keys = self._prefix_keys
+        key_positions = self._prefix_positions
+
+        term = term.lower()
+        matches = set()
+        index = bisect.bisect_left(keys, term)
+        while index < len(keys) and keys[index].startswith(term):
+            matches.add(key_positions[index])
+            index += 1
+        return self._members(matches, positions)
+
+    def _members(self, matches, positions):
+        """
+        Keep those of a set of matching relays that are among the
+        relays searched.
+
+        @type matches: iterable of C{int}
+        @param matches: The positions of the matching relays.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays searched.
+        @rtype: C{list} of C{int}
+        @return: The positions that are in both, in ascending order.
+        """
+
+        if positions is self.latest:
+            members = self._latest_set
+        else:
+            members = set(positions)
+        return sorted([position for position in matches
+                       if position in members])
+
+    def _build_prefix_index(self):
+        """
+        Build the sorted prefix index of L{search}: one key for each
+        nickname, fingerprint, and address, and the position of the
+        relay that each key belongs to.
+        """
+        entries = []
+        for field in ('nickname', 'fingerprint', 'address'):
+            column = self.columns[field]
+            entries.extend([((column[position] or u'').lower(), position)
+                            for position in xrange(self.size)])
+        entries.sort()
+        self._prefix_positions = array('l', [position for key, position
+                                             in entries])
+        self._prefix_keys = [key for key, position in entries]
+
+    def family(self, entries):
+        """
+        Find the relays named by the entries of the family line of a
+        descriptor.
+
+        An entry is either a fingerprint preceded by a '$' or a
+        nickname. A fingerprint names the relay with that fingerprint,
+        and a nickname names the relay with that exact nickname if no
+        other relay has it. Every relay in the snapshot can be named,
+        not only those in the most recent consensus.
+
+        The fingerprints and nicknames of the snapshot are indexed the
+        first time a family is resolved, so each entry costs a single
+        dictionary lookup.
+
+        @type entries: C{list} of C{string}
+        @param entries: The entries of the family line.
+        @rtype: C{list} of C{tuple}
+        @return: An (entry, fingerprint, nickname) triple for each
+            entry, where the fingerprint and nickname are those of the
+            named relay, or None if no single relay is named.
+        """
+        if self._family_fingerprints is None:
+            self._build_family_index()
+        fingerprints = self._family_fingerprints
+        nicknames = self._family_nicknames
+
+        family = []
+        for entry in entries:
+            fingerprint = nickname = None
+            if entry.startswith('$') and len(entry) == 41:
+                fingerprint = entry[1:].lower()
+                nickname = fingerprints.get(fingerprint)
+                if nickname is None:
+                    fingerprint = None
+            else:
+                fingerprint = nicknames.get(entry)
+                if fingerprint is not None:
+                    nickname = entry
+            family.append((entry, fingerprint, nickname))
+        return family
+
+    def _build_family_index(self):
+        """
+        Build the indexes of L{family}: the nickname of each
+        fingerprint, and the fingerprint of each nickname that belongs
+        to a single relay.
+        """
+        fingerprints = dict(zip(self.columns['fingerprint'],
+                                self.columns['nickname']))
+        nicknames = {}
+        for fingerprint, nickname in fingerprints.iteritems():
+            if nickname in nicknames:
+                nicknames[nickname] = None
+            else:
+                nicknames[nickname] = fingerprint
+        self._family_nicknames = nicknames
+        self._family_fingerprints = fingerprints
+
+    def filter(self, filters, positions):
+        """
+        Find the relays that match every filter in a dictionary of
+        filters, as produced by L{helpers.get_filter_params}.
+
+        Keys are either flags, such as C{'isexit'}, mapped to 1 or 0,
+        or django-style lookups, such as C{'bandwidthkbps__gt'},
+        mapped to a search term. As in SQL, a NULL value never matches.
+        The C{'exitport__exact'} lookup matches the relays whose port
+        summaries allow exits to a port; any other C{'exitport'} lookup
+        matches no relay.
+        A search term that cannot be compared to its field, such as
+        C{'fast'} for C{'bandwidthkbps__gt'}, matches no relay.
+
+        The filters are evaluated by L{FilterMasks} over whole columns
+        at once.
+
+        @type filters: C{dict}
+        @param filters: The filters to apply.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays to filter.
+        @rtype: C{list} of C{int}
+        @return: The positions of the matching relays, in ascending
+            order.
+        """
+        if not filters:
+            return positions
+        if self._masks is None:
+            self._masks = FilterMasks(self)
+        return self._masks.filter(filters, positions)
+
+    def order(self, positions, order):
+        """
+        Sort a list of relays as C{QuerySet.order_by(order)} would.
+
+        Text is compared without regard to case, IP addresses are
+        compared numerically, and ties are broken by fingerprint. As in
+        PostgreSQL, NULL values come last in ascending order and first
+        in descending order. Fields that are not in the snapshot leave
+        the relays sorted by fingerprint.
+
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays to sort.
+        @type order: C{string}
+        @param order: The field to sort by, preceded by a '-' if the
+            relays should be sorted in descending order.
+        @rtype: C{list} of C{int}
+        @return: The sorted positions.
+        """
+        return sorted(positions, key=self.ranks(order).__getitem__)
+
+    def results(self, search, filters, order):
+        """
+        Get the relays in the most recent consensus that match a basic
+        search or a set of advanced search filters, in a sort order.
+
+        The results of each combination of search, filters, and order
+        are kept for the life of the snapshot, so that turning the
+        pages of a search, or exporting it, slices the same tuple
+        rather than searching and sorting again.
+
+        @type search: C{string}
+        @param search: The basic search term, as for L{search}, or an
+            empty string.
+        @type filters: C{dict}
+        @param filters: The advanced search filters, as for
+            L{filter}. Ignored if a basic search term is given.
+        @type order: C{string}
+        @param order: The sort order, as for L{order}.
+        @rtype: C{tuple} of C{int}
+        @return: The positions of the matching relays, sorted.
+        """
+        if search:
+            signature = ('search', search, order)
+        else:
+            signature = ('filter', tuple(sorted(filters.items())), order)
+
+        results = self._results.get(signature)
+        if results is None:
+            if search:
+                positions = self.search(search, self.latest)
+            else:
+                positions = self.filter(filters, self.latest)
+            results = tuple(self.order(positions, order))
+
+            self._results_lock.acquire()
+            try:
+                if len(self._results) >= MAX_RESULT_SETS:
+                    self._results.clear()
+                self._results[signature] = results
+            finally:
+                self._results_lock.release()
+        return results
+
+    def ranks(self, order):
+        """
+        Get the rank of every relay in the snapshot in a sort order.
+
+        The ranks of an order are computed the first time the order is
+        requested and kept for the life of the snapshot, so that any
+        later list of relays can be sorted by comparing integers.
+
+        @type order: C{string}
+        @param order: The field to sort by, as in L{order}.
+        @rtype: C{array} of C{long}
+        @return: The rank of each relay, indexed by position.
+        """
+        ranks = self._ranks.get(order)
+        if ranks is None:
+            field = order.lstrip('-')
+            ordered = sorted(xrange(self.size), key=self._sort_key(field))
+            if order.startswith('-'):
+                ordered.reverse()
+
+            ranks = array('l', [0]) * self.size
+            for rank, position in enumerate(ordered):
+                ranks[position] = rank
+            self._ranks[order] = ranks
+        return ranks
+
+    def seek(self, positions, order, fingerprint):
+        """
+        Find where a relay falls in a sorted list of relays.
+
+        This is the keyset equivalent of an C{OFFSET}: the relay is
+        located by its (sort key, fingerprint) pair rather than by
+        counting, so a page of any depth is found by a binary search.
+        The relay itself need not be in the list.
+
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays, as sorted by
+            L{order}.
+        @type order: C{string}
+        @param order: The order that the relays are sorted in.
+        @type fingerprint: C{string}
+        @param fingerprint: The fingerprint of a relay in the most
+            recent consensus.
+        @rtype: C{tuple} of C{int}
+        @return: The indexes in C{positions} of the first relay that
+            is not sorted before the given relay and of the first relay
+            that is sorted after it, or C{None} if the given relay is
+            not in the most recent consensus.
+        """
+        position = self.latest_positions.get(fingerprint)
+        if position is None:
+            return None
+
+        ranks = self.ranks(order)
+        rank = ranks[position]
+        ranked = _RankedPositions(positions, ranks)
+        return (bisect.bisect_left(ranked, rank),
+                bisect.bisect_right(ranked, rank))
+
+    def _sort_key(self, field):
+        """
+        Get a function mapping the position of a relay to the key that
+        the relay is sorted by.
+        """
+        fingerprints = self.columns['fingerprint']
+
+        if field in FLAG_BITS:
+            flags = self.flags
+            bit = FLAG_BITS[field]
+            return lambda position: (False, flags[position] & bit != 0,
+                                     fingerprints[position])
+
+        if field == 'address':
+            keys = [_address_key(address)
+                    for address in self.columns['address']]
+        elif field in TEXT_FIELDS:
+            keys = [value if value is None else value.lower()
+                    for value in self.columns[field]]
+        elif field in self.columns:
+            keys = [self.value(field, position)
+                    for position in xrange(self.size)]
+        else:
+            return lambda position: (False, None, fingerprints[position])
+
+        return lambda position: (keys[position] is None, keys[position],
+                                 fingerprints[position])
+
+
+class FilterMasks(object):
+    """
+    Evaluates advanced search filters over the columns of a
+    L{ConsensusSnapshot} as NumPy boolean masks.
+
+    Every flag is kept as a packed bitset, one bit per relay, and the
+    masks of the filters in a search are packed and combined with a
+    bitwise and. Integer columns are viewed as NumPy arrays without
+    being copied; text and timestamp columns are converted the first
+    time a filter needs them.
+
+    @type snapshot: L{ConsensusSnapshot}
+    @ivar snapshot: The snapshot whose relays are filtered.
+    @type flag_bits: C{dict}
+    @ivar flag_bits: The packed bitset of each flag.
+    @type latest_bits: C{numpy.ndarray}
+    @ivar latest_bits: The packed bitset of the relays in the most
+        recent consensus.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.size = snapshot.size
+        flags = self._array(snapshot.flags, 'L')
+        self.flag_bits = {}
+        for flag, bit in FLAG_BITS.iteritems():
+            self.flag_bits[flag] = numpy.packbits((flags & bit) != 0)
+        self.latest_bits = self.pack(snapshot.latest)
+        self._columns = {}
+
+    def pack(self, positions):
+        """
+        Get the packed bitset of a list of relays.
+
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays.
+        @rtype: C{numpy.ndarray}
+        @return: The packed bitset.
+        """
+        mask = numpy.zeros(self.size, dtype=bool)
+        mask[numpy.asarray(positions, dtype=int)] = True
+        return numpy.packbits(mask)
+
+    def filter(self, filters, positions):
+        """
+        Find the relays that match every filter in a dictionary of
+        filters, as L{ConsensusSnapshot.filter} does.
+
+        @type filters: C{dict}
+        @param filters: The filters to apply.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays to filter.
+        @rtype: C{list} of C{int}
+        @return: The positions of the matching relays, in ascending
+            order.
+        """
+        if positions is self.snapshot.latest:
+            bits = self.latest_bits
+        else:
+            bits = self.pack(positions)
+
+        for key, term in filters.iteritems():
+            bits = bits & self.bits(key, term)
+
+        mask = numpy.unpackbits(bits)[:self.size]
+        return numpy.flatnonzero(mask).tolist()
+
+    def bits(self, key, term):
+        """
+        Get the packed bitset of the relays that match a single filter.
+
+        @type key: C{string}
+        @param key: A flag or a django-style lookup.
+        @type term: C{object}
+        @param term: 1 or 0 for a flag, or a search term.
+        @rtype: C{numpy.ndarray}
+        @return: The packed bitset.
+        """
+        if key in FLAG_BITS:
+            if term:
+                return self.flag_bits[key]
+            return ~self.flag_bits[key]
+
+        field, criterion = key.split('__')
+        if field == 'exitport':
+            if criterion != 'exact':
+                return numpy.packbits(numpy.zeros(self.size, dtype=bool))
+            return numpy.packbits(self.exit_port(term))
+
+        text = criterion in TEXT_LOOKUPS or field in TEXT_FIELDS
+        try:
+            term = _coerce(field, term, text)
+        except ValueError:
+            return numpy.packbits(numpy.zeros(self.size, dtype=bool))
+
+        caseless = criterion in CASELESS_LOOKUPS
+        if text:
+            # Test each distinct value once, then spread the results
+            # over the relays that have each value.
+            distinct, inverse, present = self.text(field, caseless)
+            if caseless:
+                term = term.lower()
+            matches = MASK_TESTS[criterion](distinct, term)
+            return numpy.packbits(present & matches[inverse])
+        elif field in INTEGER_FIELDS:
+            values, present = self.integers(field)
+        elif field in DATETIME_FIELDS:
+            values, present = self.seconds(field)
+            term = _seconds(term)
+        else:
+            values, present = self.objects(field)
+            return numpy.packbits(present & numpy.array(
+                   [value is not None and LOOKUP_TESTS[criterion](value,
+                                                                 term)
+                    for value in values], dtype=bool))
+
+        return numpy.packbits(present & MASK_TESTS[criterion](values,
+                                                               term))
+
+    def exit_port(self, term):
+        """
+        Get a mask of the relays whose port summaries allow exits to a
+        port. Each distinct summary is tested once.
+        """
+        try:
+            port = int(term)
+        except ValueError:
+            return numpy.zeros(self.size, dtype=bool)
+
+        key = ('summaries',)
+        if key not in self._columns:
+            indexes = {}
+            inverse = numpy.array([indexes.setdefault(summary,
+                                                      len(indexes))
+                                   for summary in self.snapshot.summaries],
+                                  dtype=int)
+            distinct = [None] * len(indexes)
+            for summary, index in indexes.iteritems():
+                distinct[index] = summary
+            self._columns[key] = (distinct, inverse)
+        distinct, inverse = self._columns[key]
+
+        matches = numpy.array([summary is not None and
+                               summary.allows(port)
+                               for summary in distinct], dtype=bool)
+        return matches[inverse]
+
+    def integers(self, field):
+        """
+        Get an integer column as a NumPy array, and a mask of the
+        values that are not NULL.
+        """
+        values = self._array(self.snapshot.columns[field], 'l')
+        return values, values != NULL_INTEGER
+
+    def text(self, field, caseless):
+        """
+        Get the distinct values of a column as a NumPy unicode array,
+        lower-cased if C{caseless} is True, along with the index of the
+        value of each relay in that array and a mask of the values that
+        are not NULL. NULL values are stored as empty strings.
+        """
+        key = ('text', field, caseless)
+        if key not in self._columns:
+            values, present = self.objects(field)
+            strings = [value is not None and unicode(value) or u''
+                       for value in values]
+            if caseless:
+                strings = [string.lower() for string in strings]
+            distinct, inverse = numpy.unique(numpy.array(strings,
+                                                         dtype=unicode),
+                                             return_inverse=True)
+            self._columns[key] = (distinct, inverse, present)
+        return self._columns[key]
+
+    def seconds(self, field):
+        """
+        Get a timestamp column as a NumPy array of seconds since the
+        epoch, and a mask of the values that are not NULL. NULL values
+        are stored as 0.
+        """
+        key = ('seconds', field)
+        if key not in self._columns:
+            values, present = self.objects(field)
+            self._columns[key] = (numpy.array([value is not None and
+                                               _seconds(value) or 0.0
+                                               for value in values],
+                                              dtype=float),
+                                  present)
+        return self._columns[key]
+
+    def objects(self, field):
+        """
+        Get the values of a column as a list, and a mask of the values
+        that are not NULL.
+        """
+        key = ('objects', field)
+        if key not in self._columns:
+            values = self.snapshot.values(field, xrange(self.size))
+            self._columns[key] = (values, numpy.array(
+                                  [value is not None for value in values],
+                                  dtype=bool))
+        return self._columns[key]
+
+    def _array(self, column, typecode):
+        """
+        View an C{array} column as a NumPy array without copying it.
+        """
+        if not len(column):
+            return numpy.zeros(0, dtype=typecode)
+        return numpy.frombuffer(column, dtype=typecode)
+
+
+def _coerce(field, term, text):
+    """
+    Convert a search term to the type of the values it will be
+    compared to.
+
+    @raise ValueError: If the search term cannot be converted.
+    """
+    if text:
+        return unicode(term)
+    if field in INTEGER_FIELDS:
+        return int(term)
+    if field in DATETIME_FIELDS:
+        for datetime_format in DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(term.strip(),
+                                                  datetime_format)
+            except ValueError:
+                pass
+        raise ValueError(term)
+    return term
+
+
+def _seconds(value):
+    """
+    Convert a C{datetime} to seconds since the epoch.
+    """
+    return calendar.timegm(value.timetuple()) + \
+           value.microsecond / 1000000.0
+
+
+class _RankedPositions(object):
+    """
+    A read-only sequence of the ranks of a sorted list of relays,
+    which the bisect module can search without building a list.
+    """
+    __slots__ = ('_positions', '_ranks')
+
+    def __init__(self, positions, ranks):
+        self._positions = positions
+        self._ranks = ranks
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, index):
+        return self._ranks[self._positions[index]]
+
+
+def _address_key(address):
+    """
+    Convert an IPv4 or IPv6 address to a (version, integer) pair that
+    sorts as PostgreSQL sorts INET values.
+    """
+    try:
+        return parse_address(address)
+    except (AttributeError, ValueError):
+        return None
+
+
+def build_snapshot(validafter):
+    """
+    Build a L{ConsensusSnapshot} from the cache.active_relay table.
+
+    Only the columns in L{SNAPSHOT_FIELDS} are fetched, and they are
+    fetched as tuples rather than as L{ActiveRelay} objects. The
+    hostnames of the relays are read from the cache.hostname table,
+    and any that are missing or expired are looked up in the
+    background, in time for the next snapshot. The exit policies of
+    the relays are taken from those compiled for earlier snapshots, or
+    read and compiled for the descriptors that are new (see
+    L{load_policies}), and summarized; see L{load_summaries}.
+
+    @type validafter: C{datetime}
+    @param validafter: The validafter of the most recent consensus.
+    @rtype: L{ConsensusSnapshot}
+    @return: A snapshot of the active_relay table.
+    """
+    rows = ActiveRelay.objects.values_list(*SNAPSHOT_FIELDS).order_by(
+           'fingerprint')
+    snapshot = ConsensusSnapshot(validafter, rows.iterator())
+    snapshot.set_hostnames(load_hostnames(
+            list(set(snapshot.columns['address']))))
+    descriptors = snapshot.columns['descriptor']
+    snapshot.set_policies(load_policies(dict(
+            zip(snapshot.columns['fingerprint'], descriptors))))
+    snapshot.set_summaries(load_summaries(dict(
+            [(descriptors[position], policy) for position, policy
+             in enumerate(snapshot.policies)
+             if policy is not None and descriptors[position]])))
+    return snapshot
+
+
+def get_snapshot():
+    """
+    Get the snapshot of the most recent consensus, building a new
+    snapshot if the consensus has changed since the last one was built.
+
+    Only one thread in a process builds a new snapshot at a time; the
+    others wait for it and then use the snapshot that it built.
+
+    @rtype: L{ConsensusSnapshot}
+    @return: The snapshot of the most recent consensus.
+    """
+    global __snapshot
+
+    last_va = get_validafter()
+
+    snapshot = __snapshot
+    if snapshot is not None and snapshot.validafter == last_va:
+        return snapshot
+
+    __build_lock.acquire()
+    try:
+        snapshot = __snapshot
+        if snapshot is None or snapshot.validafter != last_va:
+            snapshot = build_snapshot(last_va)
+            __snapshot = snapshot
+    finally:
+        __build_lock.release()
+
+    return snapshot
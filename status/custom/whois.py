@@ -0,0 +1,740 @@
+"""
+Look up WHOIS information in the background, and keep it by netblock.
+
+The whois page used to run C{whois} through a shell and block the
+worker until it exited, so a few lookups against a slow registry could
+tie up every worker, and every visit forked a process and fetched the
+same text again. Lookups are now made by L{WhoisClient}, which speaks
+the WHOIS protocol (RFC 3912) directly: it asks C{settings.WHOIS_SERVER}
+and follows the referrals in each answer to the registry that holds the
+address, giving up on any lookup that has not been answered within
+C{settings.WHOIS_TIMEOUT} seconds, however many servers it asks.
+
+Each answer is parsed by L{parse_whois} for the name, organisation,
+origin AS, and networks of the netblock that holds the address, and
+kept by L{NetblockCache} under each of those networks, both in memory
+and in the cache.whois table, for C{settings.WHOIS_CACHE_TIMEOUT}
+seconds. Any address inside a netblock that has already been fetched is
+then answered locally, from the most specific network that covers it.
+
+Lookups run on a L{WhoisPool} of threads, at most one per address at a
+time. A request waits up to C{settings.WHOIS_WAIT} seconds for its
+lookup and is otherwise answered with a page that reloads itself until
+the lookup has finished. A result that nobody was waiting for is kept
+until the reloaded page takes it, so that even a failed lookup is
+shown before the next one is tried.
+"""
+# General python import statements ------------------------------------
+import datetime
+import socket
+import threading
+import time
+import Queue
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+from django.db import transaction, DatabaseError
+
+# TorStatus specific import statements --------------------------------
+from statusapp.models import Whois
+from custom.addresses import address_to_int, int_to_address, netmask, \
+        range_to_networks
+
+# INIT Variables ------------------------------------------------------
+# The server that is asked first; it refers lookups to the registry
+# that holds the address.
+WHOIS_SERVER = getattr(settings, 'WHOIS_SERVER', 'whois.iana.org')
+
+# The port that WHOIS servers listen on.
+WHOIS_PORT = 43
+
+# The number of lookups that each process runs at once.
+WHOIS_WORKERS = getattr(settings, 'WHOIS_WORKERS', 4)
+
+# How long, in seconds, a lookup may take, over all of the servers it
+# asks, before it is given up.
+WHOIS_TIMEOUT = getattr(settings, 'WHOIS_TIMEOUT', 15)
+
+# How long, in seconds, a request waits for its lookup before it is
+# answered with a page that reloads itself.
+WHOIS_WAIT = getattr(settings, 'WHOIS_WAIT', 2)
+
+# How often, in seconds, a page whose lookup is pending reloads itself.
+# A lookup that finishes after its request stopped waiting is kept,
+# whether or not it failed, until the reloaded page can take it.
+WHOIS_REFRESH = 2
+
+# How long, in seconds, the WHOIS information of a netblock is kept.
+WHOIS_CACHE_TIMEOUT = getattr(settings, 'WHOIS_CACHE_TIMEOUT',
+                              60 * 60 * 24)
+
+# How long, in seconds, an address that no netblock in the cache.whois
+# table covers is not looked for there again, and the number of such
+# addresses that are remembered; when the limit is reached, they are
+# forgotten. A lookup of the address is queued meanwhile, and its
+# netblock is kept in memory once it has been found.
+WHOIS_MISS_TTL = getattr(settings, 'WHOIS_MISS_TTL', 60 * 10)
+MAX_MISSES = 1 << 14
+
+# The number of referrals that a lookup follows at most.
+MAX_REFERRALS = 4
+
+# The most bytes that are read from a single server.
+MAX_RESPONSE = 1 << 20
+
+# How to ask a server for the network that holds an address, if not
+# by the bare address. ARIN otherwise answers with every network and
+# customer that mentions the address.
+QUERY_FORMATS = {'whois.arin.net': 'n + %s'}
+
+# The keys, in lower case, that refer a lookup to another server.
+REFERRAL_KEYS = ('refer', 'referralserver', 'whois')
+
+# The keys, in lower case and in order of preference, that each field
+# of a netblock is read from. Registries disagree on what to call
+# things: ARIN says NetRange, CIDR, OrgName and OriginAS, RIPE, APNIC
+# and AFRINIC say inetnum, org-name or descr, and origin, and LACNIC
+# says inetnum, owner and aut-num.
+NETWORK_KEYS = ('cidr', 'inetnum', 'netrange', 'route')
+NETNAME_KEYS = ('netname',)
+ORG_KEYS = ('orgname', 'org-name', 'owner', 'organization', 'descr')
+ASN_KEYS = ('originas', 'origin', 'aut-num')
+
+# The text of a lookup that timed out or failed. These are shown once
+# but not cached, so the request after that tries again.
+TIMED_OUT = 'The WHOIS lookup timed out.'
+FAILED = 'The WHOIS lookup failed.'
+
+
+def parse_networks(value):
+    """
+    Read the networks from the value of a WHOIS field, which may be
+    a range of addresses, a network in CIDR notation, or a list of
+    either separated by commas.
+
+    @type value: C{string}
+    @param value: The value of the field.
+    @rtype: C{list} of C{string}
+    @return: The networks, in CIDR notation. Parts of the value that
+        are not IPv4 networks are left out.
+    """
+    networks = []
+    for part in value.split(','):
+        try:
+            if '-' in part:
+                first, last = part.split('-', 1)
+                networks.extend(range_to_networks(
+                        address_to_int(first.strip(), abbreviated=True),
+                        address_to_int(last.strip(), abbreviated=True)))
+            elif '/' in part:
+                base, bits = part.split('/', 1)
+                bits = int(bits)
+                if not 0 <= bits <= 32:
+                    continue
+                base = (address_to_int(base.strip(), abbreviated=True) &
+                        netmask(bits))
+                networks.append('%s/%d' % (int_to_address(base), bits))
+        except ValueError:
+            continue
+    return networks
+
+
+def parse_whois(text):
+    """
+    Read the fields of the netblock that an answer from a WHOIS server
+    describes.
+
+    Where the answer holds more than one object, the first value of
+    each field is used.
+
+    @type text: C{string}
+    @param text: The answer.
+    @rtype: C{dict}
+    @return: The C{netname}, C{org}, and C{asn} of the netblock, each
+        None if missing, its C{networks} as a list of networks in CIDR
+        notation, and the C{referral} as a (host, port) pair, or None
+        if the answer refers to no other server.
+    """
+    values = {}
+    for line in text.splitlines():
+        if not line or line[0] in '%#' or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        key = key.strip().lower()
+        value = value.strip()
+        if value and key not in values:
+            values[key] = value
+
+    def first(keys):
+        for key in keys:
+            if key in values:
+                return values[key]
+        return None
+
+    networks = []
+    for key in NETWORK_KEYS:
+        if key in values:
+            networks = parse_networks(values[key])
+            if networks:
+                break
+
+    referral = None
+    for key in REFERRAL_KEYS:
+        if key in values:
+            referral = parse_referral(values[key])
+            if referral is not None:
+                break
+
+    return {'netname': first(NETNAME_KEYS), 'org': first(ORG_KEYS),
+            'asn': first(ASN_KEYS), 'networks': networks,
+            'referral': referral}
+
+
+def parse_referral(value):
+    """
+    Read the server that a referral points to.
+
+    >>> parse_referral('whois://whois.ripe.net')
+    ('whois.ripe.net', 43)
+    >>> parse_referral('rwhois://rwhois.example.net:4321')
+
+    @type value: C{string}
+    @param value: The value of the referral field, either a host name
+        or a C{whois://} URL.
+    @rtype: C{tuple}
+    @return: The (host, port) of the server, or None if the referral
+        is not to a WHOIS server.
+    """
+    if '://' in value:
+        scheme, value = value.split('://', 1)
+        if scheme.lower() != 'whois':
+            return None
+    value = value.strip().rstrip('/')
+    port = WHOIS_PORT
+    if ':' in value:
+        value, port = value.rsplit(':', 1)
+        try:
+            port = int(port)
+        except ValueError:
+            return None
+    if not value or ' ' in value:
+        return None
+    return (value.lower(), port)
+
+
+class WhoisClient(object):
+    """
+    Looks up WHOIS information over the WHOIS protocol, following
+    referrals from one server to the next.
+
+    A WHOIS server closes the connection once it has answered, so
+    nothing is left to reuse between queries but the addresses of the
+    servers, which are kept so that each server is only resolved once.
+
+    @type server: C{tuple}
+    @ivar server: The (host, port) of the server that is asked first.
+    @type timeout: C{int} or C{float}
+    @ivar timeout: How long, in seconds, a lookup may take.
+    @type referrals: C{int}
+    @ivar referrals: The number of referrals that are followed at most.
+    """
+
+    def __init__(self, server, timeout, referrals=MAX_REFERRALS):
+        """
+        @type server: C{tuple}
+        @param server: The (host, port) of the server that is asked
+            first.
+        @type timeout: C{int} or C{float}
+        @param timeout: How long, in seconds, a lookup may take.
+        @type referrals: C{int}
+        @param referrals: The number of referrals that are followed at
+            most.
+        """
+        self.server = server
+        self.timeout = timeout
+        self.referrals = referrals
+
+        # The socket addresses of each (host, port), as returned by
+        # getaddrinfo.
+        self._addresses = {}
+
+    def query(self, address):
+        """
+        Look up the WHOIS information of an address.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @rtype: C{tuple}
+        @return: The answer of the last server that was asked, as
+            C{unicode}, and its fields as returned by L{parse_whois}.
+        @raise socket.error: If a server cannot be reached, or the
+            lookup times out.
+        """
+        deadline = time.time() + self.timeout
+        server = self.server
+        asked = set()
+        while True:
+            asked.add(server)
+            text = self.fetch(server, address, deadline)
+            fields = parse_whois(text)
+            server = fields['referral']
+            if (server is None or server in asked or
+                    len(asked) > self.referrals):
+                return text, fields
+
+    def fetch(self, server, address, deadline=None):
+        """
+        Ask one server about an address.
+
+        @type server: C{tuple}
+        @param server: The (host, port) of the server.
+        @type address: C{string}
+        @param address: The IP address.
+        @type deadline: C{float}
+        @param deadline: The time, as from C{time.time()}, by which the
+            server must have answered, or None to allow it
+            L{timeout} seconds from now.
+        @rtype: C{unicode}
+        @return: The answer of the server.
+        @raise socket.error: If the server cannot be reached, or has
+            not answered by the deadline.
+        """
+        if deadline is None:
+            deadline = time.time() + self.timeout
+        query = QUERY_FORMATS.get(server[0], '%s') % address
+        connection = self._connect(server, deadline)
+        try:
+            connection.settimeout(_remaining(deadline))
+            connection.sendall(query + '\r\n')
+            chunks = []
+            size = 0
+            while size < MAX_RESPONSE:
+                connection.settimeout(_remaining(deadline))
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        finally:
+            connection.close()
+        return ''.join(chunks).decode('utf-8', 'replace')
+
+    def _connect(self, server, deadline):
+        """
+        Open a connection to a server, trying each of its addresses
+        until the deadline.
+        """
+        addresses = self._addresses.get(server)
+        if addresses is None:
+            addresses = socket.getaddrinfo(server[0], server[1], 0,
+                                           socket.SOCK_STREAM)
+            self._addresses[server] = addresses
+
+        error = socket.error('no addresses for %s' % server[0])
+        for family, kind, protocol, name, sockaddr in addresses:
+            timeout = _remaining(deadline)
+            connection = socket.socket(family, kind, protocol)
+            connection.settimeout(timeout)
+            try:
+                connection.connect(sockaddr)
+                return connection
+            except socket.error, error:
+                connection.close()
+
+        # The server may have moved; resolve it again next time.
+        self._addresses.pop(server, None)
+        raise error
+
+
+def _remaining(deadline):
+    """
+    Get the time left until a deadline.
+
+    @type deadline: C{float}
+    @param deadline: The deadline, as from C{time.time()}.
+    @rtype: C{float}
+    @return: The seconds left, which are more than 0.
+    @raise socket.timeout: If the deadline has passed.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout('the WHOIS lookup timed out')
+    return remaining
+
+
+class NetblockCache(object):
+    """
+    The WHOIS information of netblocks, found by any address that they
+    cover.
+
+    Each record is a L{Whois} that is kept under its network. An
+    address is looked up by trying the network of each prefix length
+    that could cover it, from the most specific to the least.
+
+    @type ttl: C{int} or C{float}
+    @ivar ttl: How long, in seconds, a netblock is kept.
+    @type load: C{callable}
+    @ivar load: A function mapping an address to the most specific
+        unexpired L{Whois} that covers it, kept elsewhere, or None.
+    @type store: C{callable}
+    @ivar store: A function that is called with each new L{Whois}, or
+        None.
+    @type miss_ttl: C{int} or C{float}
+    @ivar miss_ttl: How long, in seconds, an address that L{load} does
+        not find is not loaded again.
+    """
+
+    def __init__(self, ttl, load=None, store=None, miss_ttl=0):
+        """
+        @type ttl: C{int} or C{float}
+        @param ttl: How long, in seconds, a netblock is kept.
+        @type load: C{callable}
+        @param load: A function that finds a netblock kept elsewhere,
+            as described above, or None.
+        @type store: C{callable}
+        @param store: A function that is called with each new netblock,
+            or None.
+        @type miss_ttl: C{int} or C{float}
+        @param miss_ttl: How long, in seconds, an address that is not
+            found by load is not loaded again.
+        """
+        self.ttl = ttl
+        self.load = load
+        self.store = store
+        self.miss_ttl = miss_ttl
+
+        # Each (network, prefix length), with the network as an
+        # integer, maps to its record.
+        self._blocks = {}
+
+        # Each address that load() did not find maps to the time until
+        # which it is not loaded again.
+        self._misses = {}
+
+    def get(self, address):
+        """
+        Get the WHOIS information of the most specific netblock that
+        covers an address.
+
+        Netblocks that are not kept in memory are loaded, unless the
+        address was not found there in the last L{miss_ttl} seconds.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @rtype: L{Whois}
+        @return: The netblock, or None if no unexpired netblock covers
+            the address.
+        """
+        value = address_to_int(address)
+        now = datetime.datetime.now()
+        for bits in xrange(32, -1, -1):
+            record = self._blocks.get((value & netmask(bits), bits))
+            if record is not None and record.expires > now:
+                return record
+
+        if self.load is None:
+            return None
+        missed = self._misses.get(address)
+        if missed is not None and missed > now:
+            return None
+        record = self.load(address)
+        if record is not None:
+            self._blocks[_network_key(record.network)] = record
+        elif self.miss_ttl:
+            if len(self._misses) >= MAX_MISSES:
+                self._misses.clear()
+            self._misses[address] = now + datetime.timedelta(
+                    seconds=self.miss_ttl)
+        return record
+
+    def add(self, address, text, fields):
+        """
+        Keep the WHOIS information that was found for an address.
+
+        The information is kept under each of its networks that covers
+        the address. A server that names no such network is only
+        trusted for the address itself.
+
+        @type address: C{string}
+        @param address: The IP address that was looked up.
+        @type text: C{unicode}
+        @param text: The answer of the server.
+        @type fields: C{dict}
+        @param fields: The fields of the answer, as returned by
+            L{parse_whois}.
+        @rtype: L{Whois}
+        @return: The most specific netblock that covers the address.
+        """
+        value = address_to_int(address)
+        expires = (datetime.datetime.now() +
+                   datetime.timedelta(seconds=self.ttl))
+
+        networks = []
+        for network in fields['networks']:
+            base, bits = _network_key(network)
+            if value & netmask(bits) == base:
+                networks.append(network)
+        if not networks:
+            networks = ['%s/32' % address]
+
+        record = None
+        for network in networks:
+            key = _network_key(network)
+            block = Whois(network=network, netname=fields['netname'],
+                          org=fields['org'], asn=fields['asn'],
+                          whois=text, expires=expires)
+            self._blocks[key] = block
+            if record is None or key[1] > _network_key(record.network)[1]:
+                record = block
+            if self.store is not None:
+                try:
+                    self.store(block)
+                except Exception:
+                    # The netblock is still kept in memory; the table
+                    # is only a cache, so a failure to write it is not
+                    # fatal.
+                    pass
+        return record
+
+
+def _network_key(network):
+    """
+    Get the (network, prefix length) of a network in CIDR notation,
+    with the network as an integer.
+    """
+    base, bits = network.split('/')
+    return (address_to_int(base), int(bits))
+
+
+class WhoisPool(object):
+    """
+    Runs the WHOIS lookups of a process on a fixed number of threads.
+
+    @type lookup: C{callable}
+    @ivar lookup: A function mapping an address to its WHOIS
+        information.
+    @type workers: C{int}
+    @ivar workers: The number of lookups that run at once.
+    @type keep: C{int} or C{float}
+    @ivar keep: How long, in seconds, the result of a lookup that
+        nobody was waiting for when it finished is kept for the next
+        request.
+    """
+
+    def __init__(self, lookup, workers, keep=0):
+        """
+        @type lookup: C{callable}
+        @param lookup: A function mapping an address to its WHOIS
+            information.
+        @type workers: C{int}
+        @param workers: The number of lookups that run at once.
+        @type keep: C{int} or C{float}
+        @param keep: How long, in seconds, the result of a lookup that
+            nobody was waiting for when it finished is kept for the
+            next request.
+        """
+        self.lookup = lookup
+        self.workers = workers
+        self.keep = keep
+
+        # Each address that is queued or being looked up maps to an
+        # event that is set, with the result as its whois attribute,
+        # when its lookup finishes.
+        self._pending = {}
+        # Each address whose lookup finished maps to its event and the
+        # time until which it is kept, until a request takes it.
+        self._finished = {}
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, address, wait=0):
+        """
+        Queue a lookup of an address, unless one is already queued, and
+        wait for it to finish.
+
+        @type address: C{string}
+        @param address: The IP address.
+        @type wait: C{int} or C{float}
+        @param wait: How long, in seconds, to wait for the lookup.
+        @return: The result of the lookup, or None if it has not
+            finished.
+        """
+        self._lock.acquire()
+        try:
+            if not self._threads:
+                self._start()
+            finished = self._pending.get(address)
+            if finished is None:
+                kept = self._finished.pop(address, None)
+                if kept is not None and kept[1] > time.time():
+                    return kept[0].whois
+                finished = threading.Event()
+                self._pending[address] = finished
+                self._queue.put(address)
+        finally:
+            self._lock.release()
+
+        if wait:
+            finished.wait(wait)
+        if not finished.isSet():
+            return None
+        self._lock.acquire()
+        try:
+            # The result has been taken, so the next request looks the
+            # address up again if it failed.
+            kept = self._finished.get(address)
+            if kept is not None and kept[0] is finished:
+                del self._finished[address]
+        finally:
+            self._lock.release()
+        return finished.whois
+
+    def _start(self):
+        """
+        Start the threads that run lookups.
+        """
+        for number in xrange(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='whois-%d' % number)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """
+        Run queued lookups, one at a time, forever. A lookup that
+        raises is answered as failed, and the thread carries on.
+        """
+        while True:
+            address = self._queue.get()
+            whois = None
+            try:
+                whois = self.lookup(address)
+            except Exception:
+                whois = _failed(address, FAILED)
+            finally:
+                self._lock.acquire()
+                try:
+                    finished = self._pending.pop(address)
+                    finished.whois = whois
+                    if self.keep:
+                        self._keep(address, finished)
+                finally:
+                    self._lock.release()
+                finished.set()
+
+    def _keep(self, address, finished):
+        """
+        Keep the result of a lookup for the next request, in case the
+        request that queued it has stopped waiting, and forget those
+        that have expired. The lock is held by the caller.
+        """
+        now = time.time()
+        for other, (event, expires) in self._finished.items():
+            if expires <= now:
+                del self._finished[other]
+        self._finished[address] = (finished, now + self.keep)
+
+
+# The most specific unexpired netblock that covers an address.
+COVERING_SQL = ('SELECT * FROM cache.whois '
+                'WHERE network >>= %s AND expires > now() '
+                'ORDER BY masklen(network) DESC LIMIT 1')
+
+
+def _failed(address, text):
+    """
+    Get the unsaved L{Whois} of a lookup that did not succeed.
+
+    @type address: C{string}
+    @param address: The IP address that was looked up.
+    @type text: C{string}
+    @param text: Why the lookup did not succeed, such as L{FAILED}.
+    @rtype: L{Whois}
+    @return: The WHOIS information of the address alone.
+    """
+    return Whois(network='%s/32' % address, whois=text)
+
+
+def _load_netblock(address):
+    """
+    Find the most specific netblock that covers an address in the
+    cache.whois table.
+    """
+    records = list(Whois.objects.raw(COVERING_SQL, [address]))
+    if not records:
+        return None
+    return records[0]
+
+
+def _store_netblock(record):
+    """
+    Store a netblock in the cache.whois table. Another process may
+    store the same netblock meanwhile, so a failed write is rolled back
+    to a savepoint, leaving the transaction usable, before it raises.
+    """
+    savepoint = transaction.savepoint()
+    try:
+        record.save()
+    except DatabaseError:
+        transaction.savepoint_rollback(savepoint)
+        raise
+    transaction.savepoint_commit(savepoint)
+
+
+__client = WhoisClient((WHOIS_SERVER, WHOIS_PORT), WHOIS_TIMEOUT)
+__netblocks = NetblockCache(WHOIS_CACHE_TIMEOUT, load=_load_netblock,
+                            store=_store_netblock,
+                            miss_ttl=WHOIS_MISS_TTL)
+
+
+def lookup_whois(address):
+    """
+    Look up the WHOIS information of an address over the network,
+    unless a netblock that covers it has been fetched meanwhile.
+
+    @type address: C{string}
+    @param address: The IP address.
+    @rtype: L{Whois}
+    @return: The most specific netblock that covers the address or, if
+        the lookup failed, an unsaved L{Whois} for the address alone
+        whose text says so.
+    """
+    try:
+        record = __netblocks.get(address)
+        if record is not None:
+            return record
+        try:
+            text, fields = __client.query(address)
+        except socket.timeout:
+            return _failed(address, TIMED_OUT)
+        except EnvironmentError:
+            return _failed(address, FAILED)
+        return __netblocks.add(address, text, fields)
+    finally:
+        # Lookups run on threads of their own, where nothing else ends
+        # the transaction that loading or storing netblocks began.
+        transaction.commit_unless_managed()
+
+
+__pool = WhoisPool(lookup_whois, WHOIS_WORKERS,
+                   keep=WHOIS_WAIT + WHOIS_REFRESH)
+
+
+def get_whois(address):
+    """
+    Get the WHOIS information of an address, from the netblocks that
+    have been fetched or, failing that, by waiting up to
+    C{settings.WHOIS_WAIT} seconds for it to be looked up.
+
+    @type address: C{string}
+    @param address: The IP address.
+    @rtype: L{Whois}
+    @return: The WHOIS information, or None if the lookup has not
+        finished yet.
+    """
+    record = __netblocks.get(address)
+    if record is not None:
+        return record
+    return __pool.submit(address, WHOIS_WAIT)
@@ -3,6 +3,7 @@
 # Module for setting up the proper Timezone.
 import time
 import os
+import multiprocessing
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -83,6 +84,50 @@ SESSION_ENGINE = 'django.contrib.sessions.backends.file'
 
 SESSION_FILE_PATH = os.path.join(os.path.dirname(__file__), 'tmp/')
 
+# How long, in seconds, the validafter of the most recent consensus is
+# cached when notifications from update_relay_table() cannot be
+# received (see status/custom/epoch.py).
+CONSENSUS_EPOCH_TTL = 60
+
+# How long, in seconds, rendered index pages are kept in the cache.
+# Pages are keyed by consensus, so this need only be a little longer
+# than the interval between consensuses (see status/custom/pagecache.py).
+PAGE_CACHE_TIMEOUT = 60 * 90
+
+# How long, in seconds, the hostnames of relays are kept before they
+# are looked up again, how long failed lookups are remembered, and how
+# many threads in each process look them up (see
+# status/custom/resolver.py).
+HOSTNAME_TTL = 60 * 60 * 24
+HOSTNAME_NEGATIVE_TTL = 60 * 60
+HOSTNAME_WORKERS = 4
+
+# The server that WHOIS lookups start from, how many lookups each
+# process runs at once, how long, in seconds, a lookup may take,
+# how long a request waits for a lookup, how long the information
+# of a netblock is kept, and how long an address that no stored
+# netblock covers is not looked for again (see status/custom/whois.py).
+WHOIS_SERVER = 'whois.iana.org'
+WHOIS_WORKERS = 4
+WHOIS_TIMEOUT = 15
+WHOIS_WAIT = 2
+WHOIS_CACHE_TIMEOUT = 60 * 60 * 24
+WHOIS_MISS_TTL = 60 * 10
+
+# The directory that the network statistic graphs are stored in once
+# they are rendered for a consensus (see status/custom/graphstore.py).
+GRAPH_DIR = os.path.join(os.path.dirname(__file__), 'tmp/graphs/')
+
+# The number of processes that draw graphs with matplotlib in each web
+# server process, the number that the rendergraphs command draws them
+# with, and how long, in seconds, to wait for a graph (see
+# status/custom/graphrender.py). With 0 processes, graphs are drawn by
+# the calling thread; a pool in every web server process would fork
+# as many processes again for each of them.
+GRAPH_PROCESSES = 0
+GRAPH_RENDER_PROCESSES = multiprocessing.cpu_count()
+GRAPH_TIMEOUT = 60
+
 ROOT_URLCONF = 'urls'
 
 TEMPLATE_DIRS = (
@@ -0,0 +1,191 @@
+"""
+Time the rendering of the relay table on the index page.
+
+This command builds a snapshot of synthetic relays, so it needs
+neither a database nor a consensus, and reports how long it takes to
+render every relay on a single page, both as bare table rows and as a
+complete index.html response.
+
+The rows are materialized in two ways and both are reported: as the
+relay dictionaries of gen_list_dict(), which hold every field of every
+relay, and as the tuples that a L{RowRenderer} projects from the
+snapshot, which hold only the fields that the current columns display.
+For each, the command reports the CPU time to build and render the
+rows and the approximate memory that the rows take. Run it with::
+
+    python manage.py benchmark_index --relays 7000 --repeat 5
+"""
+# General python import statements ------------------------------------
+import datetime
+import sys
+import time
+from optparse import make_option
+
+# Django-specific import statements -----------------------------------
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+# TorStatus specific import statements --------------------------------
+from custom.paginator import KeysetPaginator
+from custom.snapshot import ConsensusSnapshot, SNAPSHOT_FIELDS, \
+        FLAG_FIELDS
+from statusapp.views.helpers import gen_list_dict, ICONS, \
+        COLUMN_VALUE_NAME
+from statusapp.views.pages import CURRENT_COLUMNS, AVAILABLE_COLUMNS, \
+        NOT_MOVABLE_COLUMNS
+from statusapp.views.rows import get_renderer
+
+# INIT Variables ------------------------------------------------------
+PLATFORMS = ('Tor 0.2.2.35 on Linux x86_64',
+             'Tor 0.2.2.35 on Windows XP Service Pack 3',
+             'Tor 0.2.3.10-alpha on FreeBSD amd64',
+             'Tor 0.2.2.34 on Darwin Power Macintosh', None)
+
+COUNTRIES = ('us', 'de', 'nl', 'fr', 'se', 'ru', None)
+
+
+def synthetic_snapshot(size):
+    """
+    Build a snapshot of relays with varied, plausible values.
+
+    @type size: C{int}
+    @param size: The number of relays.
+    @rtype: L{ConsensusSnapshot}
+    @return: A snapshot in which every relay is in the most recent
+        consensus.
+    """
+    validafter = datetime.datetime(2011, 8, 1, 12)
+    rows = []
+    for index in xrange(size):
+        row = {'validafter': validafter,
+               'nickname': 'Relay%d' % index,
+               'fingerprint': '%040X' % (index * 2654435761),
+               'address': '%d.%d.%d.%d' % (10 + index % 200,
+                                           index // 256 % 256,
+                                           index % 256, 1 + index % 250),
+               'descriptor': '%040x' % index,
+               'published': validafter - datetime.timedelta(
+                            minutes=index % 1000),
+               'platform': PLATFORMS[index % len(PLATFORMS)],
+               'contact': index % 3 and 'Operator <op%d@example.com>' %
+                          index or None,
+               'family': None,
+               'country': COUNTRIES[index % len(COUNTRIES)],
+               'latitude': 40.0 + index % 20,
+               'longitude': -70.0 - index % 20,
+               'orport': 9001,
+               'dirport': index % 2 and 9030 or 0,
+               'bandwidthavg': 5242880,
+               'bandwidthburst': 10485760,
+               'bandwidthobserved': 1024 * (index % 5000),
+               'bandwidthkbps': index % 5000,
+               'uptime': 3600 * (index % 2000),
+               'uptimedays': index % 2000 // 24}
+        for bit, flag in enumerate(FLAG_FIELDS):
+            row[flag] = (index >> bit) % 3 == 0
+        rows.append(tuple([row[field] for field in SNAPSHOT_FIELDS]))
+    return ConsensusSnapshot(validafter, rows)
+
+
+def deep_size(rows):
+    """
+    Estimate the memory that a list of rows takes, counting the list,
+    each row, and each value that is not shared with the snapshot.
+
+    @type rows: C{list} of C{dict} or C{tuple}
+    @param rows: The rows.
+    @rtype: C{int}
+    @return: The approximate size of the rows, in bytes.
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        if isinstance(row, dict):
+            row = row.values()
+        for value in row:
+            # Strings that are formatted for the page are new objects;
+            # everything else is shared with the snapshot.
+            if isinstance(value, str) and value.endswith(('KB/s', ' d')):
+                size += sys.getsizeof(value)
+    return size
+
+
+class Command(BaseCommand):
+    help = ('Time the rendering of every relay on a single index page, '
+            'using synthetic relays.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--relays', type='int', dest='relays', default=7000,
+                    help='The number of relays to render.'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='The number of times to render them.'),
+        make_option('--all-columns', action='store_true',
+                    dest='all_columns', default=False,
+                    help='Display the available columns as well.'),
+        )
+
+    def handle(self, *args, **options):
+        snapshot = synthetic_snapshot(options['relays'])
+        columns = list(CURRENT_COLUMNS)
+        if options['all_columns']:
+            columns.extend(AVAILABLE_COLUMNS)
+        order = 'nickname'
+        positions = snapshot.order(snapshot.latest, order)
+
+        renderer = get_renderer(columns)
+        paginator = KeysetPaginator(snapshot, positions, order,
+                                    len(positions))
+        paged_relays = paginator.page(1)
+
+        # CPU time, so that other processes do not skew the results.
+        timings = {'dicts': [], 'dict rows': [], 'projection': [],
+                   'projected rows': [], 'page': []}
+        for attempt in xrange(options['repeat']):
+            start = time.clock()
+            relays = gen_list_dict(
+                     snapshot.relays(paged_relays.object_list))
+            timings['dicts'].append(time.clock() - start)
+
+            start = time.clock()
+            renderer.render(renderer.project_dicts(relays))
+            timings['dict rows'].append(time.clock() - start)
+
+            start = time.clock()
+            rows = renderer.project(snapshot, paged_relays.object_list)
+            timings['projection'].append(time.clock() - start)
+
+            start = time.clock()
+            relay_rows = renderer.render(rows)
+            timings['projected rows'].append(time.clock() - start)
+
+            start = time.clock()
+            render_to_string('index.html', {
+                    'paged_relays': paged_relays,
+                    'current_columns': columns,
+                    'relay_rows': relay_rows,
+                    'not_columns': NOT_MOVABLE_COLUMNS,
+                    'request': None,
+                    'column_value_name': COLUMN_VALUE_NAME,
+                    'icons_list': ICONS,
+                    'number_of_results': len(positions),
+                    'ascending_or_descending': 'descending',
+                    'order_param': order})
+            timings['page'].append(time.clock() - start)
+
+        self.stdout.write('%d relays, %d columns, %d fields, '
+                          'best of %d CPU times:\n' %
+                          (len(positions), len(columns),
+                           len(renderer.fields), options['repeat']))
+        for name, label in (('dicts', 'relay dictionaries'),
+                            ('dict rows', 'rows from dictionaries'),
+                            ('projection', 'projected tuples'),
+                            ('projected rows', 'rows from tuples'),
+                            ('page', 'rest of index.html')):
+            self.stdout.write('  %-24s %8.1f ms\n' %
+                              (label, min(timings[name]) * 1000))
+
+        self.stdout.write('Approximate memory of the rows:\n')
+        for label, size in (('relay dictionaries', deep_size(relays)),
+                            ('projected tuples', deep_size(rows))):
+            self.stdout.write('  %-24s %8.1f KB\n' %
+                              (label, size / 1024.0))
@@ -0,0 +1,118 @@
+"""
+Render the network statistic graphs once per consensus.
+
+The graphs are drawn from the most recent consensus and stored on disk
+(see L{custom.graphstore}), where the views serve them from. Run it
+once, for instance from the same crontab as update_relay_table()::
+
+    python manage.py rendergraphs
+
+or leave it running, to render the graphs whenever update_relay_table()
+sends its notification::
+
+    python manage.py rendergraphs --listen
+"""
+# General python import statements ------------------------------------
+import select
+import time
+from optparse import make_option
+
+# Django-specific import statements -----------------------------------
+from django.core.management.base import BaseCommand
+from django.db import connection as db_connection
+
+# Psycopg2-specific import statements ---------------------------------
+import psycopg2
+import psycopg2.extensions
+
+# TorStatus specific import statements --------------------------------
+from custom.epoch import NOTIFY_CHANNEL, RECONNECT_DELAY, \
+        LISTENING_TTL, connection_params, invalidate_validafter
+from custom.graphrender import GRAPH_RENDER_PROCESSES, \
+        set_graph_processes
+from statusapp.views.graphs import render_network_graphs
+
+
+class Command(BaseCommand):
+    help = 'Render the network statistic graphs once per consensus.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--listen', action='store_true', dest='listen',
+                    default=False,
+                    help='Keep running, and render the graphs after '
+                         'each update of the relay table.'),
+        )
+
+    def handle(self, *args, **options):
+        set_graph_processes(GRAPH_RENDER_PROCESSES)
+        if not options['listen']:
+            self.render()
+            return
+        try:
+            self.listen()
+        except KeyboardInterrupt:
+            pass
+
+    def render(self):
+        """
+        Render and store the graphs of the most recent consensus.
+        """
+        started = time.time()
+        try:
+            key = render_network_graphs()
+        finally:
+            # Nothing else ends the transaction that the rendering
+            # queries began, and while it stays open it blocks the
+            # truncation of the active relay table.
+            db_connection.close()
+        self.stdout.write('Rendered the graphs of consensus %s in '
+                          '%.1f seconds\n' % (key, time.time() - started))
+
+    def listen(self):
+        """
+        Render the graphs now and after every notification on
+        L{NOTIFY_CHANNEL}, reconnecting whenever the connection fails.
+        """
+        while True:
+            try:
+                connection = psycopg2.connect(**connection_params())
+                try:
+                    connection.set_isolation_level(
+                        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                    connection.cursor().execute(
+                        'LISTEN %s;' % NOTIFY_CHANNEL)
+
+                    # The table may have changed while nobody was
+                    # listening.
+                    self.render_safely()
+
+                    while True:
+                        readable = select.select([connection], [], [],
+                                                 LISTENING_TTL)[0]
+                        if not readable:
+                            continue
+                        connection.poll()
+                        if connection.notifies:
+                            # Several notifications call for a single
+                            # rendering.
+                            del connection.notifies[:]
+                            invalidate_validafter()
+                            self.render_safely()
+                finally:
+                    connection.close()
+            except (psycopg2.Error, select.error), error:
+                self.stderr.write('Lost the database connection: %s\n' %
+                                  error)
+                time.sleep(RECONNECT_DELAY)
+
+    def render_safely(self):
+        """
+        Render the graphs, reporting rather than raising any error, so
+        that a failed rendering waits for the next consensus.
+        """
+        try:
+            self.render()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception, error:
+            self.stderr.write('Could not render the graphs: %s\n' % error)
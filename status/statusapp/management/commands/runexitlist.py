@@ -0,0 +1,49 @@
+"""
+Answer TorDNSEL exit list queries over DNS.
+
+The server answers from the exit lists of the consensus snapshot of
+this process (see L{custom.dnsel}), and follows the consensus as the
+web application does. Run it with::
+
+    python manage.py runexitlist --address 127.0.0.1 --port 5353
+
+and ask it, for instance, with::
+
+    dig -p 5353 @127.0.0.1 \\
+        4.3.2.1.443.8.7.6.5.ip-port.exitlist.torproject.org
+"""
+# General python import statements ------------------------------------
+from optparse import make_option
+
+# Django-specific import statements -----------------------------------
+from django.core.management.base import BaseCommand
+
+# TorStatus specific import statements --------------------------------
+from custom.dnsel import ExitListServer, DNSEL_ZONE, ANSWER_TTL
+
+
+class Command(BaseCommand):
+    help = 'Answer TorDNSEL exit list queries over DNS.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--address', dest='address', default='127.0.0.1',
+                    help='The address to listen on.'),
+        make_option('--port', type='int', dest='port', default=5353,
+                    help='The UDP port to listen on.'),
+        make_option('--zone', dest='zone', default=DNSEL_ZONE,
+                    help='The zone that queries are made under.'),
+        make_option('--ttl', type='int', dest='ttl', default=ANSWER_TTL,
+                    help='How long, in seconds, answers may be kept.'),
+        )
+
+    def handle(self, *args, **options):
+        server = ExitListServer((options['address'], options['port']),
+                                zone=options['zone'], ttl=options['ttl'])
+        self.stdout.write('Answering queries under %s on %s:%d\n' %
+                          (server.zone, options['address'],
+                           server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
@@ -1467,3 +1467,89 @@ class ActiveRelay(models.Model):
 
     def __unicode__(self):
         return self.fingerprint
+
+
+class Hostname(models.Model):
+    """
+    Model for the hostnames of the addresses of relays, as found by
+    reverse DNS lookups.
+
+    @type address: IPAddressField (C{string})
+    @ivar address: The IP address of a relay.
+    @type hostname: CharField (C{string})
+    @ivar hostname: The hostname of the address, or None if the lookup
+        found no hostname.
+    @type expires: DateTimeField (C{datetime})
+    @ivar expires: The time after which the hostname should be looked
+        up again.
+    """
+    address = models.IPAddressField(primary_key=True)
+    hostname = models.CharField(max_length=255, null=True, blank=True)
+    expires = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'hostname'
+        db_table = 'cache\".\"hostname'
+
+    def __unicode__(self):
+        return self.address
+
+
+class Whois(models.Model):
+    """
+    Model for the WHOIS information of netblocks, as found by lookups
+    from the whois page.
+
+    @type network: CharField (C{string})
+    @ivar network: The network of the netblock, in CIDR notation.
+    @type netname: CharField (C{string})
+    @ivar netname: The name that the registry gives the netblock, or
+        None.
+    @type org: CharField (C{string})
+    @ivar org: The organisation that holds the netblock, or None.
+    @type asn: CharField (C{string})
+    @ivar asn: The autonomous system that announces the netblock, or
+        None.
+    @type whois: TextField (C{string})
+    @ivar whois: The answer of the registry.
+    @type expires: DateTimeField (C{datetime})
+    @ivar expires: The time after which the netblock should be looked
+        up again.
+    """
+    network = models.CharField(max_length=18, primary_key=True)
+    netname = models.CharField(max_length=255, null=True, blank=True)
+    org = models.CharField(max_length=255, null=True, blank=True)
+    asn = models.CharField(max_length=255, null=True, blank=True)
+    whois = models.TextField()
+    expires = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'whois'
+        db_table = 'cache\".\"whois'
+
+    def __unicode__(self):
+        return self.network
+
+
+class ExitSummary(models.Model):
+    """
+    Model for the summaries of the ports that exit policies accept,
+    in the form of the C{p} line of a microdescriptor.
+
+    @type descriptor: CharField (C{string})
+    @ivar descriptor: The digest of the descriptor whose exit policy
+        is summarized.
+    @type summary: TextField (C{string})
+    @ivar summary: The summary, such as C{'accept 80,443'} or
+        C{'reject 1-65535'}.
+    """
+    descriptor = models.CharField(max_length=40, primary_key=True)
+    summary = models.TextField()
+
+    class Meta:
+        verbose_name = 'exit summary'
+        verbose_name_plural = 'exit summaries'
+        db_table = 'cache\".\"exit_summary'
+
+    def __unicode__(self):
+        return self.summary
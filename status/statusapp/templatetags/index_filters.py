@@ -12,6 +12,7 @@ FILTERED_NAME = {'Longitude': 'longitude',
                  'Bandwidth': 'bandwidthkbps',
                  'Uptime': 'uptime',
                  'IP': 'address',
+                 'Hostname': 'hostname',
                  'Hibernating': 'hibernating',
                  'ORPort': 'orport',
                  'DirPort': 'dirport',
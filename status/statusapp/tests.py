@@ -2,9 +2,62 @@
 The test module. To run tests, change directory to status and run
 'python manage.py test statusapp'.
 """
+import datetime
+import gzip
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import socket
+import threading
+import SocketServer
+from cStringIO import StringIO
+
 import django.test
+import matplotlib
+from django.db import DatabaseError
+from django.http import HttpRequest, HttpResponse
 from statusapp.views.helpers import is_ip_in_subnet, get_exit_policy, \
-        is_ipaddress, is_port
+        is_ipaddress, is_port, port_match
+from custom.snapshot import ConsensusSnapshot, SnapshotRelay, \
+        SNAPSHOT_FIELDS
+from custom.epoch import ConsensusEpoch
+from custom.resolver import HostnameResolver
+from custom.paginator import KeysetPaginator
+from statusapp.views.helpers import gen_list_dict
+from statusapp.views import graphs, pages
+from statusapp.views.pages import CURRENT_COLUMNS, AVAILABLE_COLUMNS
+from statusapp.views.rows import get_renderer, render_rows, \
+        stream_rows, stream_page, ROWS_PLACEHOLDER
+from custom.middleware import GZipMiddleware
+from custom.pagecache import page_key, page_etag, not_modified, \
+        get_page, set_page, set_redirect
+from custom.details import adjusted_uptime, details_key, fill_uptime, \
+        UPTIME_PLACEHOLDER
+from custom.addresses import address_to_int, ipv6_to_int, \
+        parse_address, parse_network, Network, AddressArray, IPV4, IPV6, \
+        MAX_ADDRESS, int_to_address, netmask, range_to_networks
+from custom.exitpolicy import compile_policy, get_policy, ExitIndex, \
+        stream_exit_list, summarize_policy, parse_summary, PortSummary
+from custom import dnsel
+from custom.dnsel import ExitListServer, resolve, DNSEL_ZONE, TYPE_A, \
+        NOERROR, NXDOMAIN, REFUSED
+from custom.graphstore import GraphStore
+from custom.graphrender import RenderPool, bar_graph, new_figure
+from custom.whois import WhoisPool, WhoisClient, NetblockCache, \
+        parse_whois, parse_networks, FAILED
+
+
+def snapshot_row(**values):
+    """
+    Build a row of values in the order of SNAPSHOT_FIELDS, with None
+    for every field that is not given.
+    """
+    row = dict([(field, None) for field in SNAPSHOT_FIELDS])
+    row.update(values)
+    return tuple([row[field] for field in SNAPSHOT_FIELDS])
 
 
 class IpInSubnetTest(django.test.TestCase):
@@ -16,6 +69,9 @@ class IpInSubnetTest(django.test.TestCase):
         """
         Test that the subnet bit, when provided, is handled correctly.
         """
+        self.assertEqual(is_ip_in_subnet('2001:db8::1', '2001:db8::/32'),
+                True)
+        self.assertEqual(is_ip_in_subnet('10.0.0.1', '::/0'), False)
         self.assertEqual(is_ip_in_subnet('0.0.0.0', '0.0.0.0/8'),
                 True)
         self.assertEqual(is_ip_in_subnet('0.255.255.255', '0.0.0.0/8'),
@@ -91,3 +147,1568 @@ class PortTest(django.test.TestCase):
         self.assertEqual(is_port('-1'), False)
         self.assertEqual(is_port('65535'), True)
         self.assertEqual(is_port('65536'), False)
+
+
+class AddressesTest(django.test.TestCase):
+    """
+    Test the parsing of addresses and networks of both versions, and
+    the membership of arrays of addresses.
+    """
+
+    def test_parse_address(self):
+        """
+        Test that addresses of both versions are parsed to integers,
+        and that malformed addresses are refused.
+        """
+        self.assertEqual(parse_address('1.2.3.4'), (IPV4, 0x01020304))
+        self.assertEqual(parse_address('::'), (IPV6, 0))
+        self.assertEqual(parse_address('[2001:db8::1]'),
+                         (IPV6, (0x20010db8 << 96) | 1))
+        self.assertEqual(ipv6_to_int('1:2:3:4:5:6:7:8'),
+                         0x00010002000300040005000600070008)
+        self.assertEqual(ipv6_to_int('::ffff:10.0.0.1'),
+                         0xffff0a000001)
+        for text in ('1.2.3', '1.2.3.256', '1.2.3.-4', 'a.b.c.d',
+                     '1::2::3', '1:2:3:4:5:6:7:8:9', '12345::', ':::'):
+            self.assertRaises(ValueError, parse_address, text)
+
+    def test_ranges(self):
+        """
+        Test that abbreviated addresses are only read when asked for,
+        and that ranges are split into the fewest networks.
+        """
+        self.assertRaises(ValueError, address_to_int, '200.0')
+        self.assertEqual(address_to_int('200.0', abbreviated=True),
+                         200 << 24)
+        self.assertEqual(int_to_address(0x0a000201), '10.0.2.1')
+        self.assertEqual(netmask(0), 0)
+        self.assertEqual(netmask(24), 0xffffff00)
+        self.assertEqual(range_to_networks(address_to_int('10.0.0.0'),
+                                           address_to_int('10.0.2.255')),
+                         ['10.0.0.0/23', '10.0.2.0/24'])
+        self.assertEqual(range_to_networks(0, MAX_ADDRESS[IPV4]),
+                         ['0.0.0.0/0'])
+        self.assertEqual(range_to_networks(1 << 112, (2 << 112) - 1,
+                                           IPV6),
+                         ['1:0:0:0:0:0:0:0/16'])
+
+    def test_parse_network(self):
+        """
+        Test that networks are parsed from bits, netmasks, and bare
+        addresses, and that their addresses are masked.
+        """
+        self.assertEqual(parse_network('10.1.2.3/8'),
+                         Network(IPV4, 0x0a000000, 0x0affffff))
+        self.assertEqual(parse_network('10.1.2.3/255.255.0.0'),
+                         Network(IPV4, 0x0a010000, 0x0a01ffff))
+        self.assertEqual(parse_network('10.1.2.3'),
+                         Network(IPV4, 0x0a010203, 0x0a010203))
+        self.assertEqual(parse_network('*'),
+                         Network(IPV4, 0, 0xffffffff))
+        self.assertEqual(parse_network('[2001:db8::]/32'),
+                         Network(IPV6, 0x20010db8 << 96,
+                                 (0x20010db9 << 96) - 1))
+        self.assertTrue('2001:db8:ffff::1' in
+                        parse_network('2001:db8::/32'))
+        self.assertFalse('10.0.0.1' in parse_network('::/0'))
+        for text in ('10.0.0.0/33', '::/129', '10.0.0.0/x', '10.0/8'):
+            self.assertRaises(ValueError, parse_network, text)
+
+    def test_members(self):
+        """
+        Test that the members of a network among an array of addresses
+        are those that the network contains one at a time.
+        """
+        texts = ['10.0.0.1', '10.0.1.0', '9.255.255.255', None, 'bogus',
+                 '2001:db8::1', '2001:db9::', '::a00:1',
+                 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff']
+        addresses = AddressArray(texts)
+        self.assertEqual(len(addresses), len(texts))
+        for network in ('10.0.0.0/24', '10.0.0.0/8', '0.0.0.0/0',
+                        '2001:db8::/32', '::/96', '::/0', '10.0.1.0',
+                        'ffff:ffff:ffff:ffff::/64', '2001:db8::1/128'):
+            network = parse_network(network)
+            self.assertEqual(list(network.members(addresses)),
+                             [text in network for text in texts])
+
+
+class ConsensusSnapshotTest(django.test.TestCase):
+    """
+    Test the filtering, searching, and sorting of a ConsensusSnapshot.
+    """
+
+    def setUp(self):
+        """
+        Build a snapshot of three relays, one of which is not in the
+        most recent consensus.
+        """
+        self.validafter = datetime.datetime(2011, 8, 1, 12)
+        earlier = self.validafter - datetime.timedelta(hours=1)
+        rows = [self.row(nickname='alpha', fingerprint='a' * 40,
+                         address='10.0.0.2', bandwidthkbps=50,
+                         isexit=True),
+                self.row(nickname='Beta', fingerprint='b' * 40,
+                         address='9.0.0.1', bandwidthkbps=None),
+                self.row(nickname='gamma', fingerprint='c' * 40,
+                         address='10.0.0.10', bandwidthkbps=500,
+                         isexit=True, validafter=earlier)]
+        self.snapshot = ConsensusSnapshot(self.validafter, rows)
+
+    def row(self, **values):
+        """
+        Build a row of values in the order of SNAPSHOT_FIELDS, in the
+        consensus of the snapshot unless another is given.
+        """
+        values.setdefault('validafter', self.validafter)
+        return snapshot_row(**values)
+
+    def test_latest(self):
+        """
+        Test that only relays in the most recent consensus are latest.
+        """
+        self.assertEqual(self.snapshot.latest, [0, 1])
+
+    def test_relays_at(self):
+        """
+        Test that the relays on an address are found whether or not
+        they are in the most recent consensus.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.relays_at(address_to_int('10.0.0.10')),
+                         [2])
+        self.assertEqual(snapshot.relays_at(address_to_int('9.0.0.1')),
+                         [1])
+        self.assertEqual(snapshot.relays_at(address_to_int('10.0.0.1')),
+                         [])
+
+    def test_filter(self):
+        """
+        Test that flags, lookups, and NULL values are filtered as the
+        database would filter them.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.filter({'isexit': 1}, [0, 1, 2]),
+                [0, 2])
+        self.assertEqual(snapshot.filter({'isexit': 0}, [0, 1, 2]), [1])
+        self.assertEqual(snapshot.filter({'bandwidthkbps__lt': '100'},
+                [0, 1, 2]), [0])
+        self.assertEqual(snapshot.filter({'nickname__icontains': 'ET'},
+                [0, 1, 2]), [1])
+        self.assertEqual(snapshot.filter({'bandwidthkbps__gt': 'fast'},
+                [0, 1, 2]), [])
+        self.assertEqual(snapshot.search('10.0', [0, 1, 2]), [0, 2])
+        self.assertEqual(snapshot.search('b', [0, 1, 2]), [1])
+
+    def test_search(self):
+        """
+        Test that a search matches the start of nicknames, fingerprints,
+        and addresses without regard to case, lists each relay once,
+        and only returns relays among those searched.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.search('A', [0, 1, 2]), [0])
+        self.assertEqual(snapshot.search('bBb', [0, 1, 2]), [1])
+        self.assertEqual(snapshot.search('10.0.0.1', [0, 1, 2]), [2])
+        self.assertEqual(snapshot.search('10.0', snapshot.latest), [0])
+        self.assertEqual(snapshot.search('10.0', [2]), [2])
+        self.assertEqual(snapshot.search('delta', [0, 1, 2]), [])
+
+    def test_search_network(self):
+        """
+        Test that a search for a network finds the relays on addresses
+        in it, rather than those whose addresses start with it.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.search('10.0.0.0/28', [0, 1, 2]),
+                         [0, 2])
+        self.assertEqual(snapshot.search('10.0.0.8/29', [0, 1, 2]), [2])
+        self.assertEqual(snapshot.search('10.0.0.0/8', snapshot.latest),
+                         [0])
+        self.assertEqual(snapshot.search('0.0.0.0/0', [0, 1, 2]),
+                         [0, 1, 2])
+        self.assertEqual(snapshot.search('::/0', [0, 1, 2]), [])
+        self.assertEqual(snapshot.search('10.0/x', [0, 1, 2]), [])
+
+    def test_order(self):
+        """
+        Test that text is sorted without regard to case, addresses are
+        sorted numerically, and NULL values are sorted last.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.order([2, 1, 0], 'nickname'), [0, 1, 2])
+        self.assertEqual(snapshot.order([0, 1, 2], 'address'), [1, 0, 2])
+        self.assertEqual(snapshot.order([0, 1, 2], 'bandwidthkbps'),
+                [0, 2, 1])
+        self.assertEqual(snapshot.order([0, 1, 2], '-bandwidthkbps'),
+                [1, 2, 0])
+
+    def test_family(self):
+        """
+        Test that family entries name relays by fingerprint, or by a
+        nickname that exactly one relay has.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.family(['$' + 'A' * 40, 'Beta', 'beta',
+                                          '$' + 'd' * 40, 'gamma']),
+                [('$' + 'A' * 40, 'a' * 40, 'alpha'),
+                 ('Beta', 'b' * 40, 'Beta'), ('beta', None, None),
+                 ('$' + 'd' * 40, None, None),
+                 ('gamma', 'c' * 40, 'gamma')])
+
+        snapshot = ConsensusSnapshot(self.validafter,
+                [self.row(nickname='twin', fingerprint='a' * 40),
+                 self.row(nickname='twin', fingerprint='b' * 40)])
+        self.assertEqual(snapshot.family(['twin']), [('twin', None, None)])
+
+    def test_results(self):
+        """
+        Test that results are searched, filtered, and sorted among the
+        relays in the most recent consensus, and kept per search,
+        filters, and order.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.results('', {}, '-nickname'), (1, 0))
+        self.assertEqual(snapshot.results('10.0', {}, 'nickname'), (0,))
+        self.assertEqual(snapshot.results('', {'isexit': 0}, 'nickname'),
+                (1,))
+        self.assertTrue(snapshot.results('', {'isexit': 1, 'isfast': 0},
+                                         'address') is
+                        snapshot.results('', {'isfast': 0, 'isexit': 1},
+                                         'address'))
+        self.assertFalse(snapshot.results('', {}, 'nickname') is
+                         snapshot.results('', {}, '-nickname'))
+
+
+class FilterMasksTest(django.test.TestCase):
+    """
+    Test that advanced searches evaluated as NumPy masks match the
+    relays that the same filters select one relay at a time.
+    """
+
+    def setUp(self):
+        self.validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index in range(40):
+            rows.append(snapshot_row(
+                    validafter=self.validafter,
+                    nickname='Relay%d' % index,
+                    fingerprint='%040X' % (index * 7919),
+                    address='10.0.%d.%d' % (index % 3, index),
+                    platform=('Tor on Linux', 'Tor on Windows XP',
+                              None)[index % 3],
+                    bandwidthkbps=index % 4 and index * 10 or None,
+                    published=self.validafter -
+                              datetime.timedelta(hours=index),
+                    isexit=index % 2 == 0, isfast=index % 3 == 0))
+        self.snapshot = ConsensusSnapshot(self.validafter, rows)
+
+    def expected(self, test, positions=None):
+        """
+        Select relays one at a time with a function of a relay.
+        """
+        if positions is None:
+            positions = self.snapshot.latest
+        return [position for position in positions
+                if test(SnapshotRelay(self.snapshot, position))]
+
+    def test_flags(self):
+        """
+        Test that flags that are set and flags that are not set are
+        combined with each other and with other lookups.
+        """
+        snapshot = self.snapshot
+        self.assertEqual(snapshot.filter({'isexit': 1, 'isfast': 0},
+                                         snapshot.latest),
+                self.expected(lambda relay: relay.isexit and
+                                            not relay.isfast))
+        self.assertEqual(snapshot.filter({'isexit': 0,
+                                          'bandwidthkbps__gt': '200'},
+                                         [39, 3, 35, 4]),
+                self.expected(lambda relay: not relay.isexit and
+                              relay.bandwidthkbps > 200, [3, 35, 39]))
+
+    def test_lookups(self):
+        """
+        Test text, integer, and timestamp lookups, including NULL
+        values and terms that cannot be compared.
+        """
+        snapshot = self.snapshot
+        latest = snapshot.latest
+        self.assertEqual(snapshot.filter({'platform__icontains': 'LINUX'},
+                                         latest),
+                self.expected(lambda relay: relay.platform and
+                              'linux' in relay.platform.lower()))
+        self.assertEqual(snapshot.filter({'platform__exact': 'None'},
+                                         latest), [])
+        self.assertEqual(snapshot.filter({'bandwidthkbps__contains': '0'},
+                                         latest),
+                self.expected(lambda relay: relay.bandwidthkbps is not None
+                              and '0' in str(relay.bandwidthkbps)))
+        self.assertEqual(snapshot.filter({'bandwidthkbps__lt': '50'},
+                                         latest), [1, 2, 3])
+        self.assertEqual(snapshot.filter({'bandwidthkbps__lt': 'x'},
+                                         latest), [])
+        self.assertEqual(snapshot.filter(
+                {'published__gt': '2011-08-01 09:00'}, latest), [0, 1, 2])
+        self.assertEqual(snapshot.filter({'nickname__istartswith': 'relay3',
+                                          'address__startswith': '10.0.0'},
+                                         latest), [3, 30, 33, 36, 39])
+
+    def test_empty(self):
+        """
+        Test that an empty snapshot can be filtered.
+        """
+        snapshot = ConsensusSnapshot(self.validafter, [])
+        self.assertEqual(snapshot.filter({'isexit': 1,
+                                          'nickname__contains': 'a'},
+                                         snapshot.latest), [])
+
+
+class KeysetPaginatorTest(django.test.TestCase):
+    """
+    Test that pages located by the relay before or after them match
+    the pages located by number.
+    """
+
+    def setUp(self):
+        """
+        Build a snapshot of ten relays whose bandwidths tie in pairs.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index in range(10):
+            rows.append(snapshot_row(validafter=validafter,
+                                     nickname='relay%d' % index,
+                                     fingerprint='%040X' % index,
+                                     bandwidthkbps=index // 2))
+        self.snapshot = ConsensusSnapshot(validafter, rows)
+
+    def paginator(self, order):
+        """
+        Paginate the latest relays three to a page in an order.
+        """
+        snapshot = self.snapshot
+        return KeysetPaginator(snapshot,
+                snapshot.order(snapshot.latest, order), order, 3)
+
+    def test_after(self):
+        """
+        Test that following the "next" links visits every relay once.
+        """
+        for order in ('bandwidthkbps', '-bandwidthkbps', 'nickname'):
+            paginator = self.paginator(order)
+            page = paginator.page(1)
+            visited = list(page.object_list)
+            while page.has_next():
+                page = paginator.page_after(page.last_key)
+                visited.extend(page.object_list)
+            self.assertEqual(visited, paginator.object_list)
+            self.assertEqual(page.number, paginator.num_pages)
+
+    def test_before(self):
+        """
+        Test that the "previous" link of a page leads to the relays
+        just before it.
+        """
+        paginator = self.paginator('-bandwidthkbps')
+        page = paginator.page_before(paginator.page(3).first_key)
+        self.assertEqual(page.object_list, paginator.page(2).object_list)
+        second = self.snapshot.value('fingerprint',
+                                     paginator.object_list[1])
+        page = paginator.page_after(second)
+        self.assertEqual(page.number, 2)
+        page = paginator.page_before(page.first_key)
+        self.assertEqual(page.number, 1)
+        self.assertEqual(page.object_list, paginator.page(1).object_list)
+
+    def test_missing(self):
+        """
+        Test that a relay that is not in the consensus leads to the
+        first page, and that out of range pages lead to the last page.
+        """
+        paginator = self.paginator('nickname')
+        self.assertEqual(paginator.page_after('F' * 40).number, 1)
+        self.assertEqual(paginator.page(99).number, 4)
+        self.assertEqual(paginator.page(99).object_list,
+                paginator.object_list[9:])
+
+
+class ConsensusEpochTest(django.test.TestCase):
+    """
+    Test that the validafter of the most recent consensus is only
+    queried again once it has expired or been invalidated.
+    """
+
+    def setUp(self):
+        """
+        Start counting the queries for the validafter.
+        """
+        self.queries = []
+
+    def fetch(self):
+        """
+        Query the validafter, which moves an hour on with every query.
+        """
+        self.queries.append(None)
+        return datetime.datetime(2010, 1, 1, len(self.queries))
+
+    def test_cached(self):
+        """
+        Test that the validafter is queried once while it is fresh.
+        """
+        epoch = ConsensusEpoch(self.fetch, 60)
+        self.assertEqual(epoch.validafter(),
+                datetime.datetime(2010, 1, 1, 1))
+        self.assertEqual(epoch.validafter(),
+                datetime.datetime(2010, 1, 1, 1))
+        self.assertEqual(len(self.queries), 1)
+
+    def test_invalidate(self):
+        """
+        Test that the validafter is queried again after a notification.
+        """
+        epoch = ConsensusEpoch(self.fetch, 60)
+        epoch.validafter()
+        epoch.invalidate()
+        self.assertEqual(epoch.validafter(),
+                datetime.datetime(2010, 1, 1, 2))
+        self.assertEqual(len(self.queries), 2)
+
+    def test_expired(self):
+        """
+        Test that the validafter is queried on every call without a ttl.
+        """
+        epoch = ConsensusEpoch(self.fetch, 0)
+        epoch.validafter()
+        epoch.validafter()
+        self.assertEqual(len(self.queries), 2)
+
+
+class HostnameResolverTest(django.test.TestCase):
+    """
+    Test that hostnames are looked up in the background, kept until
+    they expire, and that failed lookups are remembered.
+    """
+    def setUp(self):
+        self.lookups = []
+        self.stored = []
+        self.names = {'10.0.0.1': 'relay.example.com',
+                      '10.0.0.2': 'exit.example.net'}
+
+    def lookup(self, address):
+        """
+        Stand in for a reverse DNS lookup.
+        """
+        self.lookups.append(address)
+        if address not in self.names:
+            raise socket.herror(1, 'Unknown host')
+        return self.names[address]
+
+    def store(self, address, hostname, expires):
+        self.stored.append((address, hostname))
+
+    def test_lookup(self):
+        """
+        Test that a hostname is not waited for, and is known once the
+        lookup has finished.
+        """
+        resolver = HostnameResolver(self.lookup, 60, 60, 2, self.store)
+        self.assertEqual(resolver.hostname('10.0.0.1'), None)
+        resolver.wait()
+        self.assertEqual(resolver.hostname('10.0.0.1'),
+                         'relay.example.com')
+        self.assertEqual(self.lookups, ['10.0.0.1'])
+        self.assertEqual(self.stored, [('10.0.0.1', 'relay.example.com')])
+
+    def test_negative(self):
+        """
+        Test that a failed lookup is remembered until it expires.
+        """
+        resolver = HostnameResolver(self.lookup, 60, 60, 2)
+        self.assertEqual(resolver.refresh(['10.0.0.1', '10.0.0.3',
+                                           '10.0.0.3']), 2)
+        resolver.wait()
+        self.assertEqual(resolver.refresh(['10.0.0.1', '10.0.0.3']), 0)
+        self.assertEqual(resolver.hostname('10.0.0.3'), None)
+        self.assertEqual(resolver.hostnames(['10.0.0.1', '10.0.0.3']),
+                         {'10.0.0.1': 'relay.example.com'})
+        self.assertEqual(sorted(self.lookups), ['10.0.0.1', '10.0.0.3'])
+
+    def test_fetch(self):
+        """
+        Test that a hostname missing from memory is fetched, and that
+        an address that is not found is not fetched again until the
+        negative TTL has passed.
+        """
+        fetched = []
+        stored = {'10.0.0.2': [('10.0.0.2', 'exit.example.net',
+                                datetime.datetime(2031, 1, 1))]}
+
+        def fetch(address):
+            fetched.append(address)
+            return stored.get(address, [])
+
+        resolver = HostnameResolver(self.lookup, 60, 60, 0, fetch=fetch)
+        for number in range(3):
+            self.assertEqual(resolver.get('10.0.0.2'), 'exit.example.net')
+            self.assertEqual(resolver.get('10.0.0.3'), None)
+        self.assertEqual(fetched, ['10.0.0.2', '10.0.0.3'])
+
+        resolver = HostnameResolver(self.lookup, 60, 0, 0, fetch=fetch)
+        resolver.get('10.0.0.3')
+        resolver.get('10.0.0.3')
+        self.assertEqual(fetched, ['10.0.0.2', '10.0.0.3', '10.0.0.3',
+                                   '10.0.0.3'])
+
+    def test_expired(self):
+        """
+        Test that an expired hostname is still returned while it is
+        looked up again.
+        """
+        resolver = HostnameResolver(self.lookup, 0, 0, 1)
+        resolver.load([('10.0.0.2', 'old.example.net',
+                        datetime.datetime(2011, 1, 1))])
+        self.assertEqual(resolver.hostname('10.0.0.2'), 'old.example.net')
+        resolver.wait()
+        self.assertEqual(resolver.hostname('10.0.0.2'),
+                         'exit.example.net')
+
+    def test_snapshot(self):
+        """
+        Test that relays are sorted by hostname, with relays that have
+        no hostname last.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for address in ('10.0.0.3', '10.0.0.2', '10.0.0.1'):
+            rows.append(snapshot_row(validafter=validafter,
+                                     address=address,
+                                     fingerprint=address))
+        snapshot = ConsensusSnapshot(validafter, rows)
+        snapshot.set_hostnames(self.names)
+        self.assertEqual(snapshot.order(snapshot.latest, 'hostname'),
+                         [1, 2, 0])
+        self.assertEqual(SnapshotRelay(snapshot, 2).hostname,
+                         'relay.example.com')
+
+
+class RowRendererTest(django.test.TestCase):
+    """
+    Test that relay rows are rendered as index.html rendered them.
+    """
+
+    def relay(self, **values):
+        """
+        Build a relay dictionary as produced by gen_list_dict.
+        """
+        relay = {'isbadexit': 0, 'country': 'de', 'longitude': 13.4,
+                 'latitude': 52.5, 'nickname': 'relay',
+                 'bandwidthkbps': '20 KB/s', 'uptime': '3 d',
+                 'address': '10.0.0.1', 'hibernating': 0, 'orport': 9001,
+                 'dirport': 0, 'isnamed': 0, 'isexit': 0,
+                 'isauthority': 0, 'isfast': 0, 'isguard': 0,
+                 'isstable': 0, 'isv2dir': 0, 'platform': None,
+                 'fingerprint': 'A' * 40, 'published': None,
+                 'contact': None, 'isbaddirectory': 0}
+        relay.update(values)
+        return relay
+
+    def render(self, relays, columns):
+        """
+        Render relay dictionaries as table rows.
+        """
+        renderer = get_renderer(columns)
+        return renderer.render(renderer.project_dicts(relays))
+
+    def test_cells(self):
+        """
+        Test that values are escaped, that false values are displayed
+        as None, and that flags are displayed as images.
+        """
+        html = self.render([self.relay(nickname='<b>', contact='a & b',
+                                       isbadexit=1)],
+                           ['Router Name', 'Contact', 'DirPort',
+                            'BadExit', 'Named'])
+        self.assertTrue(html.startswith('<tr class="relayBadExit">'))
+        self.assertTrue('>&lt;b&gt;</a>' in html)
+        self.assertTrue('<td id="col_relayContact">a &amp; b</td>' in html)
+        self.assertTrue('<td id="col_relayDirPort">None</td>' in html)
+        self.assertTrue('alt="Bad Exit"' in html)
+        self.assertFalse('<b><a' in html)
+        self.assertFalse('col_relayNamed' in html)
+
+    def test_icons(self):
+        """
+        Test that only the icons among the current columns are shown,
+        in the order of ICONS, with the platform icon last.
+        """
+        html = self.render([self.relay(isexit=1, isfast=1, isnamed=1,
+                                       platform='Tor 0.2.2 on Linux')],
+                           ['Icons', 'Platform', 'Exit', 'Named',
+                            'Router Name'])
+        self.assertTrue('<b><a class="linkDetails"' in html)
+        self.assertFalse('Fast.png' in html)
+        self.assertTrue(html.index('Exit.png') <
+                        html.index('os-icons/Linux.png'))
+        self.assertTrue('title="Tor 0.2.2 on Linux"' in html)
+
+    def test_cached(self):
+        """
+        Test that a renderer is compiled once per tuple of columns.
+        """
+        self.assertTrue(get_renderer(['IP', 'Icons']) is
+                        get_renderer(('IP', 'Icons')))
+
+
+class StreamedIndexTest(django.test.TestCase):
+    """
+    Test that a streamed relay table matches a rendered one, and that
+    streamed responses are compressed as they are streamed.
+    """
+
+    def setUp(self):
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index in range(7):
+            rows.append(snapshot_row(
+                    validafter=validafter, nickname='relay%d' % index,
+                    fingerprint='%040X' % index, address='10.0.0.1',
+                    isexit=index % 2 == 0, bandwidthkbps=index,
+                    uptimedays=index or None))
+        self.snapshot = ConsensusSnapshot(validafter, rows)
+
+    def test_chunks(self):
+        """
+        Test that the rows are rendered in chunks, in order.
+        """
+        snapshot = self.snapshot
+        columns = ['Router Name', 'IP']
+        chunks = list(stream_rows(snapshot, snapshot.latest, columns,
+                                  chunk_size=3))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(u''.join(chunks), render_rows(
+                snapshot, snapshot.latest, columns))
+
+        page = u'<table>%s</table>' % ROWS_PLACEHOLDER
+        self.assertEqual(u''.join(stream_page(page, chunks)),
+                u'<table>%s</table>' % u''.join(chunks))
+        self.assertEqual(list(stream_page(u'<p>None</p>', chunks)),
+                         [u'<p>None</p>'])
+
+    def index(self, search):
+        """
+        Get the index page of all relays for a search of the snapshot.
+        """
+        request = HttpRequest()
+        request.GET['search'] = search
+        request.session = {'all': 1}
+        get_snapshot = pages.get_snapshot
+        pages.get_snapshot = lambda: self.snapshot
+        try:
+            return pages.index(request)
+        finally:
+            pages.get_snapshot = get_snapshot
+
+    def test_index(self):
+        """
+        Test that the index page of all relays streams its relay table,
+        and is rendered whole when no relay matches the search.
+        """
+        response = self.index('relay')
+        self.assertTrue(getattr(response, 'streaming', False))
+        html = ''.join(list(response))
+        self.assertTrue(ROWS_PLACEHOLDER not in html)
+        self.assertTrue('relay6' in html)
+
+        response = self.index('nosuchrelay')
+        self.assertFalse(getattr(response, 'streaming', False))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(ROWS_PLACEHOLDER not in response.content)
+        self.assertTrue('relay0' not in response.content)
+
+    def test_projection(self):
+        """
+        Test that rows projected from the snapshot hold the values of
+        the relay dictionaries that gen_list_dict produces.
+        """
+        snapshot = self.snapshot
+        renderer = get_renderer(CURRENT_COLUMNS + AVAILABLE_COLUMNS)
+        self.assertEqual(renderer.project(snapshot, snapshot.latest),
+                renderer.project_dicts(gen_list_dict(
+                    snapshot.relays(snapshot.latest))))
+        self.assertEqual(get_renderer([]).project(snapshot, [0, 1]),
+                         [(), ()])
+
+    def test_gzip(self):
+        """
+        Test that a streamed response is compressed lazily and that
+        it decompresses to the original content.
+        """
+        consumed = []
+
+        def content():
+            for chunk in ('<html>', 'x' * 500, '</html>'):
+                consumed.append(chunk)
+                yield chunk
+
+        request = HttpRequest()
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+        response = HttpResponse(content())
+        response.streaming = True
+        response = GZipMiddleware().process_response(request, response)
+        self.assertEqual(consumed, [])
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        data = ''.join(list(response))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(),
+                '<html>' + 'x' * 500 + '</html>')
+
+
+class PageCacheTest(django.test.TestCase):
+    """
+    Test the keys, ETags, and responses of the page cache.
+    """
+
+    def setUp(self):
+        self.validafter = datetime.datetime(2011, 8, 1, 12)
+        self.key = page_key('test', self.validafter,
+                            (u'search', {'isexit': 1, 'isfast': 0}))
+        self.request = HttpRequest()
+
+    def test_key(self):
+        """
+        Test that equal inputs give equal keys, and that a different
+        consensus gives a different key.
+        """
+        self.assertEqual(self.key, page_key('test', self.validafter,
+                ('search', {'isfast': 0, 'isexit': 1})))
+        self.assertNotEqual(self.key, page_key('test',
+                self.validafter + datetime.timedelta(hours=1),
+                (u'search', {'isexit': 1, 'isfast': 0})))
+
+    def test_not_modified(self):
+        """
+        Test that a client with the ETag of a page gets a 304.
+        """
+        self.assertEqual(not_modified(self.request, self.key), None)
+        self.request.META['HTTP_IF_NONE_MATCH'] = '"x", %s' % \
+                page_etag(self.key)
+        self.assertEqual(not_modified(self.request, self.key).status_code,
+                304)
+
+    def test_pages(self):
+        """
+        Test that stored pages are sent gzipped only to clients that
+        accept gzip, and that redirects are stored as redirects.
+        """
+        html = u'<html>%s</html>' % (u'relay ' * 100)
+        set_page(self.request, self.key, html)
+
+        response = get_page(self.request, self.key)
+        self.assertEqual(response.content, html)
+        self.assertEqual(response['ETag'], page_etag(self.key))
+
+        self.request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        response = get_page(self.request, self.key)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(
+                fileobj=StringIO(response.content)).read(), html)
+
+        set_redirect(self.key, '/details/' + 'A' * 40)
+        response = get_page(self.request, self.key)
+        self.assertEqual(response.status_code, 302)
+
+
+class DetailsCacheTest(django.test.TestCase):
+    """
+    Test the keys of cached details pages and the adjusted uptime that
+    is filled into them.
+    """
+
+    def test_key(self):
+        """
+        Test that a new consensus, descriptor, or hostname changes the
+        key of a page.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        key = details_key(validafter, 'a' * 40, 'b' * 40, None)
+        self.assertEqual(key, details_key(validafter, 'a' * 40, 'b' * 40,
+                                          None))
+        self.assertNotEqual(key, details_key(
+                validafter + datetime.timedelta(hours=1), 'a' * 40,
+                'b' * 40, None))
+        self.assertNotEqual(key, details_key(validafter, 'a' * 40,
+                                             'c' * 40, None))
+        self.assertNotEqual(key, details_key(validafter, 'a' * 40,
+                                             'b' * 40, 'relay.example'))
+
+    def test_uptime(self):
+        """
+        Test that the adjusted uptime counts the time since the
+        descriptor was published, and is only filled in where the page
+        holds the placeholder.
+        """
+        published = datetime.datetime(2011, 8, 1, 12)
+        self.assertEqual(adjusted_uptime(100, published,
+                published + datetime.timedelta(days=1, seconds=5)),
+                100 + 86400 + 5)
+
+        html = u'<td>%s</td>' % UPTIME_PLACEHOLDER
+        filled = fill_uptime(html, 100, datetime.datetime.now())
+        self.assertTrue(filled.startswith(u'<td>0 day(s), 0 hour(s), 1'))
+        self.assertEqual(fill_uptime(u'<td></td>', 100, None),
+                         u'<td></td>')
+
+
+class StandInWhoisHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers a WHOIS query with the answer its server has for it.
+    """
+
+    def handle(self):
+        query = self.rfile.readline().strip()
+        self.server.queries.append(query)
+        self.wfile.write(self.server.answers.get(query, ''))
+
+
+class TricklingWhoisHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers a WHOIS query one byte at a time, never pausing long enough
+    for a single read to time out.
+    """
+
+    def handle(self):
+        self.rfile.readline()
+        for number in xrange(50):
+            try:
+                self.wfile.write('%')
+                self.wfile.flush()
+            except socket.error:
+                return
+            time.sleep(0.1)
+
+
+class StandInWhoisServer(SocketServer.ThreadingTCPServer):
+    """
+    A WHOIS server on a free local port that answers from a dict of
+    queries to answers.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, answers, handler=StandInWhoisHandler):
+        SocketServer.ThreadingTCPServer.__init__(
+                self, ('127.0.0.1', 0), handler)
+        self.answers = answers
+        self.queries = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def address(self):
+        """
+        Get the (host, port) of the server.
+        """
+        return self.server_address
+
+
+class WhoisTest(django.test.TestCase):
+    """
+    Test the WHOIS client against stand-in WHOIS servers, the parsing of
+    their answers, and the cache of netblocks.
+    """
+
+    def setUp(self):
+        self.registry = StandInWhoisServer({
+                '10.1.2.3': 'inetnum:  10.1.0.0 - 10.1.255.255\n'
+                            'netname:  TEST-NET\n'
+                            'descr:    Test Networks\n'
+                            'origin:   AS64500\n'})
+        self.root = StandInWhoisServer({
+                '10.1.2.3': '%% referred\n'
+                            'refer:    whois://127.0.0.1:%d\n'
+                            'inetnum:  10.0.0.0 - 10.255.255.255\n'
+                            % self.registry.address()[1]})
+
+    def tearDown(self):
+        for server in (self.root, self.registry):
+            server.shutdown()
+            server.server_close()
+
+    def test_parse_networks(self):
+        """
+        Test that ranges and lists of networks are read as networks.
+        """
+        self.assertEqual(parse_networks('10.0.0.0 - 10.0.2.255'),
+                         ['10.0.0.0/23', '10.0.2.0/24'])
+        self.assertEqual(parse_networks('10.0.0.0/8, 10.1.2.3/16'),
+                         ['10.0.0.0/8', '10.1.0.0/16'])
+        self.assertEqual(parse_networks('200.0/16'), ['200.0.0.0/16'])
+        self.assertEqual(parse_networks('2001:db8::/32'), [])
+
+    def test_parse_whois(self):
+        """
+        Test that the fields of an ARIN answer are read.
+        """
+        fields = parse_whois('# ARIN WHOIS data\n'
+                             'NetRange:  192.0.2.0 - 192.0.2.255\n'
+                             'CIDR:      192.0.2.0/24\n'
+                             'NetName:   TEST-NET-1\n'
+                             'OriginAS:  AS64496\n'
+                             'OrgName:   Example Org\n'
+                             'ReferralServer: rwhois://rwhois.example:4321\n')
+        self.assertEqual(fields['networks'], ['192.0.2.0/24'])
+        self.assertEqual(fields['netname'], 'TEST-NET-1')
+        self.assertEqual(fields['org'], 'Example Org')
+        self.assertEqual(fields['asn'], 'AS64496')
+        self.assertEqual(fields['referral'], None)
+
+    def test_referral(self):
+        """
+        Test that the client follows a referral to the registry.
+        """
+        client = WhoisClient(self.root.address(), 5)
+        text, fields = client.query('10.1.2.3')
+        self.assertTrue('TEST-NET' in text)
+        self.assertEqual(fields['networks'], ['10.1.0.0/16'])
+        self.assertEqual(fields['org'], 'Test Networks')
+        self.assertEqual(self.root.queries, ['10.1.2.3'])
+        self.assertEqual(self.registry.queries, ['10.1.2.3'])
+
+    def test_deadline(self):
+        """
+        Test that a lookup times out as a whole, even when the server
+        keeps sending.
+        """
+        server = StandInWhoisServer({}, TricklingWhoisHandler)
+        try:
+            client = WhoisClient(server.address(), 0.5)
+            started = time.time()
+            self.assertRaises(socket.timeout, client.query, '10.1.2.3')
+            self.assertTrue(time.time() - started < 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_netblocks(self):
+        """
+        Test that a netblock answers every address that it covers, and
+        that the most specific unexpired netblock is used.
+        """
+        stored = []
+        netblocks = NetblockCache(60, store=stored.append)
+        client = WhoisClient(self.root.address(), 5)
+        text, fields = client.query('10.1.2.3')
+        record = netblocks.add('10.1.2.3', text, fields)
+        self.assertEqual(record.network, '10.1.0.0/16')
+        self.assertEqual(stored, [record])
+        self.assertEqual(netblocks.get('10.1.200.7'), record)
+        self.assertEqual(netblocks.get('10.2.0.1'), None)
+
+        fields = parse_whois('CIDR: 10.1.2.0/24\nNetName: SMALL\n')
+        small = netblocks.add('10.1.2.9', 'small', fields)
+        self.assertEqual(netblocks.get('10.1.2.200'), small)
+        self.assertEqual(netblocks.get('10.1.3.1'), record)
+
+        small.expires = datetime.datetime.now()
+        self.assertEqual(netblocks.get('10.1.2.200'), record)
+
+    def test_missing_netblock(self):
+        """
+        Test that an address that no stored netblock covers is not
+        loaded again until its miss expires.
+        """
+        loaded = []
+
+        def load(address):
+            loaded.append(address)
+            return None
+
+        netblocks = NetblockCache(60, load=load, miss_ttl=60)
+        for number in range(3):
+            self.assertEqual(netblocks.get('10.1.2.3'), None)
+        self.assertEqual(loaded, ['10.1.2.3'])
+        fields = parse_whois('CIDR: 10.1.0.0/16\n')
+        record = netblocks.add('10.1.2.3', 'found', fields)
+        self.assertEqual(netblocks.get('10.1.2.3'), record)
+
+        netblocks = NetblockCache(60, load=load)
+        netblocks.get('10.1.2.3')
+        self.assertEqual(loaded, ['10.1.2.3', '10.1.2.3'])
+
+    def test_foreign_network(self):
+        """
+        Test that a server is only trusted for networks that cover the
+        address that was looked up.
+        """
+        netblocks = NetblockCache(60)
+        fields = parse_whois('CIDR: 10.9.0.0/16\n')
+        record = netblocks.add('10.1.2.3', 'foreign', fields)
+        self.assertEqual(record.network, '10.1.2.3/32')
+        self.assertEqual(netblocks.get('10.9.0.1'), None)
+
+
+class WhoisPoolTest(django.test.TestCase):
+    """
+    Test that whois lookups run in the background and are not run twice
+    at once for the same address.
+    """
+
+    def setUp(self):
+        self.lookups = []
+        self.release = threading.Event()
+
+    def lookup(self, address):
+        """
+        Look up an address, waiting for the test to allow it.
+        """
+        self.lookups.append(address)
+        self.release.wait(5)
+        return 'netname: TEST-%s' % address
+
+    def test_lookup(self):
+        """
+        Test that a lookup is waited for.
+        """
+        self.release.set()
+        pool = WhoisPool(self.lookup, 2)
+        self.assertEqual(pool.submit('10.0.0.1', 5),
+                         'netname: TEST-10.0.0.1')
+        self.assertEqual(self.lookups, ['10.0.0.1'])
+
+    def test_pending(self):
+        """
+        Test that a slow lookup is pending, and is run once however
+        often it is requested.
+        """
+        pool = WhoisPool(self.lookup, 2)
+        self.assertEqual(pool.submit('10.0.0.9'), None)
+        self.assertEqual(pool.submit('10.0.0.9', 0.1), None)
+        self.release.set()
+        self.assertEqual(pool.submit('10.0.0.9', 5),
+                         'netname: TEST-10.0.0.9')
+        self.assertEqual(self.lookups, ['10.0.0.9'])
+
+    def test_error(self):
+        """
+        Test that a lookup that raises is answered as failed, and that
+        its thread goes on to run the next lookup.
+        """
+        def lookup(address):
+            if address == '10.0.0.66':
+                raise RuntimeError('the database is down')
+            return self.lookup(address)
+
+        self.release.set()
+        pool = WhoisPool(lookup, 1)
+        whois = pool.submit('10.0.0.66', 5)
+        self.assertEqual(whois.network, '10.0.0.66/32')
+        self.assertEqual(whois.whois, FAILED)
+        self.assertEqual(pool.submit('10.0.0.1', 5),
+                         'netname: TEST-10.0.0.1')
+
+    def test_keep(self):
+        """
+        Test that the result of a lookup that nobody waited for is kept
+        for the next request only, even if it failed.
+        """
+        def lookup(address):
+            if address == '10.0.0.66':
+                self.lookups.append(address)
+                return FAILED
+            return self.lookup(address)
+
+        self.release.set()
+        pool = WhoisPool(lookup, 1, keep=60)
+        self.assertEqual(pool.submit('10.0.0.66'), None)
+        # The only thread looks 10.0.0.1 up after 10.0.0.66.
+        pool.submit('10.0.0.1', 5)
+        self.assertEqual(pool.submit('10.0.0.66'), FAILED)
+        self.assertEqual(self.lookups, ['10.0.0.66', '10.0.0.1'])
+        self.assertEqual(pool.submit('10.0.0.66', 5), FAILED)
+        self.assertEqual(pool.submit('10.0.0.1', 5),
+                         'netname: TEST-10.0.0.1')
+        self.assertEqual(self.lookups, ['10.0.0.66', '10.0.0.1',
+                                        '10.0.0.66', '10.0.0.1'])
+
+
+class GraphStoreTest(django.test.TestCase):
+    """
+    Test the storing, loading, and purging of rendered graphs.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = GraphStore(os.path.join(self.directory, 'graphs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        """
+        Test that a graph is loaded as it was saved, under its name and
+        consensus, and that saving it again replaces it.
+        """
+        store = self.store
+        self.assertEqual(store.load('byplatform', '20110801120000'), None)
+        store.save('byplatform', '20110801120000', '\x89PNG one')
+        store.save('byplatform', '20110801120000', '\x89PNG two')
+        self.assertEqual(store.load('byplatform', '20110801120000'),
+                         '\x89PNG two')
+        self.assertEqual(store.load('byplatform', '20110801130000'), None)
+        self.assertEqual(store.load('bycountrycode', '20110801120000'),
+                         None)
+        self.assertEqual(os.listdir(store.directory),
+                         ['byplatform-20110801120000.png'])
+
+    def test_purge(self):
+        """
+        Test that only the graphs of the kept consensus remain.
+        """
+        store = self.store
+        self.assertEqual(store.purge('20110801130000'), 0)
+        for key in ('20110801120000', '20110801130000'):
+            for name in ('byplatform', 'bycountrycode'):
+                store.save(name, key, name + key)
+        self.assertEqual(store.purge('20110801130000'), 2)
+        self.assertEqual(sorted(os.listdir(store.directory)),
+                         ['bycountrycode-20110801130000.png',
+                          'byplatform-20110801130000.png'])
+        self.assertEqual(store.load('byplatform', '20110801130000'),
+                         'byplatform20110801130000')
+
+
+class GraphRenderTest(django.test.TestCase):
+    """
+    Test that graphs are drawn with their own layout, in the calling
+    thread or in a pool of processes.
+    """
+    PARAMS = {'WIDTH': 480, 'HEIGHT': 320, 'TOP_MARGIN': 25,
+              'BOTTOM_MARGIN': 64, 'LEFT_MARGIN': 38,
+              'RIGHT_MARGIN': 5, 'X_FONT_SIZE': '8',
+              'Y_FONT_SIZE': '9', 'LABEL_FONT_SIZE': '8',
+              'LABEL_FLOAT': 3, 'LABEL_ROT': 'vertical',
+              'FONT_WEIGHT': 'bold', 'BAR_WIDTH': 0.5,
+              'COLOR': '#005500', 'TITLE': 'Test'}
+
+    def test_layout(self):
+        """
+        Test that the margins of a figure are its own, and that the
+        defaults of matplotlib are left alone.
+        """
+        defaults = dict([(name, matplotlib.rcParams[name])
+                         for name in matplotlib.rcParams
+                         if name.startswith('figure.subplot.')])
+        fig = new_figure(400, 200, 20, 40, 100, 40)
+        self.assertAlmostEqual(fig.subplotpars.left, 0.25)
+        self.assertAlmostEqual(fig.subplotpars.right, 0.9)
+        self.assertAlmostEqual(fig.subplotpars.top, 0.9)
+        self.assertAlmostEqual(fig.subplotpars.bottom, 0.2)
+        bar_graph([0, 1], [3, 4], ['a', 'b'], self.PARAMS)
+        for name, value in defaults.iteritems():
+            self.assertEqual(matplotlib.rcParams[name], value)
+
+    def test_inline(self):
+        """
+        Test that a pool without processes draws in the calling thread.
+        """
+        pool = RenderPool(0, 60)
+        graph = pool.submit(bar_graph, [0, 1], [3, 4], ['a', 'b'],
+                            self.PARAMS)
+        self.assertTrue(graph.get().startswith('\x89PNG'))
+
+    def test_processes(self):
+        """
+        Test that graphs submitted together are drawn by the processes
+        of the pool as they are in the calling thread.
+        """
+        pool = RenderPool(2, 60)
+        try:
+            graphs = [pool.submit(bar_graph, range(count), range(count),
+                                  map(str, range(count)), self.PARAMS)
+                      for count in (1, 2, 3)]
+            for count, graph in zip((1, 2, 3), graphs):
+                self.assertEqual(graph.get(),
+                                 bar_graph(range(count), range(count),
+                                           map(str, range(count)),
+                                           self.PARAMS))
+        finally:
+            pool.close()
+
+    def test_timed_out(self):
+        """
+        Test that a graph that is not drawn in time is answered with a
+        503 response rather than an error.
+        """
+        class Graph(object):
+            def get(self):
+                raise multiprocessing.TimeoutError()
+
+        draw_line_graph = graphs.draw_line_graph
+        graphs.draw_line_graph = lambda *args: Graph()
+        try:
+            response = graphs.readhist(HttpRequest(), 'F' * 40)
+        finally:
+            graphs.draw_line_graph = draw_line_graph
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'],
+                         str(graphs.GRAPH_RETRY_AFTER))
+
+
+class CompiledPolicyTest(django.test.TestCase):
+    """
+    Test that compiled exit policies decide as the exit node query did
+    when it parsed each line with is_ip_in_subnet and port_match.
+    """
+
+    def allows(self, lines, ip, port):
+        """
+        Decide whether a policy allows exiting to ip and port, as the
+        exit node query used to.
+        """
+        for line in lines:
+            condition, network_line = line.strip().split(' ')
+            subnet, port_line = network_line.split(':')
+            if is_ip_in_subnet(ip, subnet) and port_match(port, port_line):
+                return condition == 'accept'
+        return False
+
+    def random_address(self, generator):
+        """
+        Pick an address, favouring the edges of the octets.
+        """
+        return '.'.join([str(generator.choice((0, 10, 127, 128, 255,
+                                               generator.randint(0, 255))))
+                         for octet in xrange(4)])
+
+    def random_line(self, generator):
+        """
+        Make up an accept or reject line of an exit policy.
+        """
+        subnet = generator.choice(('*', self.random_address(generator),
+                                   '%s/%d' % (self.random_address(generator),
+                                              generator.randint(0, 32))))
+        first = generator.choice((22, 80, 443, generator.randint(1, 65535)))
+        last = generator.randint(first, 65535)
+        ports = generator.choice(('*', str(first), '%d-%d' % (first, last)))
+        return '%s %s:%s' % (generator.choice(('accept', 'reject')),
+                             subnet, ports)
+
+    def test_differential(self):
+        """
+        Test random policies against random destinations.
+        """
+        generator = random.Random(16)
+        for trial in xrange(300):
+            lines = [self.random_line(generator)
+                     for line in xrange(generator.randint(0, 12))]
+            policy = compile_policy(lines)
+            self.assertEqual(len(policy), len(lines))
+            for destination in xrange(20):
+                if destination % 4 == 0 and lines:
+                    # Aim at the subnet of one of the lines.
+                    subnet = generator.choice(lines).split(' ')[1]
+                    subnet = subnet.split(':')[0].split('/')[0]
+                    ip = subnet == '*' and '1.2.3.4' or subnet
+                else:
+                    ip = self.random_address(generator)
+                port = str(generator.choice((22, 80, 443,
+                                             generator.randint(1, 65535))))
+                self.assertEqual(
+                        policy.allows(address_to_int(ip), int(port)),
+                        self.allows(lines, ip, port),
+                        '%r %s:%s' % (lines, ip, port))
+
+    def test_lines(self):
+        """
+        Test netmasks, unparsable lines, and the digest cache.
+        """
+        policy = compile_policy(['reject 10.0.0.0/255.0.0.0:*',
+                                 'accept6 [::]/0:*', 'accept *:80-81',
+                                 'reject *:*'])
+        self.assertEqual(len(policy), 3)
+        self.assertFalse(policy.allows(address_to_int('10.1.1.1'), 80))
+        self.assertTrue(policy.allows(address_to_int('11.1.1.1'), 81))
+        self.assertFalse(policy.allows(address_to_int('11.1.1.1'), 82))
+
+        policy = get_policy('digest', ['accept *:*'])
+        self.assertTrue(get_policy('digest', ['reject *:*']) is policy)
+
+    def test_exit_index(self):
+        """
+        Test that the exit index finds exactly the relays whose
+        policies accept each destination.
+        """
+        generator = random.Random(17)
+        shared = [self.random_line(generator) for line in xrange(8)]
+        policies = []
+        for position in xrange(60):
+            if position % 3 == 0:
+                lines = shared
+            else:
+                lines = [self.random_line(generator)
+                         for line in xrange(generator.randint(0, 10))]
+            policies.append((position, compile_policy(lines)))
+        index = ExitIndex(policies)
+
+        for destination in xrange(300):
+            address = address_to_int(self.random_address(generator))
+            port = generator.choice((22, 80, 443, 65535,
+                                     generator.randint(1, 65535)))
+            self.assertEqual(index.exits(address, port),
+                             [position for position, policy in policies
+                              if policy.allows(address, port)])
+
+    def test_summarize_policy(self):
+        """
+        Test that ports are summarized as accepted when only private
+        networks or a few hosts are rejected, and that the shorter of
+        the accepted and rejected lists is written.
+        """
+        summary = summarize_policy(compile_policy([
+                'reject 10.0.0.0/8:*', 'reject 1.2.3.4:*',
+                'accept *:80', 'accept *:443', 'accept 5.6.0.0/16:22',
+                'reject *:*']))
+        self.assertEqual(str(summary), 'accept 80,443')
+        self.assertTrue(summary.allows(80))
+        self.assertFalse(summary.allows(22))
+
+        summary = summarize_policy(compile_policy([
+                'reject *:25', 'reject 0.0.0.0/1:119', 'accept *:*']))
+        self.assertEqual(str(summary), 'reject 25,119')
+        self.assertFalse(summary.allows(25))
+        self.assertTrue(summary.allows(0) and summary.allows(65535))
+
+        self.assertEqual(str(summarize_policy(compile_policy([]))),
+                         'reject 1-65535')
+        self.assertEqual(str(summarize_policy(compile_policy(
+                ['accept *:1-1000', 'accept *:1001-65535']))),
+                'accept 1-65535')
+
+        self.assertEqual(parse_summary('reject 25,119'),
+                         PortSummary(False, [(25, 25), (119, 119)]))
+        self.assertRaises(ValueError, parse_summary, 'allow 80')
+        self.assertRaises(ValueError, parse_summary, 'accept 80-x')
+
+
+
+class SnapshotExitsTest(django.test.TestCase):
+    """
+    Test the exits that the consensus snapshot lists for a destination.
+    """
+
+    def test_snapshot_exits(self):
+        """
+        Test that only running relays in the most recent consensus are
+        listed as exits.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index, (running, hours) in enumerate(((True, 0), (False, 0),
+                                                  (True, 1))):
+            rows.append(snapshot_row(
+                    fingerprint=str(index) * 40, isrunning=running,
+                    validafter=validafter -
+                               datetime.timedelta(hours=hours)))
+        snapshot = ConsensusSnapshot(validafter, rows)
+        policy = compile_policy(['accept *:80', 'reject *:*'])
+        snapshot.set_policies({'0' * 40: policy, '1' * 40: policy,
+                               '2' * 40: policy})
+        self.assertEqual(snapshot.exits(address_to_int('1.2.3.4'), 80),
+                         [0])
+        self.assertEqual(snapshot.exits(address_to_int('1.2.3.4'), 81),
+                         [])
+
+    def test_exit_list(self):
+        """
+        Test that destinations that every policy treats alike share an
+        exit list, and that a batch is checked against it.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index in xrange(3):
+            rows.append(snapshot_row(fingerprint=str(index) * 40,
+                                     isrunning=True,
+                                     address='10.0.0.%d' % index,
+                                     validafter=validafter))
+        snapshot = ConsensusSnapshot(validafter, rows)
+        snapshot.set_policies({
+                '0' * 40: compile_policy(['accept *:*']),
+                '1' * 40: compile_policy(['reject 1.2.3.0/24:*',
+                                          'accept *:443']),
+                '2' * 40: compile_policy(['reject *:*'])})
+
+        exits = snapshot.exit_list(address_to_int('5.6.7.8'), 443)
+        self.assertEqual(sorted(exits.values()), ['10.0.0.0', '10.0.0.1'])
+        self.assertTrue(snapshot.exit_list(address_to_int('9.9.9.9'), 443)
+                        is exits)
+        self.assertEqual(snapshot.exit_list(address_to_int('1.2.3.4'),
+                                            443).values(), ['10.0.0.0'])
+
+        lines = ['10.0.0.2, 10.0.0.1\n', 'junk 10.0.0.0', '', '10.0.0.1']
+        self.assertEqual(''.join(stream_exit_list(exits, lines, 2)),
+                         '10.0.0.1\n10.0.0.0\n10.0.0.1\n')
+
+
+class ExitPortFilterTest(django.test.TestCase):
+    """
+    Test the advanced search for relays by the exit ports of their
+    summaries.
+    """
+
+    def test_exit_port_filter(self):
+        """
+        Test that the advanced search for exits to a port matches the
+        relays whose summaries allow the port.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index in xrange(4):
+            rows.append(snapshot_row(
+                    fingerprint=str(index) * 40, validafter=validafter,
+                    descriptor=index < 3 and 'd%d' % index or None))
+        snapshot = ConsensusSnapshot(validafter, rows)
+        snapshot.set_summaries({
+                'd0': parse_summary('accept 80,443'),
+                'd1': parse_summary('reject 25'),
+                'd2': parse_summary('accept 80,443')})
+
+        self.assertEqual(snapshot.filter({'exitport__exact': '80'},
+                                         snapshot.latest), [0, 1, 2])
+        self.assertEqual(snapshot.filter({'exitport__exact': '25'},
+                                         snapshot.latest), [])
+        self.assertEqual(snapshot.filter({'exitport__exact': '22'},
+                                         snapshot.latest), [1])
+        self.assertEqual(snapshot.filter({'exitport__exact': 'ssh'},
+                                         snapshot.latest), [])
+        self.assertEqual(snapshot.filter({'exitport__gt': '22'},
+                                         snapshot.latest), [])
+
+
+class PortCoverageTest(django.test.TestCase):
+    """
+    Test the exits and exit bandwidth that the consensus snapshot
+    counts for every port.
+    """
+
+    def test_port_coverage(self):
+        """
+        Test that the exits and exit bandwidth of every port add up the
+        running relays in the most recent consensus whose summaries
+        allow the port.
+        """
+        validafter = datetime.datetime(2011, 8, 1, 12)
+        rows = []
+        for index, (running, hours) in enumerate(((True, 0), (True, 0),
+                                                  (True, 0), (False, 0),
+                                                  (True, 1))):
+            rows.append(snapshot_row(
+                    fingerprint=str(index) * 40,
+                    descriptor='d%d' % index, isrunning=running,
+                    bandwidthobserved=index < 2 and 1000 or None,
+                    validafter=validafter -
+                               datetime.timedelta(hours=hours)))
+        snapshot = ConsensusSnapshot(validafter, rows)
+        snapshot.set_summaries({'d0': parse_summary('accept 80,443'),
+                                'd1': parse_summary('reject 25,80-90'),
+                                'd2': parse_summary('accept 80,443'),
+                                'd3': parse_summary('accept 1-65535'),
+                                'd4': parse_summary('accept 1-65535')})
+
+        counts, bandwidths = snapshot.port_coverage()
+        self.assertEqual(len(counts), 65536)
+        for port, count, bandwidth in ((0, 0, 0), (1, 1, 1000),
+                                       (25, 0, 0), (80, 2, 1000),
+                                       (443, 3, 2000), (65535, 1, 1000)):
+            self.assertEqual((counts[port], bandwidths[port]),
+                             (count, bandwidth))
+        self.assertTrue(snapshot.port_coverage()[0] is counts)
+
+
+class ExitListServerTest(django.test.TestCase):
+    """
+    Test the DNS exit list responder with a local resolver client.
+    """
+
+    def setUp(self):
+        self.questions = []
+        self.server = ExitListServer(('127.0.0.1', 0), self.is_exit)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def is_exit(self, client, port, destination):
+        """
+        Let 10.0.0.1 exit to port 443 of every destination.
+        """
+        self.questions.append((client, port, destination))
+        return client == '10.0.0.1' and port == 443
+
+    def ask(self, name, kind=TYPE_A):
+        return resolve(self.server.server_address, name, kind, 5)
+
+    def test_answers(self):
+        """
+        Test that exits are answered with 127.0.0.2 and other clients
+        with NXDOMAIN.
+        """
+        self.assertEqual(self.ask('1.0.0.10.443.8.7.6.5.' + DNSEL_ZONE),
+                         (NOERROR, ['127.0.0.2']))
+        self.assertEqual(self.questions, [('10.0.0.1', 443, '5.6.7.8')])
+        self.assertEqual(self.ask('1.0.0.10.80.8.7.6.5.' + DNSEL_ZONE),
+                         (NXDOMAIN, []))
+        self.assertEqual(self.ask('2.0.0.10.443.8.7.6.5.' + DNSEL_ZONE),
+                         (NXDOMAIN, []))
+        self.assertEqual(self.ask('1.0.0.10.443.8.7.6.5.' +
+                                  DNSEL_ZONE.upper(), 16),
+                         (NOERROR, []))
+
+    def test_bad_names(self):
+        """
+        Test that names outside the zone are refused and malformed
+        names are not found.
+        """
+        self.assertEqual(self.ask('www.example.com'), (REFUSED, []))
+        self.assertEqual(self.ask('1.0.0.10.443.' + DNSEL_ZONE),
+                         (NXDOMAIN, []))
+        self.assertEqual(self.ask('1.0.0.10.0.8.7.6.5.' + DNSEL_ZONE),
+                         (NXDOMAIN, []))
+        self.assertEqual(self.ask(DNSEL_ZONE), (NOERROR, []))
+        self.assertEqual(self.questions, [])
+
+    def test_snapshot_closes_connection(self):
+        """
+        Test that answering from the snapshot closes the database
+        connection, so that no transaction is left open, even when the
+        snapshot cannot be built.
+        """
+        class Connection(object):
+            closed = 0
+
+            def close(self):
+                self.closed += 1
+
+        class Snapshot(object):
+            def exit_list(self, destination, port):
+                return [address_to_int('10.0.0.1')]
+
+        def broken():
+            raise DatabaseError('no snapshot')
+
+        snapshots = [lambda: Snapshot(), broken]
+        original = dnsel.get_snapshot, dnsel.db_connection
+        dnsel.get_snapshot = lambda: snapshots.pop(0)()
+        dnsel.db_connection = Connection()
+        try:
+            self.assertTrue(dnsel.snapshot_is_exit('10.0.0.1', 443,
+                                                   '5.6.7.8'))
+            self.assertEqual(dnsel.db_connection.closed, 1)
+            self.assertRaises(DatabaseError, dnsel.snapshot_is_exit,
+                              '10.0.0.1', 443, '5.6.7.8')
+            self.assertEqual(dnsel.db_connection.closed, 2)
+        finally:
+            dnsel.get_snapshot, dnsel.db_connection = original
@@ -16,6 +16,7 @@ urlpatterns = patterns('',
     (r'^index/$', 'statusapp.views.pages.index'),
     (r'^display-options/$', 'statusapp.views.pages.display_options'),
     (r'^exit-node-query/$', 'statusapp.views.pages.exitnodequery'),
+    (r'^exit-list/$', 'statusapp.views.pages.exitlist'),
 
     # Details Page
     (r'^details/(?P<fingerprint>\w{40})$', 'statusapp.views.pages.details'),
@@ -47,6 +48,10 @@ urlpatterns = patterns('',
         'statusapp.views.graphs.byplatform'),
     (r'^network-statistic-graphs/networktotalbw.png$',
         'statusapp.views.graphs.networktotalbw'),
+    (r'^network-statistic-graphs/exitports.png$',
+        'statusapp.views.graphs.exitports'),
+    (r'^network-statistic-graphs/exitports.json$',
+        'statusapp.views.graphs.exitportsjson'),
 
     # CSV Files
     (r'^tor-query-export.csv$', 'statusapp.views.csvs.current_results_csv'),
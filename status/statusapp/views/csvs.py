@@ -5,13 +5,12 @@ There is one function for each link.
 """
 # Django-specific import statements -----------------------------------
 from django.http import HttpResponse
-from django.db.models import Max
 
 # CSV specific import statements
 import csv
 
 # TorStatus specific import statements --------------------------------
-from statusapp.models import ActiveRelay
+from custom.snapshot import get_snapshot
 from helpers import *
 from pages import *
 
@@ -27,7 +26,7 @@ def current_results_csv(request):
     @return: csv formatted current queryset
     """
     current_columns = request.session['currentColumns']
-    undisplayed_columns = ['Hostname', 'Valid', 'Running', 'Named']
+    undisplayed_columns = ['Valid', 'Running', 'Named']
 
     # Don't provide certain flag information in the csv
     for column in undisplayed_columns:
@@ -41,10 +40,7 @@ def current_results_csv(request):
     elif "Icons" in current_columns:
         current_columns.remove("Icons")
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-    active_relays = ActiveRelay.objects.filter(
-                    validafter=last_va).order_by('nickname')
+    snapshot = get_snapshot()
 
     # Filter the results set using the provided search filters in
     # the session
@@ -55,16 +51,9 @@ def current_results_csv(request):
     # We should never have both basic_input and advanced_input
     assert not (basic_input and advanced_input)
 
-    if basic_input:
-        active_relays = active_relays.filter(
-                        Q(nickname__istartswith=basic_input) | \
-                        Q(fingerprint__istartswith=basic_input) | \
-                        Q(address__istartswith=basic_input)).order_by(
-                        order)
-    else:
-        filter_params = get_filter_params(request)
-        active_relays = active_relays.filter(
-                        **filter_params).order_by(order)
+    if not basic_input:
+        advanced_input = get_filter_params(request)
+    active_relays = snapshot.results(basic_input, advanced_input, order)
 
     # Create the HttpResponse object with the appropriate CSV header
     response = HttpResponse(mimetype='text/csv')
@@ -78,20 +67,18 @@ def current_results_csv(request):
     for column in current_columns: rows[column] = []
 
     # Populates the row dictionary with all field values
-    for relay in active_relays:
+    for relay in snapshot.relays(active_relays):
         fields_access = [
                 ("Router Name", relay.nickname),
                 ("Country Code", relay.country),
                 ("Latitude", relay.latitude),
                 ("Longitude", relay.longitude),
-                ("Exit Policy", relay.exitpolicy),
                 ("Contact", relay.contact),
-                ("Onion Key", relay.onionkey),
-                ("Signing Key", relay.signingkey),
                 ("Family", relay.family),
                 ("Bandwidth", relay.bandwidthobserved),
                 ("Uptime", relay.uptime),
                 ("IP", relay.address),
+                ("Hostname", relay.hostname),
                 ("Fingerprint", relay.fingerprint),
                 ("Last Descriptor Published", relay.published),
                 ("BadDir", relay.isbaddirectory),
@@ -42,7 +42,8 @@ SEARCH_OPTIONS_FIELDS_ORDER = ['Fingerprint', 'Router Name',
                             'Country Code', 'Bandwidth (kb/s)',
                             'Uptime (days)', 'Last Descriptor Published',
                             'IP Address', 'Onion Router Port',
-                            'Directory Server Port', 'Platform']
+                            'Directory Server Port', 'Platform',
+                            'Exit Port']
 SEARCH_OPTIONS_FIELDS = {'Fingerprint': 'fingerprint',
                          'Router Name': 'nickname',
                          'Country Code': 'country',
@@ -54,6 +55,7 @@ SEARCH_OPTIONS_FIELDS = {'Fingerprint': 'fingerprint',
                          'Onion Router Port': 'orport',
                          'Directory Server Port': 'dirport',
                          'Platform': 'platform',
+                         'Exit Port': 'exitport',
                         }
 
 SEARCH_OPTIONS_FIELDS_BOOLEANS = {
@@ -85,6 +87,7 @@ SEARCH_OPTIONS_FIELDS_BOOLEANS = {
                                   'Is Less Than',
                                   'Is Greater Than',],
         'Platform': ['Contains (case insensitive)',],
+        'Exit Port': ['Is Allowed',],
        }
 
 SEARCH_OPTIONS_BOOLEANS_ORDER = ['Equals',
@@ -100,6 +103,7 @@ SEARCH_OPTIONS_BOOLEANS = {'Equals': 'exact',
                            'Is Greater Than': 'gt',
                            'Starts With': 'startswith',
                            'Starts With (case insensitive)': 'istartswith',
+                           'Is Allowed': 'exact',
                           }
 
 FILTER_OPTIONS_ORDER = ['Authority', 'BadDirectory', 'BadExit',
@@ -4,23 +4,24 @@ Views for statusapp that involve creating dynamic graphs.
 # Python-specific import statements -----------------------------------
 from copy import copy
 import datetime
+from multiprocessing import TimeoutError
 
 # Django-specific import statements -----------------------------------
-from django.db.models import Max
-from django.views.decorators.cache import cache_page
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils.cache import patch_response_headers
+from django.utils import simplejson
 
-# Matplotlib-specific import statements -------------------------------
-import matplotlib
-from pylab import legend
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-from matplotlib.ticker import MaxNLocator
+# NumPy-specific import statements ------------------------------------
+import numpy
 
 # TorStatus specific import statements --------------------------------
-from statusapp.models import Bwhist, TotalBandwidth, NetworkSize, \
-        ActiveRelay
-from custom.aggregate import CountCase
+from statusapp.models import Bwhist, TotalBandwidth, NetworkSize
+from custom.snapshot import get_snapshot
+from custom.exitpolicy import MAX_PORT
+from custom.epoch import epoch_key
+from custom.graphstore import get_graph, set_graph, purge_graphs
+from custom.graphrender import submit_graph, bar_graph, line_graph, \
+        total_bandwidth_graph, port_coverage_graph
 
 # Default parameters to be used with the graphs. Each graph may change
 # certain parameters, but a default dictionary enforces uniformity
@@ -33,6 +34,26 @@ DEFAULT_PARAMS = {'WIDTH': 960, 'HEIGHT': 320, 'TOP_MARGIN': 25,
                   'FONT_WEIGHT': 'bold', 'BAR_WIDTH': 0.5,
                   'COLOR': '#005500', 'TITLE': ''}
 
+# How long, in seconds, clients may keep a network statistic graph.
+GRAPH_MAX_AGE = 60 * 15
+
+# How long, in seconds, clients are asked to wait before they ask again
+# for a graph that was not drawn in time.
+GRAPH_RETRY_AFTER = 30
+
+
+def graph_timed_out():
+    """
+    Answer a request for a graph that was not drawn in time.
+
+    @rtype: HttpResponse
+    @return: A 503 response that asks the client to try again later.
+    """
+    response = HttpResponse('The graph could not be drawn in time.\n',
+                            mimetype='text/plain', status=503)
+    response['Retry-After'] = str(GRAPH_RETRY_AFTER)
+    return response
+
 
 def readhist(request, fingerprint):
     """
@@ -49,7 +70,12 @@ def readhist(request, fingerprint):
     @return: A PNG image that is the graph of the read bandwidth
         history information for the given router.
     """
-    return draw_line_graph(fingerprint, 'Read', '#68228B', '#DAC8E2')
+    graph = draw_line_graph(fingerprint, 'Read', '#68228B', '#DAC8E2')
+    try:
+        data = graph.get()
+    except TimeoutError:
+        return graph_timed_out()
+    return HttpResponse(data, mimetype='image/png')
 
 
 def writehist(request, fingerprint):
@@ -67,32 +93,33 @@ def writehist(request, fingerprint):
     @return: A PNG image that is the graph of the written bandwidth
         history information for the given router.
     """
-    return draw_line_graph(fingerprint, 'Written', '#66CD00', '#D9F3C0')
+    graph = draw_line_graph(fingerprint, 'Written', '#66CD00',
+                            '#D9F3C0')
+    try:
+        data = graph.get()
+    except TimeoutError:
+        return graph_timed_out()
+    return HttpResponse(data, mimetype='image/png')
 
 
-@cache_page(60 * 15)
-def bycountrycode(request):
+def draw_bycountrycode():
     """
     Return a graph representing the number of routers by country code.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the number of routers by country
-        code as an HttpResponse object.
+        code.
     """
     params = copy(DEFAULT_PARAMS)
     params['LABEL_ROT'] = 'vertical'
     params['TITLE'] = 'Number of Routers by Country Code'
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va)
+    snapshot = get_snapshot()
 
     # Build a dictionary mapping countries to the number of relays
     # from that country
     country_map = {}
-    for relay in relays:
-        country = relay.country
+    for country in snapshot.values('country', snapshot.latest):
         if country is None:
             country = '??'
         if country in country_map:
@@ -108,15 +135,14 @@ def bycountrycode(request):
     return draw_bar_graph(xs, ys, keys, params)
 
 
-@cache_page(60 * 15)
-def exitbycountrycode(request):
+def draw_exitbycountrycode():
     """
     Return a graph representing the number of exit routers
     by country code.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the number of exit routers by country
-        code as an HttpResponse object.
+        code.
     """
     params = copy(DEFAULT_PARAMS)
     # Make labels vertical to increase readability and minimize
@@ -124,16 +150,13 @@ def exitbycountrycode(request):
     params['LABEL_ROT'] = 'vertical'
     params['TITLE'] = 'Number of Exit Routers by Country Code'
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va, isexit=1)
+    snapshot = get_snapshot()
+    relays = snapshot.filter({'isexit': 1}, snapshot.latest)
 
     # Build a dictionary mapping countries to the number of relays
     # from that country
     country_map = {}
-    for relay in relays:
-        country = relay.country
+    for country in snapshot.values('country', relays):
         if country is None:
             country = '??'
         if country in country_map:
@@ -149,36 +172,29 @@ def exitbycountrycode(request):
     return draw_bar_graph(xs, ys, keys, params)
 
 
-@cache_page(60 * 15)
-def bytimerunning(request):
+def draw_bytimerunning():
     """
     Return a graph representing the uptime of routers in the Tor
     network.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the uptime of routers in the
-        Tor network as an HttpResponse object.
+        Tor network.
     """
     params = copy(DEFAULT_PARAMS)
     params['X_FONT_SIZE'] = '9'
     params['TITLE'] = 'Number of Routers by Time Running (weeks)'
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va)
+    snapshot = get_snapshot()
 
     uptime_map = {}
 
-    # TODO: This step is very inefficient; a custom SUM(CASE WHERE...
-    # should probably be written.
-    for relay in relays:
+    for uptimedays in snapshot.values('uptimedays', snapshot.latest):
         # The uptime in weeks is seconds / (seconds/min * min/hour
         # * hour/day * day/week), where / signifies floor division.
-        uptimedays = relay.uptimedays
         if uptimedays is None:
             continue
-        weeks = relay.uptimedays / 7
+        weeks = uptimedays / 7
         if weeks in uptime_map:
             uptime_map[weeks] += 1
         else:
@@ -192,13 +208,12 @@ def bytimerunning(request):
     return draw_bar_graph(xs, ys, keys, params)
 
 
-@cache_page(60 * 15)
-def byobservedbandwidth(request):
+def draw_byobservedbandwidth():
     """
     Return a graph representing the observed bandwidth of the
     routers in the Tor network.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the observed bandwidth of the
         routers in the Tor network.
     """
@@ -219,10 +234,7 @@ def byobservedbandwidth(request):
               (501, 1000), (1001, 2000), (2001, 3000), (3001, 5000),
               (5001, 10000)]
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va)
+    snapshot = get_snapshot()
 
     # Get the highest defined limit in RANGES
     excess = RANGES[-1][1] + 1
@@ -234,9 +246,7 @@ def byobservedbandwidth(request):
         bw_map[rng] = 0
     bw_map[excess] = 0
 
-    for relay in relays:
-        kbps = relay.bandwidthkbps
-
+    for kbps in snapshot.values('bandwidthkbps', snapshot.latest):
         # Binary search -- extensible to finer-grained ranges
         rngs = RANGES
         while (rngs and (not rngs[len(rngs) / 2][0] <= kbps <= \
@@ -261,15 +271,14 @@ def byobservedbandwidth(request):
     return draw_bar_graph(xs, ys, labels, params)
 
 
-@cache_page(60 * 15)
-def byplatform(request):
+def draw_byplatform():
     """
     Return a graph representing the platforms of the active relays
     in the Tor network.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the platforms of the active relays
-        in the Tor network as an HttpResponse object.
+        in the Tor network.
     """
     params = copy(DEFAULT_PARAMS)
     params['WIDTH'] = 480
@@ -277,10 +286,7 @@ def byplatform(request):
     params['X_FONT_SIZE'] = '9'
     params['TITLE'] = 'Number of Routers by Platform'
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va)
+    snapshot = get_snapshot()
 
     platform_map = {}
     keys = ['Linux', 'Windows', 'FreeBSD', 'Darwin', 'OpenBSD',
@@ -290,11 +296,7 @@ def byplatform(request):
 
     platform_map['Unknown'] = 0
 
-    # TODO: Inefficient for the same reason that the observed bandwidth
-    # graph is inefficient; a custom SUM(CASE WHERE...) should be
-    # necessary here
-    for relay in relays:
-        platform = relay.platform
+    for platform in snapshot.values('platform', snapshot.latest):
         if platform is None:
             platform_map['Unknown'] += 1
             continue
@@ -316,13 +318,12 @@ def byplatform(request):
     return draw_bar_graph(xs, ys, keys, params)
 
 
-@cache_page(60 * 15)
-def aggregatesummary(request):
+def draw_aggregatesummary():
     """
     Return a graph representing an aggregate summary of the routers on
-    the network as an HttpResponse object.
+    the network.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing an aggregate summary of the routers on
         the Tor network.
     """
@@ -331,25 +332,8 @@ def aggregatesummary(request):
     params['TITLE'] = 'Aggregate Summary -- Number of Routers Matching' \
                     + ' Specified Criteria'
 
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-
-    relays = ActiveRelay.objects.filter(validafter=last_va)
-
-    total = relays.count()
-    counts = ActiveRelay.objects.filter(validafter=last_va).aggregate(
-             isauthority=CountCase('isauthority', when=True),
-             isbaddirectory=CountCase('isbaddirectory', when=True),
-             isbadexit=CountCase('isbadexit', when=True),
-             isexit=CountCase('isexit', when=True),
-             isfast=CountCase('isfast', when=True),
-             isguard=CountCase('isguard', when=True),
-             ishibernating=CountCase('ishibernating', when=True),
-             isnamed=CountCase('isnamed', when=True),
-             isstable=CountCase('isstable', when=True),
-             isrunning=CountCase('isrunning', when=True),
-             isvalid=CountCase('isvalid', when=True),
-             isv2dir=CountCase('isv2dir', when=True))
+    snapshot = get_snapshot()
+    relays = snapshot.latest
 
     keys = ['isauthority', 'isbaddirectory', 'isbadexit', 'isv2dir',
             'isexit', 'isfast', 'isguard', 'ishibernating', 'isnamed',
@@ -361,45 +345,21 @@ def aggregatesummary(request):
     xs = range(num_params)
 
     ys = []
-    ys.append(total)
-    for count in keys:
-        ys.append(counts[count])
+    ys.append(len(relays))
+    for flag in keys:
+        ys.append(snapshot.count(flag, relays))
 
     return draw_bar_graph(xs, ys, labels, params)
 
 
-@cache_page(60 * 15)
-def networktotalbw(request):
+def draw_networktotalbw():
     """
     Return a graph representing the total bandwidth of the Tor network.
 
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: A graph representing the total bandwidth of the
         Tor Network.
     """
-    # Graph presentation parameters -----------------------------------
-    HEIGHT = 160
-    WIDTH = 440
-    TOP_MARGIN = 8
-    BOTTOM_MARGIN = 28
-    LEFT_MARGIN = 50
-    RIGHT_MARGIN = 50
-    X_FONT_SIZE = 8
-    Y_FONT_SIZE = 8
-    LABEL_FONT_SIZE = 8
-    LABEL_ROT = 'horizontal'
-    FONT_WEIGHT = 'bold'
-
-    # Set margins according to specification.
-    matplotlib.rcParams['figure.subplot.left'] = \
-            float(LEFT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.right'] = \
-            float(WIDTH - RIGHT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.top'] = \
-            float(HEIGHT - TOP_MARGIN) / HEIGHT
-    matplotlib.rcParams['figure.subplot.bottom'] = \
-            float(BOTTOM_MARGIN) / HEIGHT
-
     # TotalBandwidth Plot --------------------------------------------
     # Get last 93 TotalBandwidth entries
     tbw_entries = list(TotalBandwidth.objects.all().order_by(
@@ -408,7 +368,6 @@ def networktotalbw(request):
     # Should be 93, but could be less if not enough TotalBandwidth
     # entries are present
     data_points = len(tbw_entries)
-    xs = range(data_points)
 
     ys_bwobserved = []
     for i in range(data_points - 1, -1, -1):
@@ -423,37 +382,6 @@ def networktotalbw(request):
                                   2, to_add_date.day)
         times.append(to_add_str)
 
-    width_inches = float(WIDTH) / 80
-    height_inches = float(HEIGHT) / 80
-
-    fig = Figure(facecolor='white', edgecolor='black',
-                 figsize=(width_inches, height_inches), frameon=False)
-
-    # Draw bandwidth observed line
-    ax1 = fig.add_subplot(111)
-
-    observed_bw = ax1.plot(xs, ys_bwobserved, color='#68228B',
-                           label='Observed Bandwidth')
-
-    # Shade the area below the graph lightly
-    ax1.fill_between(xs, 0, ys_bwobserved, color='#DAC8E2')
-
-    # Label the graph with appropriate colors and fontsizes
-    ax1.set_xlabel("Date (GMT)", fontsize='8', fontweight=FONT_WEIGHT)
-    ax1.set_xticks(range(0, data_points, 7))
-    ax1.set_xticklabels(times, fontsize=X_FONT_SIZE,
-                        fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
-
-    ax1.set_ylabel("Bandwidth (MiB)",
-                  fontsize='8', fontweight=FONT_WEIGHT)
-
-    for tick in ax1.yaxis.get_major_ticks():
-        tick.label1.set_fontsize(Y_FONT_SIZE)
-        tick.label1.set_fontweight(FONT_WEIGHT)
-
-    for tick in ax1.get_yticklabels():
-        tick.set_color('#68228B')
-
     # Relays Plot -----------------------------------------------------
     net_size = list(NetworkSize.objects.all().order_by('-date')[:93])
 
@@ -466,140 +394,85 @@ def networktotalbw(request):
     for i in range(data_points - 1, -1, -1):
         ys.append(net_size[i].avg_running)
 
-    # Draw average relays running line using same 'xs' as before.
-    ax2 = ax1.twinx()
-    active_relays = ax2.plot(xs, ys, color='#005500',
-                             label='Average Active Relays')
-
-    # Label the graph with appropriate colors and fontsizes
-    ax2.set_xticks(range(0, data_points, 7))
-    ax2.set_xticklabels(times, fontsize=X_FONT_SIZE,
-                        fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
-
-    ax2.set_ylabel('Relays', fontsize='8', fontweight=FONT_WEIGHT)
-
-    for tick in ax2.yaxis.get_major_ticks():
-        tick.label2.set_fontsize(Y_FONT_SIZE)
-        tick.label2.set_fontweight(FONT_WEIGHT)
-
-    for tick in ax2.get_yticklabels():
-        tick.set_color('#005500')
-
-    # Label entire graph
-    fontparam = matplotlib.font_manager.FontProperties(
-                size=8, weight='bold')
-
-    # TODO: put both labels in one legend. How?
-    ax1.legend(prop=fontparam, loc='lower left')
-    ax2.legend(prop=fontparam, loc='lower right')
-
-    # TODO: Make a grid that works for both lines
-    # (Set tick marks such that a grid applies to both lines)
-    ax1.set_ylim(ymin=0)
-    ax1.set_xlim(xmin=0)
-    ax2.set_xlim(xmin=0)
-    ax1.yaxis.set_major_locator(MaxNLocator(5))
-    ax2.yaxis.set_major_locator(MaxNLocator(5))
-    canvas = FigureCanvas(fig)
-    response = HttpResponse(content_type='image/png')
-    canvas.print_png(response, ha="center")
-    return response
+    return submit_graph(total_bandwidth_graph, ys_bwobserved, ys, times)
+
+
+def draw_exitports():
+    """
+    Return a graph of the number of exits and the exit bandwidth that
+    allow exiting to each port, for a generic public destination.
+
+    @rtype: L{PendingGraph}
+    @return: A graph of the exit capacity of every port.
+    """
+    counts, bandwidths = get_snapshot().port_coverage()
+    return submit_graph(port_coverage_graph, counts, bandwidths)
+
+
+def exitportsjson(request):
+    """
+    Return the number of exits and the exit bandwidth that allow
+    exiting to each port, as JSON.
+
+    With a C{port} parameter, only that port is answered, as an object
+    with the keys C{port}, C{exits}, and C{bandwidth}. Otherwise every
+    port from 1 to 65535 is answered, as a list of [first, last,
+    exits, bandwidth] ranges of ports that have the same values.
+    Bandwidth is the total observed bandwidth in bytes per second.
+
+    @rtype: HttpResponse
+    @return: The exit capacity of the ports as an HttpResponse object,
+        or an HttpResponseBadRequest if the port is not valid.
+    """
+    snapshot = get_snapshot()
+    counts, bandwidths = snapshot.port_coverage()
+    result = {'validafter': str(snapshot.validafter)}
+
+    port = request.GET.get('port')
+    if port is not None:
+        if not (port.isdigit() and 1 <= int(port) <= MAX_PORT):
+            return HttpResponseBadRequest('Invalid port.\n',
+                                          mimetype='text/plain')
+        port = int(port)
+        result.update(port=port, exits=int(counts[port]),
+                      bandwidth=int(bandwidths[port]))
+    else:
+        # Cut the ports wherever either value changes.
+        changes = numpy.flatnonzero((numpy.diff(counts[1:]) != 0) |
+                                    (numpy.diff(bandwidths[1:]) != 0))
+        firsts = [1] + (changes + 2).tolist()
+        lasts = (changes + 1).tolist() + [MAX_PORT]
+        result['ranges'] = [[first, last, int(counts[first]),
+                             int(bandwidths[first])]
+                            for first, last in zip(firsts, lasts)]
+
+    return HttpResponse(simplejson.dumps(result),
+                        mimetype='application/json')
 
 
 def draw_bar_graph(xs, ys, labels, params):
     """
-    Draws a bar graph, given data points, labels, and presentation
-    parameters.
+    Have a bar graph drawn, given data points, labels, and presentation
+    parameters; see L{bar_graph}.
 
     @type xs: C{list}
     @param xs: The x values to be plotted.
     @type ys: C{list}
     @param ys: The y values to be plotted.
     @type labels: C{list} of C{string}
-    @param labels: The labels to be used for each data point, where
-        C{labels[i]} labels C{(xs[i], ys[i])}.
+    @param labels: The labels to be used for each data point.
     @type params: C{dict} of C{string} and C{int}
     @param params: Parameters specifying how the graph is to be drawn.
-        Params must contain the keys: WIDTH, HEIGHT, TOP_MARGIN,
-        BOTTOM_MARGIN, LEFT_MARGIN, RIGHT_MARGIN, X_FONT_SIZE,
-        Y_FONT_SIZE, LABEL_FONT_SIZE, FONT_WEIGHT, BAR_WIDTH,
-        COLOR, LABEL_FLOAT, LABEL_ROT, and TITLE.
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: The graph as specified by the parameters given.
     """
-    ## Get the parameters from the params dictionary
-    # Width and height of the graph in pixels
-    WIDTH = params['WIDTH']
-    HEIGHT = params['HEIGHT']
-    # Space in pixels given around plot
-    TOP_MARGIN = params['TOP_MARGIN']
-    BOTTOM_MARGIN = params['BOTTOM_MARGIN']
-    LEFT_MARGIN = params['LEFT_MARGIN']
-    RIGHT_MARGIN = params['RIGHT_MARGIN']
-    # Font sizes, in pixels
-    X_FONT_SIZE = params['X_FONT_SIZE']
-    Y_FONT_SIZE = params['Y_FONT_SIZE']
-    LABEL_FONT_SIZE = params['LABEL_FONT_SIZE']
-    # How many pixels above each bar the labels should be
-    LABEL_FLOAT = params['LABEL_FLOAT']
-    # How the labels should be presented
-    LABEL_ROT = params['LABEL_ROT']
-    # Font weight used for labels and titles
-    FONT_WEIGHT = params['FONT_WEIGHT']
-    BAR_WIDTH = params['BAR_WIDTH']
-    COLOR = params['COLOR']
-    # Title of graph
-    TITLE = params['TITLE']
-
-    # Set margins according to specification.
-    matplotlib.rcParams['figure.subplot.left'] = \
-            float(LEFT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.right'] = \
-            float(WIDTH - RIGHT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.top'] = \
-            float(HEIGHT - TOP_MARGIN) / HEIGHT
-    matplotlib.rcParams['figure.subplot.bottom'] = \
-            float(BOTTOM_MARGIN) / HEIGHT
-
-    # Draw the figure.
-    width_inches = float(WIDTH) / 80
-    height_inches = float(HEIGHT) / 80
-    fig = Figure(facecolor='white', edgecolor='black',
-                 figsize=(width_inches, height_inches), frameon=False)
-    ax = fig.add_subplot(111)
-
-    # Plot the data.
-    ax.bar(xs, ys, color=COLOR, width=BAR_WIDTH)
-
-    # Label the height of each bar.
-    label_float_ydist = ax.get_ylim()[1] * LABEL_FLOAT / (
-                        HEIGHT - TOP_MARGIN - BOTTOM_MARGIN)
-    num_params = len(xs)
-    for i in range(num_params):
-        ax.text(xs[i] + (BAR_WIDTH / 2.0),
-                ys[i] + (label_float_ydist), str(ys[i]),
-                fontsize=LABEL_FONT_SIZE, horizontalalignment='center')
-
-    x_index = matplotlib.numpy.arange(num_params)
-    ax.set_xticks(x_index + (BAR_WIDTH / 2.0))
-    ax.set_xticklabels(labels, fontsize=X_FONT_SIZE,
-                       fontweight=FONT_WEIGHT, rotation=LABEL_ROT)
-
-    for tick in ax.yaxis.get_major_ticks():
-        tick.label1.set_fontsize(Y_FONT_SIZE)
-        tick.label1.set_fontweight(FONT_WEIGHT)
-
-    ax.set_title(TITLE, fontsize='12', fontweight=FONT_WEIGHT)
-
-    canvas = FigureCanvas(fig)
-    response = HttpResponse(content_type='image/png')
-    canvas.print_png(response, ha="center")
-    return response
+    return submit_graph(bar_graph, xs, ys, labels, params)
 
 
 def draw_line_graph(fingerprint, bwtype, color, shade):
     """
-    Draws a line graph with given data points and display parameters.
+    Have a line graph drawn of the most recent bandwidth history of a
+    router; see L{line_graph}.
 
     @type fingerprint: C{string}
     @param fingerprint: The fingerprint of the router that the graph
@@ -612,33 +485,9 @@ def draw_line_graph(fingerprint, bwtype, color, shade):
     @param color: The color to draw the line graph with.
     @type shade: C{string}
     @param shade: The color to shade under the line graph.
-    @rtype: HttpResponse
+    @rtype: L{PendingGraph}
     @return: The graph as specified by the parameters given.
     """
-    # Width and height of the graph in pixels
-    WIDTH = 480
-    HEIGHT = 320
-    # Space in pixels given around plot
-    TOP_MARGIN = 42
-    BOTTOM_MARGIN = 32
-    LEFT_MARGIN = 98
-    RIGHT_MARGIN = 5
-    # Font sizes, in pixels
-    X_FONT_SIZE = '8'
-    Y_FONT_SIZE = '8'
-    # Font weight used for labels and titles.
-    FONT_WEIGHT = 'bold'
-
-    # Set margins according to specification.
-    matplotlib.rcParams['figure.subplot.left'] = \
-            float(LEFT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.right'] = \
-            float(WIDTH - RIGHT_MARGIN) / WIDTH
-    matplotlib.rcParams['figure.subplot.top'] = \
-            float(HEIGHT - TOP_MARGIN) / HEIGHT
-    matplotlib.rcParams['figure.subplot.bottom'] = \
-            float(BOTTOM_MARGIN) / HEIGHT
-
     last_hist = Bwhist.objects.filter(fingerprint=fingerprint)\
                 .order_by('-date')[:1][0]
 
@@ -684,12 +533,6 @@ def draw_line_graph(fingerprint, bwtype, color, shade):
             y_list = ([0] * 96)
         tr_list[0:0] = y_list[(-1 * to_fill):]
 
-    width_inches = float(WIDTH) / 80
-    height_inches = float(HEIGHT) / 80
-    fig = Figure(facecolor='white', edgecolor='black',
-                 figsize=(width_inches, height_inches), frameon=False)
-    ax = fig.add_subplot(111)
-
     # Return bytes per second, not total bandwidth for 15 minutes
     bps = map(lambda x: x / (15 * 60), tr_list)
     times = []
@@ -699,36 +542,127 @@ def draw_line_graph(fingerprint, bwtype, color, shade):
                                     2, to_add_date.minute)
         times.append(to_add_str)
 
-    dates = range(96)
+    title = ("Average Bandwidth " + bwtype + " History:\n"
+             + start_time.strftime("%Y-%m-%d %H:%M") + " to "
+             + end_time.strftime("%Y-%m-%d %H:%M"))
 
-    # Draw the graph and give the graph a light shade underneath it
-    ax.plot(dates, bps, color=color)
-    ax.fill_between(dates, 0, bps, color=shade)
+    return submit_graph(line_graph, bps, times, title, color, shade)
 
-    ax.set_xlabel("Time (GMT)", fontsize='12')
-    ax.set_xticks(range(0, 104, 8))
-    ax.set_xticklabels(times, fontsize=X_FONT_SIZE,
-                       fontweight=FONT_WEIGHT)
 
-    ax.set_ylabel("Bandwidth (bytes/sec)", fontsize='12')
+# The network statistic graphs, by name, and the functions that draw
+# them from the most recent consensus.
+NETWORK_GRAPHS = {'aggregatesummary': draw_aggregatesummary,
+                  'bycountrycode': draw_bycountrycode,
+                  'exitbycountrycode': draw_exitbycountrycode,
+                  'bytimerunning': draw_bytimerunning,
+                  'byobservedbandwidth': draw_byobservedbandwidth,
+                  'byplatform': draw_byplatform,
+                  'networktotalbw': draw_networktotalbw,
+                  'exitports': draw_exitports}
 
-    # Don't extend the y-axis to negative numbers, in any circumstance
-    ax.set_ylim(ymin=0)
 
-    # Don't use scientific notation
-    ax.yaxis.major.formatter.set_scientific(False)
+def network_graph(name):
+    """
+    Serve a network statistic graph of the most recent consensus.
 
-    # Format the y-tick labels with the desired font weight and size
-    for tick in ax.yaxis.get_major_ticks():
-        tick.label1.set_fontsize(Y_FONT_SIZE)
-        tick.label1.set_fontweight(FONT_WEIGHT)
+    The graph is served as it was stored by L{render_network_graphs}.
+    If it has not been stored for the most recent consensus yet, it is
+    drawn now and stored for the requests that follow.
 
-    ax.set_title("Average Bandwidth " + bwtype + " History:\n"
-            + start_time.strftime("%Y-%m-%d %H:%M") + " to "
-            + end_time.strftime("%Y-%m-%d %H:%M"), fontsize='12',
-            fontweight=FONT_WEIGHT)
+    @type name: C{string}
+    @param name: The name of the graph, a key of L{NETWORK_GRAPHS}.
+    @rtype: HttpResponse
+    @return: The graph as a PNG image.
+    """
+    key = epoch_key()
+    data = get_graph(name, key)
+    if data is None:
+        try:
+            data = NETWORK_GRAPHS[name]().get()
+        except TimeoutError:
+            return graph_timed_out()
+        try:
+            set_graph(name, key, data)
+        except EnvironmentError:
+            # The graph is served all the same; it will be drawn again.
+            pass
 
-    canvas = FigureCanvas(fig)
-    response = HttpResponse(content_type='image/png')
-    canvas.print_png(response, ha="center")
+    response = HttpResponse(data, mimetype='image/png')
+    patch_response_headers(response, GRAPH_MAX_AGE)
     return response
+
+
+def render_network_graphs():
+    """
+    Draw every network statistic graph from the most recent consensus
+    and store them, removing the graphs of earlier consensuses.
+
+    @rtype: C{string}
+    @return: The key of the consensus that the graphs were drawn from;
+        see L{epoch_key}.
+    """
+    key = epoch_key()
+    # Submit every graph before waiting for any, so that they are
+    # drawn at the same time.
+    graphs = [(name, NETWORK_GRAPHS[name]())
+              for name in sorted(NETWORK_GRAPHS)]
+    for name, graph in graphs:
+        set_graph(name, key, graph.get())
+    purge_graphs(key)
+    return key
+
+
+def aggregatesummary(request):
+    """
+    Serve the graph of the number of routers with each flag.
+    """
+    return network_graph('aggregatesummary')
+
+
+def bycountrycode(request):
+    """
+    Serve the graph of the number of routers by country code.
+    """
+    return network_graph('bycountrycode')
+
+
+def exitbycountrycode(request):
+    """
+    Serve the graph of the number of exit routers by country code.
+    """
+    return network_graph('exitbycountrycode')
+
+
+def bytimerunning(request):
+    """
+    Serve the graph of the number of routers by time running.
+    """
+    return network_graph('bytimerunning')
+
+
+def byobservedbandwidth(request):
+    """
+    Serve the graph of the number of routers by observed bandwidth.
+    """
+    return network_graph('byobservedbandwidth')
+
+
+def byplatform(request):
+    """
+    Serve the graph of the number of routers by platform.
+    """
+    return network_graph('byplatform')
+
+
+def networktotalbw(request):
+    """
+    Serve the graph of the total bandwidth of the Tor network.
+    """
+    return network_graph('networktotalbw')
+
+
+def exitports(request):
+    """
+    Serve the graph of the exits and exit bandwidth of every port.
+    """
+    return network_graph('exitports')
@@ -10,6 +10,8 @@ from django.http import HttpRequest, HttpResponse
 
 # TorStatus-specific import statements --------------------------------
 from statusapp.models import Bwhist, Descriptor
+from custom.addresses import parse_address, parse_network, \
+        is_address, IPV4
 
 # INIT Variables ------------------------------------------------------
 # TODO: Move these variables to settings.py and refactor the code.
@@ -64,7 +66,8 @@ SEARCHES = set(('fingerprint',
                  'address',
                  'orport',
                  'dirport',
-                 'platform'))
+                 'platform',
+                 'exitport'))
 CRITERIA = set(('exact',
                  'iexact',
                  'contains',
@@ -196,10 +199,11 @@ def is_ip_in_subnet(ip, subnet):
     """
     Return True if the IP is in the subnet, return False otherwise.
 
-    This implementation uses bitwise arithmetic and operators on
-    IPv4 subnets. Currently, this implementation does not accomodate
-    IPv6 address/subnet definitions. This should be added in the
-    future, before Tor core accomodates IPv6 addresses and subnets.
+    Both IPv4 and IPv6 addresses and subnets are understood; an
+    address is never in a subnet of the other version. The address
+    and subnet are parsed to integers by L{custom.addresses}, so
+    callers that test many addresses should parse the subnet once
+    with L{parse_network} instead.
 
     >>> is_ip_in_subnet('0.0.0.0', '0.0.0.0/8')
     True
@@ -207,6 +211,8 @@ def is_ip_in_subnet(ip, subnet):
     True
     >>> is_ip_in_subnet('1.0.0.0', '0.0.0.0/8')
     False
+    >>> is_ip_in_subnet('2001:db8::1', '2001:db8::/32')
+    True
 
     @type ip: C{string}
     @param ip: The IP address to check for membership in the subnet.
@@ -214,65 +220,19 @@ def is_ip_in_subnet(ip, subnet):
     @param subnet: The subnet that the given IP address may or may not
         be in.
     @rtype: C{boolean}
-    @return: True if the IP address is in the subnet, false otherwise.
-
-    @see: U{http://www.webopedia.com/TERM/S/subnet_mask.html}
-    @see: U{http://wiki.python.org/moin/BitwiseOperators}
+    @return: True if the IP address is in the subnet, false otherwise,
+        including when either cannot be parsed.
     """
     # If the subnet is a wildcard, the IP will always be in the subnet
     if (subnet == '*'):
         return True
 
-    # If the subnet is the IP, the IP is in the subnet
-    if (subnet == ip):
-        return True
-
-    # If the IP doesn't match and no bits are provided,
-    # the IP is not in the subnet
-    if ('/' not in subnet):
-        return False
-
-    # Separate the base from the bits and convert the base to an int
-    base, bits = subnet.split('/')
-
-    # a.b.c.d becomes a*2^24 + b*2^16 + c*2^8 + d
-    a, b, c, d = base.split('.')
-    subnet_as_int = (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + \
-                     int(d)
-
-    # Example: if 8 bits are specified, then the mask is calculated by
-    # taking a 32-bit integer consisting of 1s and doing a bitwise shift
-    # such that only 8 1s are left at the start of the 32-bit integer
-    if (int(bits) == 0):
-        mask = 0
-    else:
-        mask = (~0 << (32 - int(bits)))
-
-    # Calculate the lower and upper bounds using the mask.
-    # For example, 255.255.128.0/16 should have lower bound 255.255.0.0
-    # and upper bound 255.255.255.255. 255.255.128.0/16 is the same as
-    # 11111111.11111111.10000000.00000000 with mask
-    # 11111111.11111111.00000000.00000000. Then using the bitwise and
-    # operator, the lower bound would be
-    # 11111111.11111111.00000000.00000000.
-    lower_bound = subnet_as_int & mask
-
-    # Similarly, ~mask would be 00000000.00000000.11111111.11111111,
-    # so ~mask & 0xFFFFFFFF = ~mask & 11111111.11111111.11111111.11111111,
-    # or 00000000.00000000.11111111.11111111. Then
-    # 11111111.11111111.10000000.00000000 | (~mask % 0xFFFFFFFF) is
-    # 11111111.11111111.11111111.11111111.
-    upper_bound = subnet_as_int | (~mask & 0xFFFFFFFF)
-
-    # Convert the given IP to an integer, as before
-    a, b, c, d = ip.split('.')
-    ip_as_int = (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
-
-    # Now we can see if the IP is in the subnet or not
-    if (ip_as_int >= lower_bound and ip_as_int <= upper_bound):
-        return True
-    else:
+    try:
+        version, value = parse_address(ip)
+        network = parse_network(subnet)
+    except ValueError:
         return False
+    return network.contains(version, value)
 
 
 def is_ipaddress(ip):
@@ -280,6 +240,10 @@ def is_ipaddress(ip):
     Return True if the given supposed IP address could be a valid IP
     address, False otherwise.
 
+    Only IPv4 addresses are accepted, since the pages that check their
+    input with this function look up IPv4 relays and destinations; see
+    L{is_address} for IPv6.
+
     >>> is_ipaddress('127.0.0.1')
     True
     >>> is_ipaddress('a.b.c.d')
@@ -295,28 +259,7 @@ def is_ipaddress(ip):
     @return: True if the IP address could be a valid IP address,
         False otherwise.
     """
-    # Including period separators, no IP as a string can have more than
-    # 15 characters.
-    if (len(ip) > 15):
-        return False
-
-    # Every IP must be separated into four parts by period separators.
-    if (len(ip.split('.')) != 4):
-        return False
-
-    # Users can give IP addresses a.b.c.d such that a, b, c, or d
-    # cannot be casted to an integer. If a, b, c, or d cannot be casted
-    # to an integer, the given IP address is certainly not a
-    # valid IP address.
-    a, b, c, d = ip.split('.')
-    try:
-        if (int(a) > 255 or int(a) < 0 or int(b) > 255 or int(b) < 0 or
-            int(c) > 255 or int(c) < 0 or int(d) > 255 or int(d) < 0):
-            return False
-    except ValueError:
-        return False
-
-    return True
+    return is_address(ip, IPV4)
 
 
 def is_port(port):
@@ -542,7 +485,7 @@ def gen_list_dict(active_relays):
                           'bandwidthkbps': str(relay.bandwidthkbps) + " KB/s",
                           'uptime': str(relay.uptimedays) + " d",
                           'address': relay.address,
-                          #'hostname': relay.hostname,
+                          'hostname': relay.hostname,
                           'hibernating': 1 if relay.ishibernating else 0,
                           'orport': relay.orport,
                           'dirport': relay.dirport,
@@ -3,25 +3,34 @@ The pages module for TorStatus.
 
 This module contains a single controller for each page type.
 """
-# General python import statements ------------------------------------
-import subprocess
-import datetime
-from socket import getfqdn
-
 # Django-specific import statements -----------------------------------
 from django.shortcuts import render_to_response, redirect
-from django.http import HttpResponse, HttpRequest
-from django.db.models import Q, Max, Sum, Count
+from django.template.loader import render_to_string
+from django.http import HttpResponse, HttpRequest, \
+        HttpResponseBadRequest
+from django.db.models import Q, Max, Sum
 from django.db import connection
 from django.views.decorators.cache import cache_page
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.views.decorators.csrf import csrf_exempt
 
 # TorStatus specific import statements --------------------------------
 from statusapp.models import Statusentry, Descriptor, Bwhist,\
-        TotalBandwidth, ActiveRelay
+        TotalBandwidth
 from custom.aggregate import CountCase
+from custom.addresses import address_to_int
+from custom.exitpolicy import stream_exit_list
+from custom.details import load_relay, details_key, get_details, \
+        set_details, fill_uptime, UPTIME_PLACEHOLDER
+from custom.pagecache import page_key, not_modified, get_page, \
+        set_page, set_redirect
+from custom.paginator import KeysetPaginator
+from custom.resolver import get_hostname
+from custom.whois import get_whois, WHOIS_REFRESH
+from custom.snapshot import get_snapshot
 from helpers import *
 from display_helpers import *
+from rows import render_rows, stream_rows, stream_page, \
+        ROWS_PLACEHOLDER
 
 # INIT Variables ------------------------------------------------------
 CURRENT_COLUMNS = ['Country Code', 'Router Name', 'Bandwidth',
@@ -31,17 +40,11 @@ CURRENT_COLUMNS = ['Country Code', 'Router Name', 'Bandwidth',
                    'Stable', 'V2Dir', 'Platform']
 
 AVAILABLE_COLUMNS = ['Fingerprint', 'LastDescriptorPublished',
-                     'Contact', 'BadDir']
+                     'Contact', 'BadDir', 'Hostname']
 
 NOT_MOVABLE_COLUMNS = ['Named', 'Exit', 'Authority', 'Fast', 'Guard',
                        'Hibernating', 'Stable', 'V2Dir', 'Platform']
 
-DISPLAYABLE_COLUMNS = set(('Country Code', 'Router Name', 'Bandwidth',
-                            'Uptime', 'IP', 'Icons', 'ORPort',
-                            'DirPort', 'BadExit', 'Fingerprint',
-                            'LastDescriptorPublished', 'Contact',
-                            'BadDir'))
-
 def splash(request):
     """
     The splash page for the TorStatus website.
@@ -71,11 +74,8 @@ def index(request):
     if reset == 'True':
         search_session_reset(request)
 
-    # Get all relays in last consensus
-    last_validafter = ActiveRelay.objects.aggregate(
-                      last=Max('validafter'))['last']
-    active_relays = ActiveRelay.objects.filter(
-                    validafter=last_validafter).order_by('nickname')
+    # Get the snapshot of the last consensus
+    snapshot = get_snapshot()
 
     # Get the order specified by session.request
     order = get_order(request)
@@ -126,75 +126,103 @@ def index(request):
     # defined at this point.
     assert not (basic_input and advanced_input)
 
+    # Get the current columns from the session. If no current columns
+    # are defined, just use the default, CURRENT_COLUMNS
+    current_columns = []
+    if not ('currentColumns' in request.session):
+        request.session['currentColumns'] = CURRENT_COLUMNS
+    current_columns = request.session['currentColumns']
+
+    # The client may choose, on the display options page, to view all
+    # relays on one page.
+    all_relays = request.session.get('all', 0)
+
+    # Make sure entries per page is an integer. If not, or
+    # if no value is specified, make entries per page 50.
+    per_page = request.session.get('perpage', 50)
+
+    # The "next" and "previous" links name the relay that the
+    # requested page starts after or ends before, so that pages
+    # stay put while relays come and go.
+    after = request.GET.get('after', '')
+    before = request.GET.get('before', '')
+
+    # Make sure page request is an int. If not, deliver first page.
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+
+    # Everything above determines the page completely for a given
+    # consensus, so a page that has been rendered before is served
+    # from the page cache (see custom/pagecache.py). Pages of all
+    # relays are streamed rather than cached.
+    key = page_key('index', snapshot.validafter,
+                   (basic_input, advanced_input, order, per_page,
+                    after, before, page, current_columns, all_relays))
+    if not all_relays:
+        response = not_modified(request, key) or get_page(request, key)
+        if response is not None:
+            return response
+
     # If basic search input has been supplied, search the beginnings
     # of all fingerprints, nicknames, and IPs in the last consensus
-    # and return any matches
-    if basic_input:
-        active_relays = active_relays.filter(
-                        Q(nickname__istartswith=basic_input) | \
-                        Q(fingerprint__istartswith=basic_input) | \
-                        Q(address__istartswith=basic_input)).\
-                        order_by(order)
-
-    # Otherwise, an advanced search may have been defined, so filter
-    # all relays by the parameters given
-    else:
-        active_relays = active_relays.filter(
-                        **advanced_input).order_by(order)
-
-    num_results = active_relays.count()
+    # and return any matches. Otherwise, an advanced search may have
+    # been defined, so filter all relays by the parameters given. The
+    # ordered results are kept by the snapshot, so other pages of the
+    # same search only slice them.
+    active_relays = snapshot.results(basic_input, advanced_input,
+                                     order)
+    num_results = len(active_relays)
 
     # If the search returns only one relay, go to the details page for
     # that relay.
-    if active_relays.count() == 1:
-        url = ''.join(('/details/', active_relays[0].fingerprint))
+    if num_results == 1:
+        url = ''.join(('/details/',
+                       snapshot.value('fingerprint', active_relays[0])))
+        if not all_relays:
+            return set_redirect(key, url)
         return redirect(url)
 
-    # TODO: Eventually give client the option to view all relays
-    # on one page. The page needs to load faster before this
-    # is possible.
-    all_relays = request.session.get('all', 0)
-
     # If the user doesn't want to see all of the relays, then paginate
     # results.
     if not all_relays:
-        # Make sure entries per page is an integer. If not, or
-        # if no value is specified, make entries per page 50.
-        per_page = request.session.get('perpage', 50)
-        paginator = Paginator(active_relays, per_page)
-
-        # Make sure page request is an int. If not, deliver first page.
-        try:
-            page = int(request.GET.get('page', 1))
-        except ValueError:
-            page = 1
-
-        # If page request is out of range, deliver last
-        # page of results.
-        try:
+        paginator = KeysetPaginator(snapshot, active_relays, order,
+                                    per_page)
+
+        # If the relay named by "after" or "before" is gone, deliver
+        # the first page. If page request is out of range, deliver
+        # last page of results.
+        if after:
+            paged_relays = paginator.page_after(after)
+        elif before:
+            paged_relays = paginator.page_before(before)
+        else:
             paged_relays = paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            paged_relays = paginator.page(paginator.num_pages)
     # Display all relays on one page by making the page size as large
-    # as the current result set
+    # as the current result set. The relay table is streamed, so its
+    # rows are rendered after the response has started.
     else:
-        paginator = Paginator(active_relays, num_results)
+        paginator = KeysetPaginator(snapshot, active_relays, order,
+                                    num_results)
         paged_relays = paginator.page(1)
 
-    # Convert the list of relays to a dictionary object
-    paged_relays.object_list = gen_list_dict(paged_relays.object_list)
-
-    # Get the current columns from the session. If no current columns
-    # are defined, just use the default, CURRENT_COLUMNS
-    current_columns = []
-    if not ('currentColumns' in request.session):
-        request.session['currentColumns'] = CURRENT_COLUMNS
-    current_columns = request.session['currentColumns']
-
+    # Render the rows of the relay table outside of the template; see
+    # rows.py. Only the fields that the current columns display are
+    # read from the snapshot. When all relays are displayed, the rest
+    # of the page is rendered around a placeholder, and the rows are
+    # rendered in chunks as the response is sent. A page without
+    # relays has no relay table to stream, and is rendered whole.
+    stream = all_relays and len(paged_relays.object_list) > 0
+    if stream:
+        relay_rows = ROWS_PLACEHOLDER
+    else:
+        relay_rows = render_rows(snapshot, paged_relays.object_list,
+                                 current_columns)
 
     template_values = {'paged_relays': paged_relays,
                        'current_columns': current_columns,
-                       'displayable_columns': DISPLAYABLE_COLUMNS,
+                       'relay_rows': relay_rows,
                        'not_columns': NOT_MOVABLE_COLUMNS,
                        'request': request,
                        'column_value_name': COLUMN_VALUE_NAME,
@@ -204,7 +232,16 @@ def index(request):
                                 ascending_or_descending,
                        'order_param': order_param}
 
-    return render_to_response('index.html', template_values)
+    html = render_to_string('index.html', template_values)
+
+    if stream:
+        rows = stream_rows(snapshot, paged_relays.object_list,
+                           current_columns)
+        response = HttpResponse(stream_page(html, rows))
+        response.streaming = True
+        return response
+
+    return set_page(request, key, html)
 
 
 def details(request, fingerprint):
@@ -219,27 +256,38 @@ def details(request, fingerprint):
     @return: The L{ActiveRelay} information of the router.
     """
     # We'll let the client look up a relay as long as it is in the
-    # ActiveRelay cache; it need not be in the last consensus
-    poss_relay = ActiveRelay.objects.filter(
-                 fingerprint=fingerprint).order_by('-validafter')[:1]
+    # ActiveRelay cache; it need not be in the last consensus. The
+    # snapshot knows everything that the page is keyed by, so a page
+    # that has been rendered before is served without any queries
+    # (see custom/details.py).
+    snapshot = get_snapshot()
+    position = snapshot.positions.get(fingerprint)
+    if position is not None:
+        hostname = get_hostname(snapshot.value('address', position))
+        key = details_key(snapshot.validafter, fingerprint,
+                          snapshot.value('descriptor', position),
+                          hostname)
+        html = get_details(key)
+        if html is not None:
+            return HttpResponse(fill_uptime(html,
+                    snapshot.value('uptime', position),
+                    snapshot.value('published', position)))
+
+    # Get the most recent entry for this relay, together with the
+    # validafter of the last consensus.
+    relay = load_relay(fingerprint)
 
     # If no such relay exists, display a 404 page with an informative
     # debugging message.
-    if not poss_relay:
+    if relay is None:
         return render_to_response(
                 '404.html',
                 {'debug_message': 'The server could not find any ' + \
                                   'recently active relay with a ' + \
                                   'fingerprint of ' + fingerprint + '.'})
 
-    # Otherwise, at least one entry for the relay exists, so get the
-    # most recent entry for this relay
-    relay = poss_relay[0]
-
     # Create an attribute, 'active', to flag active/unactive relays.
-    last_va = ActiveRelay.objects.aggregate(
-              last=Max('validafter'))['last']
-    if last_va != relay.validafter:
+    if relay.last_validafter != relay.validafter:
         relay.active = False
     else:
         relay.active = True
@@ -251,24 +299,19 @@ def details(request, fingerprint):
     else:
         relay.hasdescriptor = False
 
-    # If the relay has a descriptor and the relay is active, calculate
-    # the adjusted uptime
+    # If the relay has a descriptor and the relay is active, the
+    # adjusted uptime is displayed. It is filled in each time the page
+    # is served, since it changes while the page is cached.
+    relay.adjuptime = None
     if relay.hasdescriptor and relay.active:
-        published = relay.published
-        now = datetime.datetime.now()
-        diff = now - published
-        diff_sec = (diff.microseconds + (
-                    diff.seconds + diff.days * 24 * 3600) * 10**6) \
-                    / 10**6
-        relay.adjuptime = relay.uptime + diff_sec
-
-    # TODO: eventually, we'll want to find a way to add a hostname
-    # attribute into the database instead of calculating it each time
-    # the details page is requested. It might be of interest on the
-    # index page as well.
-    # NOTE: getfqdn returns the IP address itself if no hostname is
-    # available, so there is no need to catch errors or null objects.
-    relay.hostname = getfqdn(str(relay.address))
+        relay.adjuptime = UPTIME_PLACEHOLDER
+
+    # Hostnames are looked up in the background (see
+    # custom/resolver.py), so a hostname that has not been found yet
+    # is displayed as the IP address itself, as getfqdn would.
+    if position is None:
+        hostname = get_hostname(relay.address)
+    relay.hostname = hostname or relay.address
 
     # Generate a dictionary mapping labels to
     # values in a router details table
@@ -286,28 +329,39 @@ def details(request, fingerprint):
                        'options_list': options_list,
                        'flags_list': flags_list,
                        }
-    return render_to_response('details.html', template_values)
+    html = render_to_string('details.html', template_values)
+
+    # Relays that are not in the snapshot are not cached, since the
+    # snapshot is what the cache is looked up by.
+    if position is not None:
+        set_details(key, html)
+    return HttpResponse(fill_uptime(html, relay.uptime, relay.published))
 
 
 def whois(request, address):
     """
     Get WHOIS information for a given IP address.
 
-    @see: U{http://docs.python.org/library/subprocess.html}
+    @see: L{custom.whois}
 
     @type address: C{string}
     @param address: The IP address to gather WHOIS information for.
     @rtype: HttpResponse
     @return: The WHOIS information of the L{address} as an HttpResponse.
     """
-    # Make sure that the given IP address is in fact an IP address
+    # Make sure that the given IP address is in fact an IP address.
+    # Lookups run in the background (see custom/whois.py); if this one
+    # has not finished after a moment, the page reloads itself until
+    # it has.
+    pending = False
+    record = None
+    whois = None
     if is_ipaddress(address):
-        # NOTE: Linux/Unix specific command; would break on windows.
-        # TODO: Find a replacement for this command.
-        proc = subprocess.Popen(["whois %s" % address],
-                                  stdout=subprocess.PIPE,
-                                  shell=True)
-        whois = proc.communicate()[0]
+        record = get_whois(address)
+        if record is None:
+            pending = True
+        else:
+            whois = record.whois
 
     # If the given IP address is not a valid IP address, the whois
     # information cannot be looked up. Supply helpful debugging
@@ -315,15 +369,20 @@ def whois(request, address):
     else:
         whois = 'Unparsable IP address supplied.'
 
-    template_values = {'whois': whois, 'address': address}
-    return render_to_response('whois.html', template_values)
+    template_values = {'whois': whois, 'record': record,
+                       'address': address, 'pending': pending}
+    response = render_to_response('whois.html', template_values)
+    if pending:
+        response['Refresh'] = str(WHOIS_REFRESH)
+    return response
 
 
 def exitnodequery(request):
     """
     Determine if an IP address is an active Tor server, and optionally
     see if the server's exit policy would permit it to exit to a given
-    destination IP address and port.
+    destination IP address and port. Given only a destination, list
+    every running Tor server that would permit exiting to it.
 
     This method aims to provide meaningful information to the client in
     the case of unparsable input by returning both the information
@@ -371,71 +430,53 @@ def exitnodequery(request):
     router_nickname = ""
     exit_possible = False
     relays = []
-    if (source_valid):
-
-        # Don't search entries published over 24 hours
-        # from the most recent entries.
-        last_va = ActiveRelay.objects.aggregate(
-                  last=Max('validafter'))['last']
+    if (dest_ip_valid):
+        dest_address = address_to_int(dest_ip)
+
+    # Without a Query IP, list every running relay that would allow
+    # exiting to the destination, from the exit index of the consensus
+    # snapshot (see custom/exitpolicy.py).
+    reverse = not source and dest_ip_valid
+    exits = []
+    if (reverse):
+        snapshot = get_snapshot()
+        positions = snapshot.exits(dest_address, int(dest_port))
+        for relay in snapshot.relays(snapshot.order(positions,
+                                                    'nickname')):
+            exits.append((relay.nickname, relay.fingerprint))
 
-        fingerprints = ActiveRelay.objects.filter(
-                       address=source).values(
-                       'fingerprint').annotate(
-                       Count('fingerprint'))
-
-        # Grouped by fingerprints, which are unique. If at least one
-        # fingerprint is found, there is a match, so for each
-        # fingerprint, get the fingerprint and nickname.
-        if (fingerprints):
+    if (source_valid):
+        # The relays on the source address are found in the address
+        # index of the consensus snapshot, along with their compiled
+        # exit policies (see custom/exitpolicy.py), so this makes no
+        # queries.
+        snapshot = get_snapshot()
+        positions = snapshot.relays_at(address_to_int(source))
+        if (positions):
             is_router = True
 
-            # For each entry, gather the nickname and fingerprint. If a
-            # destination IP and port are defined, also find whether or
-            # not the entries will allow exiting to the given
-            # IP and port.
-            for fp_entry in fingerprints:
-                # Note that the trailing [:1] is djangonese for
-                # "LIMIT 1", so this query should not be expensive.
-                relay = ActiveRelay.objects.filter(
-                        fingerprint=fp_entry['fingerprint']).order_by(
-                        '-validafter')[:1][0]
-
-                nickname = relay.nickname
-                fingerprint = relay.fingerprint
-                exit_possible = False
-
-                # If the client also wants to test the relay's exit
-                # policy, dest_ip and dest_port cannot be empty strings.
-                if (dest_ip_valid and dest_port_valid):
-
-                    # Search the exit policy information for a case in
-                    # which the given IP is in a subnet defined in the
-                    # exit policy information of a relay.
-                    for policy_line in relay.exitpolicy:
-                        condition, network_line = (policy_line.strip())\
-                                                   .split(' ')
-                        subnet, port_line = network_line.split(':')
-
-                        # When the IP is in the given subnet, check to
-                        # ensure that the given destination port is also
-                        # in the port defined in the exit policy
-                        # information. When a match is found, see if the
-                        # condition is "accept" or "reject".
-                        if (is_ip_in_subnet(dest_ip, subnet)):
-                            if (port_match(dest_port, port_line)):
-                                if (condition == 'accept'):
-                                    exit_possible = True
-                                else:
-                                    exit_possible = False
-                                break
-
-                # Render a 'relays' list to response consisting only of
-                # the relays' nickname, fingerprint, and whether or not
-                # exiting is possible to the specified IP and port.
-                relays.append((nickname, fingerprint, exit_possible))
+        # For each relay, gather the nickname and fingerprint. If a
+        # destination IP and port are defined, also find whether or
+        # not the relay will allow exiting to the given IP and port.
+        for position, relay in zip(positions,
+                                   snapshot.relays(positions)):
+            exit_possible = False
+            if (dest_ip_valid and dest_port_valid):
+                policy = snapshot.policies[position]
+                exit_possible = (policy is not None and
+                                 policy.allows(dest_address,
+                                               int(dest_port)))
+
+            # Render a 'relays' list to response consisting only of
+            # the relays' nickname, fingerprint, and whether or not
+            # exiting is possible to the specified IP and port.
+            relays.append((relay.nickname, relay.fingerprint,
+                           exit_possible))
 
     template_values = {'is_router': is_router,
                        'relays': relays,
+                       'reverse': reverse,
+                       'exits': exits,
                        'dest_ip': dest_ip,
                        'dest_port': dest_port,
                        'source': source,
@@ -445,6 +486,61 @@ def exitnodequery(request):
     return render_to_response('nodequery.html', template_values)
 
 
+@csrf_exempt
+def exitlist(request):
+    """
+    Check a batch of addresses against the relays that would allow
+    exiting to a destination IP address and port, in the manner of
+    TorDNSEL.
+
+    The destination is given as C{destinationAddress} and, optionally,
+    C{destinationPort}, which defaults to 80 as in L{exitnodequery}.
+    The addresses to check are POSTed as an uploaded file or a form
+    field named C{addresses}, or as the body of the request, separated
+    by whitespace or commas. Each address that is a running relay that
+    would allow exiting to the destination is streamed back on a line
+    of its own, in the order given; other addresses are left out.
+    Without any addresses, the whole exit list of the destination is
+    returned, one address per line.
+
+    The exit list comes from the consensus snapshot, which keeps it for
+    the rest of the consensus; see L{ConsensusSnapshot.exit_list}.
+
+    @rtype: HttpResponse
+    @return: The addresses, as text/plain.
+    """
+    dest_ip = request.REQUEST.get('destinationAddress', '').strip()
+    dest_port = request.REQUEST.get('destinationPort', '80').strip()
+    if not (is_ipaddress(dest_ip) and is_port(dest_port)):
+        return HttpResponseBadRequest('A valid destinationAddress and '
+                                      'destinationPort are required.\n',
+                                      mimetype='text/plain')
+
+    exits = get_snapshot().exit_list(address_to_int(dest_ip),
+                                      int(dest_port))
+
+    lines = []
+    if request.method == 'POST':
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith('multipart/'):
+            if 'addresses' in request.FILES:
+                lines = request.FILES['addresses']
+            else:
+                lines = request.POST.get('addresses', '').splitlines()
+        elif content_type.startswith(
+                'application/x-www-form-urlencoded'):
+            lines = request.POST.get('addresses', '').splitlines()
+        else:
+            lines = request.raw_post_data.splitlines()
+
+    if lines:
+        content = stream_exit_list(exits, lines)
+    else:
+        content = ''.join([exits[address] + '\n'
+                           for address in sorted(exits)])
+    return HttpResponse(content, mimetype='text/plain')
+
+
 @cache_page(60 * 30)
 def networkstatisticgraphs(request):
     """
@@ -453,8 +549,10 @@ def networkstatisticgraphs(request):
     return render_to_response('statisticgraphs.html')
 
 
-# NOTE/TODO: When the index page loads faster, increase the upper bound
-MAX_PP = 200
+# The largest number of relays per page. The relay table is rendered
+# by rows.py rather than by the template language, so a page can hold
+# every relay in the network; see benchmark_index.
+MAX_PP = 10000
 def display_options(request):
     """
     Let the user choose what columns should be displayed on the index
@@ -475,23 +573,35 @@ def display_options(request):
     # input in the session.
     if 'pp' in request.GET:
 
-        # Ensure that the supplied information is an integer between 1
-        # and MAX_PP, inclusive.
-        try:
-            supplied_pp = int(request.GET.get('pp', ''))
-            assert 1 <= supplied_pp <= MAX_PP
-            request.session['perpage'] = supplied_pp
-
-        # Display a helpful debug_message in the case of unusable input
-        except (ValueError, AssertionError):
-            debug_message = 'Unable to set \"Relays Per Page\" to' + \
-                            ' the given value.\nPlease enter an' + \
-                            ' integer between 1 and ' + str(MAX_PP) + \
-                            ', inclusive.'
+        # "all" displays every relay on one page, streamed to the
+        # client.
+        if request.GET['pp'].strip().lower() == 'all':
+            request.session['all'] = 1
+
+        # Otherwise, ensure that the supplied information is an integer
+        # between 1 and MAX_PP, inclusive.
+        else:
+            try:
+                supplied_pp = int(request.GET.get('pp', ''))
+                assert 1 <= supplied_pp <= MAX_PP
+                request.session['perpage'] = supplied_pp
+                request.session['all'] = 0
+
+            # Display a helpful debug_message in the case of unusable
+            # input
+            except (ValueError, AssertionError):
+                debug_message = 'Unable to set \"Relays Per Page\"' + \
+                                ' to the given value.\nPlease enter' + \
+                                ' an integer between 1 and ' + \
+                                str(MAX_PP) + ', inclusive, or' + \
+                                ' \"all\".'
 
     # Get the number of relays per page from the session, and if it
     # doesn't exist, make it 50 by default.
-    current_pp = int(request.session.get('perpage', 50))
+    if request.session.get('all', 0):
+        current_pp = 'All'
+    else:
+        current_pp = int(request.session.get('perpage', 50))
 
     current_columns = []
     available_columns = []
@@ -0,0 +1,447 @@
+"""
+The relay rows of the index page, rendered without the template
+language.
+
+index.html used to decide how to display every cell of every relay by
+looping over the current columns and looking up each value through
+template filters, even though those decisions depend only on the
+current columns and not on the relay. A L{RowRenderer} makes those
+decisions once for a tuple of current columns, producing a single
+format string for a row and a list of the values that fill it, and
+then fills the format string once per relay.
+
+A renderer also knows which fields its columns display, so relays are
+handed to it as compact tuples of just those fields, read column by
+column from the consensus snapshot and formatted as gen_list_dict()
+would format them, rather than as dictionaries of every field.
+
+Renderers are cached by their tuple of columns, so each distinct
+column layout is compiled once per process.
+"""
+# General python import statements ------------------------------------
+import threading
+
+# Django-specific import statements -----------------------------------
+from django.conf import settings
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+# TorStatus specific import statements --------------------------------
+from statusapp.templatetags.index_filters import FILTERED_NAME, get_os
+from helpers import ICONS
+
+# INIT Variables ------------------------------------------------------
+# The columns that are displayed in a cell of their own. Flag columns
+# that are not listed here are only displayed as icons.
+DISPLAYABLE_COLUMNS = set(('Country Code', 'Router Name', 'Bandwidth',
+                           'Uptime', 'IP', 'Icons', 'ORPort',
+                           'DirPort', 'BadExit', 'Fingerprint',
+                           'LastDescriptorPublished', 'Contact',
+                           'BadDir', 'Hostname'))
+
+# Whether the template language displays integers without thousand
+# separators, so that they can be displayed with unicode().
+PLAIN_INTEGERS = not (settings.USE_L10N and
+                      settings.USE_THOUSAND_SEPARATOR)
+
+# The largest number of column layouts whose renderers are kept.
+MAX_RENDERERS = 128
+
+# The number of relays rendered at a time when the relay table is
+# streamed.
+STREAM_CHUNK_SIZE = 250
+
+# Stands in for the relay rows when the rest of index.html is rendered
+# around a streamed relay table.
+ROWS_PLACEHOLDER = mark_safe(u'<!-- relay rows -->')
+
+# The fields of the rows that are handed to a renderer, named as in
+# FILTERED_NAME, mapped to the field of the snapshot that each is read
+# from and to the function that formats it, as in gen_list_dict().
+ROW_FIELDS = {'country': ('country', None),
+              'longitude': ('longitude', None),
+              'latitude': ('latitude', None),
+              'nickname': ('nickname', None),
+              'bandwidthkbps': ('bandwidthkbps',
+                                lambda value: '%s KB/s' % value),
+              'uptime': ('uptimedays', lambda value: '%s d' % value),
+              'address': ('address', None),
+              'hostname': ('hostname', None),
+              'hibernating': ('ishibernating', int),
+              'orport': ('orport', None),
+              'dirport': ('dirport', None),
+              'isbadexit': ('isbadexit', int),
+              'isnamed': ('isnamed', int),
+              'isexit': ('isexit', int),
+              'isauthority': ('isauthority', int),
+              'isfast': ('isfast', int),
+              'isguard': ('isguard', int),
+              'isstable': ('isstable', int),
+              'isv2dir': ('isv2dir', int),
+              'platform': ('platform', None),
+              'fingerprint': ('fingerprint', None),
+              'published': ('published', None),
+              'contact': ('contact', None),
+              'isbaddirectory': ('isbaddirectory', int),
+             }
+
+BAD_EXIT_YES = ('<img src="/static/img/bg_yes.png" width="12" '
+                'height="12" alt="Bad Exit" title="Bad Exit">')
+BAD_EXIT_NO = ('<img src="/static/img/bg_no.png" width="12" height="12" '
+               'alt="Not a Bad Exit" title="Not a Bad Exit">')
+BAD_DIR_YES = ('<img src="/static/img/bg_yes.png" width="12" '
+               'height="12" alt="Bad Directory" title="Bad Directory">')
+BAD_DIR_NO = ('<img src="/static/img/bg_no.png" width="12" height="12" '
+              'alt="Not a Bad Directory" title="Not a Bad Directory">')
+
+__renderers = {}
+__renderers_lock = threading.Lock()
+
+
+def text(value):
+    """
+    Convert a value to escaped text, as the template language would
+    display C{{{ value }}} with autoescaping on.
+
+    Strings and numbers, which make up nearly every cell, are
+    converted directly; other values are localized as the template
+    language would localize them. Floats, which are only displayed as
+    coordinates, always use a '.' as their decimal separator, as the
+    openstreetmap links that they appear in require.
+
+    @type value: C{object}
+    @param value: The value to display.
+    @rtype: C{unicode}
+    @return: The value as escaped text.
+    """
+    if isinstance(value, basestring):
+        return force_unicode(value).replace('&', '&amp;').replace(
+                '<', '&lt;').replace('>', '&gt;').replace(
+                '"', '&quot;').replace("'", '&#39;')
+    if value is None or isinstance(value, float) or (
+            PLAIN_INTEGERS and isinstance(value, (int, long))):
+        return unicode(value)
+    return escape(force_unicode(localize(value)))
+
+
+class RowRenderer(object):
+    """
+    Renders the relays on the index page as table rows for one tuple
+    of current columns.
+
+    @type columns: C{tuple} of C{string}
+    @ivar columns: The current columns, in the order they are displayed.
+    @type fields: C{list} of C{string}
+    @ivar fields: The fields that the columns display, in the order
+        they appear in the rows that L{render} takes.
+    @type row_format: C{unicode}
+    @ivar row_format: The format string of a row, with one C{%s} for
+        the class of the row and for each value in L{cells}.
+    @type cells: C{list} of C{callable}
+    @ivar cells: Functions mapping a row to the escaped values that
+        fill L{row_format}.
+    """
+
+    def __init__(self, columns):
+        """
+        Compile the row template for a tuple of current columns.
+
+        @type columns: C{tuple} of C{string}
+        @param columns: The current columns.
+        """
+        self.columns = columns
+        self.fields = []
+        self.cells = []
+        parts = [u'<tr class="%s">']
+
+        for column in columns:
+            if column == 'Country Code':
+                parts.append(u'<td id="col_relayName"><a href="http://'
+                             u'www.openstreetmap.org/?mlon=%s&mlat=%s'
+                             u'&zoom=6"><img src="/static/img/flags/'
+                             u'%s.png" alt=%s title="%s: %s, %s" '
+                             u'border=0></a></td>')
+                country = self._slot('country')
+                self.cells.extend([self._field('Longitude'),
+                                   self._field('Latitude'),
+                                   lambda row: escape(force_unicode(
+                                           row[country]).lower()),
+                                   self._field(column),
+                                   self._field(column),
+                                   self._field('Latitude'),
+                                   self._field('Longitude')])
+
+            elif column == 'Router Name':
+                link = (u'<a class="linkDetails" href="/details/%s" '
+                        u'target="_BLANK">%s</a>')
+                parts.append(u'<td id="col_relayName">%s</td>')
+                fingerprint = self._slot('fingerprint')
+                nickname = self._slot('nickname')
+                if 'Named' in columns:
+                    named = self._slot('isnamed')
+                    self.cells.append(lambda row: (
+                            u'<b>%s</b>' % link if row[named] == 1
+                            else link) % (text(row[fingerprint]),
+                                          text(row[nickname])))
+                else:
+                    self.cells.append(lambda row: link % (
+                            text(row[fingerprint]), text(row[nickname])))
+
+            elif column == 'IP':
+                parts.append(u'<td>[<a id="relayAddress" href="/details/'
+                             u'%s/whois">%s</a>]</td>')
+                self.cells.extend([self._field(column),
+                                   self._field(column)])
+
+            elif column == 'BadDir':
+                parts.append(u'<td id="col_relayBadDir">%s</td>')
+                self.cells.append(self._image(column, BAD_DIR_YES,
+                                              BAD_DIR_NO))
+
+            elif column == 'Icons':
+                parts.append(u'<td id="col_relayIcons">%s</td>')
+                self.cells.append(self._icons([icon for icon in ICONS
+                                               if icon in columns]))
+
+            elif column in DISPLAYABLE_COLUMNS:
+                parts.append(u'<td id="col_relay%s">%%s</td>' %
+                             text(column))
+                if column == 'BadExit':
+                    self.cells.append(self._image(column, BAD_EXIT_YES,
+                                                  BAD_EXIT_NO))
+                else:
+                    self.cells.append(self._field(column, u'None'))
+
+        parts.append(u'</tr>')
+        self.row_format = u''.join(parts)
+        self.row_class = self._row_class()
+
+    def project(self, snapshot, positions):
+        """
+        Read the fields that the columns display for a list of relays,
+        one field at a time, into a tuple per relay.
+
+        @type snapshot: L{ConsensusSnapshot}
+        @param snapshot: The snapshot that the relays belong to.
+        @type positions: C{list} of C{int}
+        @param positions: The positions of the relays, in display order.
+        @rtype: C{list} of C{tuple}
+        @return: The rows that L{render} takes.
+        """
+        if not self.fields:
+            return [()] * len(positions)
+        columns = []
+        for field in self.fields:
+            source, formatter = ROW_FIELDS[field]
+            values = snapshot.values(source, positions)
+            if formatter is not None:
+                values = map(formatter, values)
+            columns.append(values)
+        return zip(*columns)
+
+    def project_dicts(self, relays):
+        """
+        Convert relay dictionaries into the rows that L{render} takes.
+
+        @type relays: C{list} of C{dict}
+        @param relays: The relays, as produced by
+            L{helpers.gen_list_dict}.
+        @rtype: C{list} of C{tuple}
+        @return: The rows of the relays.
+        """
+        fields = self.fields
+        return [tuple([relay[field] for field in fields])
+                for relay in relays]
+
+    def render(self, rows):
+        """
+        Render a list of relays as table rows.
+
+        @type rows: C{list} of C{tuple}
+        @param rows: The relays, as produced by L{project} or
+            L{project_dicts}.
+        @rtype: C{SafeUnicode}
+        @return: The rows of the relays, as html.
+        """
+        row_format = self.row_format
+        row_class = self.row_class
+        cells = self.cells
+        html = [row_format % tuple([row_class(row)] +
+                                   [cell(row) for cell in cells])
+                for row in rows]
+        return mark_safe(u''.join(html))
+
+    def _slot(self, field):
+        """
+        Get the index of a field in the rows that L{render} takes,
+        adding the field to L{fields} if it is not there yet.
+        """
+        if field not in self.fields:
+            self.fields.append(field)
+        return self.fields.index(field)
+
+    def _row_class(self):
+        """
+        Get a function mapping a row to the class of its table row.
+        """
+        if 'BadExit' in self.columns:
+            bad_exit = self._slot('isbadexit')
+            hibernating = self._slot('hibernating')
+
+            def row_class(row):
+                if row[bad_exit] == 1:
+                    return u'relayBadExit'
+                if row[hibernating] == 1:
+                    return u'relayHibernating'
+                return u'relay'
+            return row_class
+        return lambda row: u'relay'
+
+    def _field(self, column, default=None):
+        """
+        Get a function mapping a row to the escaped value of a column,
+        or to C{default} if the value is false and a default is given,
+        as the C{default} template filter would.
+        """
+        slot = self._slot(FILTERED_NAME[column])
+        if default is None:
+            return lambda row: text(row[slot])
+        return lambda row: text(row[slot] or default)
+
+    def _image(self, column, yes, no):
+        """
+        Get a function mapping a row to one of two images, depending
+        on a flag.
+        """
+        slot = self._slot(FILTERED_NAME[column])
+        return lambda row: yes if row[slot] == 1 else no
+
+    def _icons(self, icons):
+        """
+        Get a function mapping a row to the images of the icons that
+        are among the current columns, in the order of L{ICONS}.
+        """
+        images = []
+        for icon in icons:
+            if icon == 'Platform':
+                images.append((self._slot('platform'), None))
+            else:
+                images.append((self._slot(FILTERED_NAME[icon]),
+                               u'<img src="/static/img/status/%s.png" '
+                               u'alt="%s" title="%s">' %
+                               (icon, icon, icon)))
+
+        def icon_images(row):
+            parts = []
+            for slot, image in images:
+                if image is None:
+                    parts.append(_platform_icon(row[slot]))
+                elif row[slot] == 1:
+                    parts.append(image)
+            return u''.join(parts)
+        return icon_images
+
+
+def _platform_icon(platform):
+    """
+    Get the image of the operating system of a relay.
+    """
+    os_name = get_os(platform)
+    if platform:
+        title = text(platform)
+    else:
+        title = u'Platform Not Available'
+    return (u'<img src="/static/img/os-icons/%s.png" alt="%s" '
+            u'title="%s">' % (os_name, os_name, title))
+
+
+def get_renderer(columns):
+    """
+    Get the L{RowRenderer} for a list of current columns, compiling it
+    if no renderer for the same columns has been compiled yet.
+
+    @type columns: C{list} of C{string}
+    @param columns: The current columns.
+    @rtype: L{RowRenderer}
+    @return: The renderer for the columns.
+    """
+    columns = tuple(columns)
+    renderer = __renderers.get(columns)
+    if renderer is None:
+        renderer = RowRenderer(columns)
+        __renderers_lock.acquire()
+        try:
+            if len(__renderers) >= MAX_RENDERERS:
+                __renderers.clear()
+            __renderers[columns] = renderer
+        finally:
+            __renderers_lock.release()
+    return renderer
+
+
+def render_rows(snapshot, positions, columns):
+    """
+    Render a list of relays as the rows of the relay table on the
+    index page.
+
+    @type snapshot: L{ConsensusSnapshot}
+    @param snapshot: The snapshot that the relays belong to.
+    @type positions: C{list} of C{int}
+    @param positions: The positions of the relays, in display order.
+    @type columns: C{list} of C{string}
+    @param columns: The current columns.
+    @rtype: C{SafeUnicode}
+    @return: The rows of the relays, as html.
+    """
+    renderer = get_renderer(columns)
+    return renderer.render(renderer.project(snapshot, positions))
+
+
+def stream_rows(snapshot, positions, columns,
+                chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Render a list of relays as the rows of the relay table, a chunk of
+    relays at a time, so that only one chunk of rows is held in memory
+    at once.
+
+    @type snapshot: L{ConsensusSnapshot}
+    @param snapshot: The snapshot that the relays belong to.
+    @type positions: C{list} of C{int}
+    @param positions: The positions of the relays, in display order.
+    @type columns: C{list} of C{string}
+    @param columns: The current columns.
+    @type chunk_size: C{int}
+    @param chunk_size: The number of relays to render at a time.
+    @rtype: generator of C{SafeUnicode}
+    @return: The rows of the relays, as html.
+    """
+    renderer = get_renderer(columns)
+    for start in xrange(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        yield renderer.render(renderer.project(snapshot, chunk))
+
+
+def stream_page(page, rows):
+    """
+    Stream a rendered page with the relay rows in place of
+    L{ROWS_PLACEHOLDER}.
+
+    @type page: C{unicode}
+    @param page: The page, rendered with L{ROWS_PLACEHOLDER} as its
+        relay rows.
+    @type rows: iterable of C{unicode}
+    @param rows: The chunks of relay rows, as from L{stream_rows}.
+    @rtype: generator of C{unicode}
+    @return: The chunks of the page, which is the page unchanged if
+        it has no placeholder.
+    """
+    if ROWS_PLACEHOLDER not in page:
+        yield page
+        return
+    head, tail = page.split(ROWS_PLACEHOLDER, 1)
+    yield head
+    for chunk in rows:
+        yield chunk
+    yield tail